@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Throughput benchmark for the raw tile copy in indicaTIFF_to_ome.py.
+
+Writes a synthetic HALO/Indica-style tiled pyramid, converts it once with one
+read per tile (the previous behaviour) and once per coalesced read setting,
+and checks that the tiles of every output are byte-identical to the baseline.
+
+Use --latency-ms to emulate per-request latency of network storage; memory
+mapped reads bypass the emulation and are skipped in that mode.
+"""
+
+import argparse
+import hashlib
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import tifffile
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'bin'))
+import indicaTIFF_to_ome  # noqa: E402
+
+
+def write_indica_pyramid(path, channels=4, size=4096, tile=256, levels=3, seed=0):
+    """Write a tiled multi-channel pyramid with an Indica-style XML description."""
+    rng = np.random.default_rng(seed)
+    data = rng.integers(0, 4096, size=(channels, size, size), dtype=np.uint16)
+    xml = '<root>' + ''.join(f'<channel name="CH{i}"/>' for i in range(channels)) + '</root>'
+    with tifffile.TiffWriter(path, bigtiff=True) as tw:
+        tw.write(
+            data, tile=(tile, tile), subifds=levels - 1, photometric='minisblack',
+            compression='zlib', description=xml, metadata=None,
+            resolution=(20000.0, 20000.0), resolutionunit='CENTIMETER',
+        )
+        for level in range(1, levels):
+            factor = 2 ** level
+            tw.write(
+                data[:, ::factor, ::factor], tile=(tile, tile), subfiletype=1,
+                photometric='minisblack', compression='zlib', metadata=None,
+            )
+    return sum(page.databytecounts[i] for page in tifffile.TiffFile(path).pages for i in range(len(page.databytecounts)))
+
+
+def emulate_latency(seconds):
+    """Delay every read issued through tifffile's FileHandle by a fixed amount."""
+    read = tifffile.FileHandle.read
+
+    def slow_read(self, size=-1):
+        time.sleep(seconds)
+        return read(self, size)
+
+    tifffile.FileHandle.read = slow_read
+
+
+def convert(src, dst, **options):
+    argv = ['indicaTIFF_to_ome.py', '-i', str(src), '-o', str(dst)]
+    for key, value in options.items():
+        flag = '--' + key.replace('_', '-')
+        if value is True:
+            argv.append(flag)
+        else:
+            argv.extend([flag, str(value)])
+    saved = sys.argv
+    sys.argv = argv
+    try:
+        start = time.perf_counter()
+        indicaTIFF_to_ome.main()
+        return time.perf_counter() - start
+    finally:
+        sys.argv = saved
+
+
+def tile_digest(path):
+    """Hash the raw tile bytes of every level; the OME-XML carries a fresh UUID per file."""
+    digest = hashlib.sha256()
+    with tifffile.TiffFile(path) as tif:
+        fh = tif.filehandle
+        for level in tif.series[0].levels:
+            for page in level:
+                for offset, bytecount in zip(page.dataoffsets, page.databytecounts):
+                    fh.seek(offset)
+                    digest.update(fh.read(bytecount))
+    return digest.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Indica tile copy")
+    parser.add_argument("--size", type=int, default=4096, help="Base level width/height in pixels")
+    parser.add_argument("--channels", type=int, default=4, help="Number of channels")
+    parser.add_argument("--tile", type=int, default=256, help="Tile width/height in pixels")
+    parser.add_argument("--repeat", type=int, default=3, help="Best-of repeats per configuration")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Emulated latency per read request in milliseconds")
+    args = parser.parse_args()
+
+    configs = {
+        'per-tile': {'read_size': 0, 'prefetch': 0},
+        'coalesced': {'prefetch': 0},
+        'coalesced+prefetch': {},
+        'mmap+prefetch': {'mmap': True},
+    }
+    if args.latency_ms > 0:
+        del configs['mmap+prefetch']
+
+    with tempfile.TemporaryDirectory() as tmp:
+        src = Path(tmp) / 'indica.tif'
+        payload = write_indica_pyramid(src, args.channels, args.size, args.tile)
+        print(f"Synthetic input: {src.stat().st_size / 2**20:.1f} MiB, tile payload {payload / 2**20:.1f} MiB")
+        if args.latency_ms > 0:
+            emulate_latency(args.latency_ms / 1000)
+
+        reference = None
+        for name, options in configs.items():
+            dst = Path(tmp) / f'{name}.ome.tif'
+            best = min(convert(src, dst, **options) for _ in range(args.repeat))
+            digest = tile_digest(dst)
+            reference = reference or digest
+            status = 'identical' if digest == reference else 'MISMATCH'
+            print(f"{name:>20}: {best:7.3f} s  {payload / 2**20 / best:8.1f} MiB/s  ({status})")
+            if digest != reference:
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Calibration runs for bin/estimate_resources.py.
+
+Writes synthetic OME-TIFFs of several sizes, runs each per-sample step on them
+with --perf (as the pipeline would: downscale, extract, every background removal
+method, segmentation input, render and channel selection) and fits the
+resource model to the resulting *.perf.json files. Inputs are generated in
+child processes too: on Linux a child's peak RSS starts from its parent's, so
+this process is kept small.
+
+    python benchmarks/calibrate_resources.py --workdir /tmp/mihcro-calib \
+        -o assets/resource_model.json --report assets/resource_model_report.md
+"""
+
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+import tifffile
+
+HERE = Path(__file__).resolve().parent
+BIN = HERE.parent / 'bin'
+
+# base plane sizes at 0.5 µm/pixel, downscaled to half that at the default 1 µm/pixel
+SIZES = (1024, 2048, 4096, 6144, 8192)
+CHANNELS = 4
+# rolling ball time grows with radius² per pixel, so it is only run on the smaller sizes
+ROLLINGBALL_MAX_SIZE = 4096
+
+
+def run(script, *args, perf=True):
+    command = [sys.executable, str(script), *map(str, args)] + (['--perf'] if perf else [])
+    print(' '.join(command[1:]), flush=True)
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+
+
+def run_step(script, *args):
+    run(BIN / script, *args)
+
+
+def synthetic(*args):
+    run(HERE / 'synthetic.py', *args, perf=False)
+
+
+def calibrate(workdir: Path, sizes, sigma: float, radius: int):
+    workdir.mkdir(parents=True, exist_ok=True)
+    names = [f'CH{c}' for c in range(CHANNELS)]
+    markers = workdir / 'markers.csv'
+    markers.write_text('marker_name\n' + ''.join(f'{name}\n' for name in names[:-1]))
+
+    for size in sizes:
+        stem = workdir / f's{size}'
+        image = f'{stem}.ome.tif'
+        synthetic('ome', image, '--axes', 'CYX', '--size', size, '--channels', CHANNELS,
+                  '--compression', 'zlib', '--pyramid', 'subifd', '--levels', 3)
+        run_step('ome_tiff_rescaler.py', image, '--prefix', stem)
+        downscaled = f'{stem}.downscaled.ome.tiff'
+        with tifffile.TiffFile(downscaled) as tif:
+            xml = Path(f'{stem}.xml')
+            xml.write_text(tif.ome_metadata)
+            plane = tif.series[0].shape[-1]
+
+        run_step('extract_image_channel.py', '-i', downscaled, '-x', xml, '-c', 'CH0', '-o', f'{stem}_dapi.tif')
+        run_step('extract_image_channel.py', '-i', downscaled, '-x', xml, '-c', 'CH1', '-o', f'{stem}_membrane.tif')
+
+        methods = ['otsu_only', 'mean', 'gaussian']
+        if size <= ROLLINGBALL_MAX_SIZE:
+            methods.append('rollingball')
+        for method in methods:
+            run_step('otsu_thresholding.py', '-i', f'{stem}_dapi.tif', '-m', method, '-s', sigma, '-r', radius,
+                '-o', f'{stem}_{method}.tif', '-p', f'{stem}_{method}.png')
+        run_step('otsu_thresholding.py', '--image', downscaled, '-x', xml, '-m', 'af',
+            '--dapi_channel', 'CH0', '--af_channel', names[-1],
+            '-o', f'{stem}_af.tif', '-p', f'{stem}_af.png')
+
+        run_step('stack_segmentation_input.py', '-i', f'{stem}_dapi.tif', '-i', f'{stem}_membrane.tif',
+            '-o', f'{stem}_seg_input.tif')
+
+        mask = f'{stem}_mask.tif'
+        synthetic('mask', mask, '--size', plane, '--cells', plane * plane // 1000)
+        run_step('render_boundaries.py', '--dapi_path', f'{stem}_dapi.tif', '--mask_path', mask,
+            '--output_prefix', f'{stem}_render')
+
+        run_step('convert_ome_tiff.py', '-i', downscaled, '-m', markers, '-o', f'{stem}_separated.ome.tif')
+
+    return sorted(workdir.glob('*.perf.json'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit bin/estimate_resources.py to perf runs on synthetic inputs")
+    parser.add_argument("--workdir", type=Path, required=True, help="Directory for inputs, outputs and *.perf.json")
+    parser.add_argument("-o", "--output", type=str, required=True, help="Fitted model .json")
+    parser.add_argument("--report", type=str, help="Fit-quality report (markdown)")
+    parser.add_argument("--sizes", type=int, nargs='+', default=SIZES, help="Base plane sizes")
+    parser.add_argument("--sigma", type=float, default=50, help="Gaussian sigma, as params.dapi_bg_sigma")
+    parser.add_argument("--radius", type=int, default=50, help="Rolling ball radius, as params.dapi_bg_radius")
+    args = parser.parse_args()
+
+    perf_files = calibrate(args.workdir, args.sizes, args.sigma, args.radius)
+    command = [sys.executable, str(BIN / 'estimate_resources.py'), 'fit', *map(str, perf_files), '-o', args.output]
+    if args.report:
+        command += ['--report', args.report]
+    subprocess.run(command, check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+"""
+Timing and peak memory benchmarks for the bin/ hot paths.
+
+Each case runs in its own Python process so that its peak RSS is not
+inflated by earlier cases. Inputs are synthetic (see synthetic.py) and are
+generated once per work directory, in a separate process, before the case
+processes start, so input generation is neither timed nor counted in the
+memory figures. On Linux a process inherits its parent's ru_maxrss across
+fork and exec, so peaks are read from VmHWM, which each case process resets
+when it starts (see reset_peak_rss).
+
+Results are written as JSON. Pass a previous result file with --compare to
+report cases that got slower or use more memory than the tolerance allows;
+the exit code is 1 if any case regressed or started failing.
+
+    python benchmarks/run_benchmarks.py -o results.json
+    python benchmarks/run_benchmarks.py -o new.json --compare results.json
+"""
+
+import argparse
+import datetime
+import fnmatch
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from collections import namedtuple
+from importlib import metadata
+from pathlib import Path
+
+BENCHMARKS = Path(__file__).resolve().parent
+BIN = BENCHMARKS.parent / 'bin'
+sys.path.insert(0, str(BENCHMARKS))
+sys.path.insert(0, str(BIN))
+
+import synthetic  # noqa: E402
+
+# fixture name -> (file name, writer(path, size))
+FIXTURES = {
+    'cyx_u16_subifd2_zlib': ('cyx_u16_subifd2_zlib.ome.tif', lambda p, n: synthetic.write_ome_tiff(
+        p, 'CYX', n, 4, dtype='uint16', compression='zlib', pyramid='subifd', factor=2)),
+    'cyx_u16_subifd4': ('cyx_u16_subifd4.ome.tif', lambda p, n: synthetic.write_ome_tiff(
+        p, 'CYX', n, 4, dtype='uint16', pyramid='subifd', factor=4, physical_size=0.25)),
+    'cyx_u16_series2': ('cyx_u16_series2.ome.tif', lambda p, n: synthetic.write_ome_tiff(
+        p, 'CYX', n, 4, dtype='uint16', pyramid='series', factor=2)),
+    'cyx_u16_strips': ('cyx_u16_strips.ome.tif', lambda p, n: synthetic.write_ome_tiff(
+        p, 'CYX', n, 4, dtype='uint16', tile=0, pyramid='none')),
+    'yxc_u8_flat': ('yxc_u8_flat.ome.tif', lambda p, n: synthetic.write_ome_tiff(
+        p, 'YXC', n, 3, dtype='uint8', pyramid='none')),
+    'yx_f32_subifd2': ('yx_f32_subifd2.ome.tif', lambda p, n: synthetic.write_ome_tiff(
+        p, 'YX', n, dtype='float32', compression='zlib', pyramid='subifd')),
+    'cyx_u16_series_c256': ('cyx_u16_series_c256.ome.tif', lambda p, n: synthetic.write_ome_tiff(
+        p, 'CYX', n // 8, 256, dtype='uint16', compression='zlib', pyramid='series', factor=2)),
+    'czyx_u16_subifd2': ('czyx_u16_subifd2.ome.tif', lambda p, n: synthetic.write_ome_tiff(
+        p, 'CZYX', n // 2, 4, z=3, dtype='uint16', pyramid='subifd')),
+    'dapi_f32': ('dapi_f32.tif', lambda p, n: synthetic.tifffile.imwrite(
+        p, synthetic.synthetic_image((n, n), 'YX', 'float32', seed=1))),
+    'af_f32': ('af_f32.tif', lambda p, n: synthetic.tifffile.imwrite(
+        p, synthetic.synthetic_image((n, n), 'YX', 'float32', seed=2) * 0.2)),
+    'mask_u32': ('mask_u32.tif', lambda p, n: synthetic.write_label_mask(
+        p, n, cells=n * n // 2000, radius=8)),
+    'mask_empty': ('mask_empty.tif', lambda p, n: synthetic.write_label_mask(p, n, cells=0)),
+    'indica_u16': ('indica_u16.tif', lambda p, n: synthetic.write_indica_tiff(
+        p, 4, n, 256, 3)),
+    'quant_csv': ('quant.csv', lambda p, n: synthetic.write_quant_csv(
+        p, cells=n * n // 20, markers=[f'CH{c}' for c in range(20)], size=n)),
+    'markers': ('markers.csv', lambda p, n: synthetic.write_markers(p, ['CH0', 'CH2'])),
+}
+
+
+def fixture_path(workdir, name):
+    return Path(workdir) / FIXTURES[name][0]
+
+
+def prepare_fixtures(workdir, names, size):
+    for name in names:
+        path = fixture_path(workdir, name)
+        if not path.exists():
+            FIXTURES[name][1](path, size)
+
+
+def run_main(module, argv):
+    saved = sys.argv
+    sys.argv = [module.__name__ + '.py'] + [str(a) for a in argv]
+    try:
+        module.main()
+    finally:
+        sys.argv = saved
+
+
+# Case setups take (fixture paths, scratch dir) and return the zero-argument
+# callable that is timed; anything loaded by the setup is excluded from timing.
+
+def rescaler_process(fixture):
+    def setup(paths, scratch):
+        import logging
+        from ome_tiff_rescaler import OMETIFFRescaler
+        logging.disable(logging.INFO)
+        output = scratch / 'rescaled.downscaled.ome.tiff'
+        return lambda: OMETIFFRescaler(paths[fixture], output, 1.0).process()
+    return setup
+
+
+def plan_pyramid(fixture):
+    def setup(paths, scratch):
+        import logging
+        from ome_tiff_rescaler import OMETIFFRescaler
+        logging.disable(logging.INFO)
+        rescaler = OMETIFFRescaler(paths[fixture], scratch / 'unused.ome.tiff', 1.0)
+        return lambda: rescaler.plan_pyramid().close()
+    return setup
+
+
+def downsample_integer(factor):
+    def setup(paths, scratch):
+        import logging
+        import tifffile
+        from ome_tiff_rescaler import OMETIFFRescaler
+        logging.disable(logging.INFO)
+        data = tifffile.imread(paths['cyx_u16_subifd2_zlib'])
+        rescaler = OMETIFFRescaler(paths['cyx_u16_subifd2_zlib'], scratch / 'unused.ome.tiff')
+        return lambda: rescaler._downsample_integer(data, factor, 1, 2)
+    return setup
+
+
+def process_dapi(method, **options):
+    def setup(paths, scratch):
+        import tifffile
+        from otsu_thresholding import process_dapi
+        img = tifffile.imread(paths['dapi_f32'])
+        if method == 'af':
+            options['af_img'] = tifffile.imread(paths['af_f32'])
+        return lambda: process_dapi(img, method, **options)
+    return setup
+
+
+def fused_af_otsu(fixture):
+    def setup(paths, scratch):
+        from otsu_thresholding import fused_af_otsu
+        # channel 0 as DAPI, channel 1 as AF
+        return lambda: fused_af_otsu(str(paths[fixture]), 0, 1)
+    return setup
+
+
+def mask_to_boundaries(paths, scratch):
+    from render_boundaries import instance_mask_to_boundaries
+    return lambda: instance_mask_to_boundaries(paths['mask_u32'], scratch / 'boundaries.tiff')
+
+
+def compact_mask(paths, scratch):
+    from compact_mask import compact_mask
+    return lambda: compact_mask(paths['mask_u32'], scratch / 'compact_labels.tif')
+
+
+def cell_outlines(paths, scratch):
+    from cell_outlines import export_outlines
+    return lambda: export_outlines(paths['mask_u32'], str(scratch / 'outlines.geojson'), workers=1)
+
+
+def cell_outlines_empty(paths, scratch):
+    # a blank sample: compacted to a header-only bbox CSV, which the outlines must accept
+    from cell_outlines import export_outlines
+    from compact_mask import compact_mask
+    compact = scratch / 'empty_labels.tif'
+    compact_mask(paths['mask_empty'], compact)
+    return lambda: export_outlines(str(compact), str(scratch / 'empty_outlines.geojson'), workers=1)
+
+
+def aggregate_quant(paths, scratch):
+    from aggregate_quant import aggregate_quant
+    markers = [f'CH{c}' for c in range(20)]
+    return lambda: aggregate_quant(paths['quant_csv'], markers, str(scratch / 'quant_qc'))
+
+
+def save_channel_image(fixture):
+    def setup(paths, scratch):
+        from extract_image_channel import save_channel_image
+        return lambda: save_channel_image(2, str(paths[fixture]), str(scratch / 'channel.tif'))
+    return setup
+
+
+def convert_ome_tiff(paths, scratch):
+    import convert_ome_tiff
+    argv = ['-i', paths['cyx_u16_subifd2_zlib'], '-m', paths['markers'], '-o', scratch / 'converted.tif']
+    return lambda: run_main(convert_ome_tiff, argv)
+
+
+def indica_to_ome(*options):
+    def setup(paths, scratch):
+        import indicaTIFF_to_ome
+        argv = ['-i', paths['indica_u16'], '-o', scratch / 'converted.ome.tif', *options]
+        return lambda: run_main(indicaTIFF_to_ome, argv)
+    return setup
+
+
+# prints the interpreter's own peak RSS (KiB) after the import, where /proc is available
+IMPORT_PEAK = """import {module}
+try:
+    print(next(line.split()[1] for line in open('/proc/self/status') if line.startswith('VmHWM:')))
+except OSError:
+    pass
+"""
+
+
+def import_script(module):
+    # start-up plus import in a fresh interpreter, as paid by every pipeline task; the
+    # peak RSS is the child's, not this worker's
+    def setup(paths, scratch):
+        cmd = [sys.executable, '-c', IMPORT_PEAK.format(module=module)]
+
+        def run():
+            out = subprocess.run(cmd, cwd=BIN, check=True, capture_output=True, text=True).stdout.split()
+            if out:
+                run.child_peaks.append(int(out[-1]) / 2**10)
+        run.child_peaks = []
+        return run
+    return setup
+
+
+Case = namedtuple('Case', 'name fixtures setup')
+
+CASES = [
+    Case('rescaler.process/cyx-u16-subifd2-zlib', ['cyx_u16_subifd2_zlib'], rescaler_process('cyx_u16_subifd2_zlib')),
+    Case('rescaler.process/cyx-u16-subifd4', ['cyx_u16_subifd4'], rescaler_process('cyx_u16_subifd4')),
+    Case('rescaler.process/cyx-u16-series2', ['cyx_u16_series2'], rescaler_process('cyx_u16_series2')),
+    Case('rescaler.process/yxc-u8-flat', ['yxc_u8_flat'], rescaler_process('yxc_u8_flat')),
+    Case('rescaler.process/yx-f32-subifd2-zlib', ['yx_f32_subifd2'], rescaler_process('yx_f32_subifd2')),
+    Case('rescaler.process/czyx-u16-subifd2', ['czyx_u16_subifd2'], rescaler_process('czyx_u16_subifd2')),
+    Case('rescaler.plan_pyramid/cyx-u16-series-c256', ['cyx_u16_series_c256'], plan_pyramid('cyx_u16_series_c256')),
+    Case('rescaler.plan_pyramid/cyx-u16-subifd2-zlib', ['cyx_u16_subifd2_zlib'], plan_pyramid('cyx_u16_subifd2_zlib')),
+    Case('rescaler.downsample_integer/x2', ['cyx_u16_subifd2_zlib'], downsample_integer(2)),
+    Case('rescaler.downsample_integer/x4', ['cyx_u16_subifd2_zlib'], downsample_integer(4)),
+    Case('process_dapi/otsu_only', ['dapi_f32'], process_dapi('otsu_only')),
+    Case('process_dapi/mean', ['dapi_f32'], process_dapi('mean')),
+    Case('process_dapi/gaussian', ['dapi_f32'], process_dapi('gaussian', sigma=10.0)),
+    Case('process_dapi/af', ['dapi_f32', 'af_f32'], process_dapi('af')),
+    Case('fused_af_otsu/cyx-u16-subifd2-zlib', ['cyx_u16_subifd2_zlib'], fused_af_otsu('cyx_u16_subifd2_zlib')),
+    Case('instance_mask_to_boundaries', ['mask_u32'], mask_to_boundaries),
+    Case('compact_mask', ['mask_u32'], compact_mask),
+    Case('cell_outlines', ['mask_u32'], cell_outlines),
+    Case('cell_outlines/empty', ['mask_empty'], cell_outlines_empty),
+    Case('aggregate_quant', ['quant_csv'], aggregate_quant),
+    Case('save_channel_image/cyx-tiled-zlib', ['cyx_u16_subifd2_zlib'], save_channel_image('cyx_u16_subifd2_zlib')),
+    Case('save_channel_image/cyx-strips', ['cyx_u16_strips'], save_channel_image('cyx_u16_strips')),
+    Case('convert_ome_tiff.main', ['cyx_u16_subifd2_zlib', 'markers'], convert_ome_tiff),
+    Case('indicaTIFF_to_ome.main', ['indica_u16'], indica_to_ome()),
+    Case('indicaTIFF_to_ome.main/downscale', ['indica_u16'], indica_to_ome('--downscale-prefix', 'unused')),
+] + [
+    Case(f'import/{module}', [], import_script(module)) for module in (
+        'ome_tiff_rescaler', 'indicaTIFF_to_ome', 'extract_image_channel', 'convert_ome_tiff',
+        'otsu_thresholding', 'render_boundaries', 'stack_segmentation_input', 'tile_segmentation', 'compact_mask',
+        'cell_outlines', 'aggregate_quant',
+    )
+]
+
+
+def reset_peak_rss():
+    """Reset VmHWM to the current RSS (Linux), dropping the high-water mark inherited from the launcher."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mib():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+def run_case(case, workdir, repeat):
+    """Run one case in this process and return its result record."""
+    result = {'case': case.name, 'status': 'ok'}
+    with tempfile.TemporaryDirectory(dir=workdir) as scratch:
+        scratch = Path(scratch)
+        paths = {name: fixture_path(workdir, name) for name in case.fixtures}
+        try:
+            # relative outputs (e.g. --downscale-prefix) land in the scratch directory
+            os.chdir(scratch)
+            func = case.setup(paths, scratch)
+            result['setup_rss_mib'] = round(peak_rss_mib(), 1)
+            seconds = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                func()
+                seconds.append(time.perf_counter() - start)
+        except Exception as e:
+            result['status'] = 'error'
+            result['error'] = f"{type(e).__name__}: {e}"
+            result['traceback'] = traceback.format_exc()
+            return result
+        finally:
+            os.chdir(workdir)
+
+    result['seconds'] = [round(s, 4) for s in seconds]
+    result['best_seconds'] = round(min(seconds), 4)
+    result['median_seconds'] = round(statistics.median(seconds), 4)
+    child_peaks = getattr(func, 'child_peaks', None)
+    result['peak_rss_mib'] = round(max(child_peaks) if child_peaks else peak_rss_mib(), 1)
+    return result
+
+
+def spawn_case(case, workdir, size, repeat, verbose):
+    """Run a case in a fresh interpreter and return its result record."""
+    with tempfile.NamedTemporaryFile('r', suffix='.json', dir=workdir) as out:
+        cmd = [
+            sys.executable, __file__, '--worker', case.name, '--workdir', str(workdir),
+            '--size', str(size), '--repeat', str(repeat), '-o', out.name,
+        ]
+        proc = subprocess.run(cmd, stdout=None if verbose else subprocess.DEVNULL,
+                              stderr=None if verbose else subprocess.PIPE, text=True)
+        try:
+            return json.load(out)
+        except ValueError:
+            return {'case': case.name, 'status': 'error',
+                    'error': f"worker exited with {proc.returncode}", 'traceback': proc.stderr or ''}
+
+
+def spawn_prepare(workdir, names, size):
+    """Generate the fixtures in a child process, so that this launcher stays small."""
+    cmd = [sys.executable, __file__, '--prepare', *names, '--workdir', str(workdir), '--size', str(size)]
+    subprocess.run(cmd, check=True)
+
+
+def environment():
+    packages = {}
+    for name in ('numpy', 'tifffile', 'scikit-image', 'pandas', 'matplotlib', 'imagecodecs'):
+        try:
+            packages[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            packages[name] = None
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'host': platform.node(),
+        'git_commit': commit,
+        'packages': packages,
+    }
+
+
+def compare(results, baseline, tolerance, noise_floor):
+    """Print per-case ratios against a baseline run and return the names of regressed cases."""
+    previous = {r['case']: r for r in baseline['results']}
+    regressed = []
+    print(f"\n{'case':<45} {'time':>8} {'peak rss':>9}")
+    for result in results:
+        before = previous.get(result['case'])
+        if before is None or before['status'] != 'ok':
+            continue
+        if result['status'] != 'ok':
+            print(f"{result['case']:<45} {'FAILED':>8}")
+            regressed.append(result['case'])
+            continue
+        time_ratio = result['best_seconds'] / max(before['best_seconds'], 1e-9)
+        rss_ratio = result['peak_rss_mib'] / max(before['peak_rss_mib'], 1e-9)
+        slower = (time_ratio > 1 + tolerance
+                  and result['best_seconds'] - before['best_seconds'] > noise_floor)
+        flag = slower or rss_ratio > 1 + tolerance
+        if flag:
+            regressed.append(result['case'])
+        print(f"{result['case']:<45} {time_ratio:7.2f}x {rss_ratio:8.2f}x{'  REGRESSION' if flag else ''}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bin/ hot paths on synthetic inputs")
+    parser.add_argument('-o', '--output', type=Path, default=None, help='Result JSON file')
+    parser.add_argument('-k', '--cases', action='append', default=None,
+                        help='Only run cases matching this glob (repeatable), e.g. "process_dapi/*"')
+    parser.add_argument('--size', type=int, default=2048, help='Base image width/height in pixels')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed repeats per case')
+    parser.add_argument('--workdir', type=Path, default=None,
+                        help='Directory for synthetic inputs, reused between runs (default: temporary)')
+    parser.add_argument('--compare', type=Path, default=None, help='Baseline result JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed relative increase in time or peak RSS before a case is a regression')
+    parser.add_argument('--noise-floor', type=float, default=0.05,
+                        help='Ignore slowdowns smaller than this many seconds, whatever the ratio')
+    parser.add_argument('--list', action='store_true', help='List cases and exit')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show the output of each case')
+    parser.add_argument('--worker', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--prepare', nargs='+', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.prepare:
+        prepare_fixtures(args.workdir.resolve(), args.prepare, args.size)
+        return
+
+    cases = [c for c in CASES if not args.cases or any(fnmatch.fnmatch(c.name, k) for k in args.cases)]
+    if args.list:
+        print('\n'.join(c.name for c in cases))
+        return
+    if args.output is None:
+        parser.error("the following arguments are required: -o/--output")
+
+    if args.worker:
+        reset_peak_rss()
+        case = next(c for c in CASES if c.name == args.worker)
+        args.output.write_text(json.dumps(run_case(case, args.workdir.resolve(), args.repeat)))
+        return
+
+    tmp = None
+    if args.workdir is None:
+        tmp = tempfile.TemporaryDirectory()
+        args.workdir = Path(tmp.name)
+    workdir = args.workdir.resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    try:
+        names = sorted({name for case in cases for name in case.fixtures})
+        print(f"Preparing {len(names)} synthetic inputs in {workdir}")
+        if names:
+            spawn_prepare(workdir, names, args.size)
+
+        results = []
+        for case in cases:
+            result = spawn_case(case, workdir, args.size, args.repeat, args.verbose)
+            results.append(result)
+            if result['status'] == 'ok':
+                print(f"{case.name:<45} {result['best_seconds']:8.3f} s {result['peak_rss_mib']:8.1f} MiB")
+            else:
+                print(f"{case.name:<45} ERROR {result['error']}")
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+    report = {
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'environment': environment(),
+        'options': {'size': args.size, 'repeat': args.repeat},
+        'results': results,
+    }
+    args.output.write_text(json.dumps(report, indent=2) + '\n')
+    print(f"Saved results to {args.output}")
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        if baseline.get('options') != report['options']:
+            print(f"Warning: baseline options {baseline.get('options')} differ from {report['options']}")
+        regressed = compare(results, baseline, args.tolerance, args.noise_floor)
+        if regressed:
+            print(f"{len(regressed)} case(s) regressed beyond {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""
+Synthetic inputs for the benchmarks in this directory.
+
+Writes OME-TIFFs with a chosen axes order (YX, YXC, CYX, CZYX), dtype,
+channel count, tile size, compression and pyramid layout (none, SubIFD
+levels or one series per level, at 2x or 4x per level), HALO/Indica-style
+fused TIFFs and instance label masks. Pixel content is a smooth pattern
+with noise, so compression ratios are closer to real tissue than random
+data would give.
+"""
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import tifffile
+
+AXES = ('YX', 'YXC', 'CYX', 'CZYX')
+PYRAMIDS = ('none', 'subifd', 'series')
+
+
+def image_shape(axes, size, channels=4, z=1):
+    """Array shape for axes, with a square size x size plane."""
+    lengths = {'Y': size, 'X': size, 'C': channels, 'Z': z}
+    return tuple(lengths[a] for a in axes)
+
+
+def synthetic_image(shape, axes, dtype='uint16', seed=0):
+    """Smooth per-plane pattern plus noise, scaled to the range of dtype."""
+    rng = np.random.default_rng(seed)
+    dtype = np.dtype(dtype)
+    y_idx, x_idx = axes.index('Y'), axes.index('X')
+    ny, nx = shape[y_idx], shape[x_idx]
+
+    # low-frequency separable pattern, different phase per plane
+    planes = int(np.prod(shape)) // (ny * nx)
+    yy = np.linspace(0, 6 * np.pi, ny, dtype=np.float32)[:, None]
+    xx = np.linspace(0, 6 * np.pi, nx, dtype=np.float32)[None, :]
+    data = np.empty((planes, ny, nx), dtype=np.float32)
+    for p in range(planes):
+        phase = rng.uniform(0, 2 * np.pi)
+        data[p] = np.sin(yy + phase) * np.cos(xx - phase)
+        data[p] += rng.normal(0, 0.15, (ny, nx)).astype(np.float32)
+    data = (data - data.min()) / (data.max() - data.min())
+
+    if np.issubdtype(dtype, np.integer):
+        data = np.round(data * min(np.iinfo(dtype).max, 4095)).astype(dtype)
+    else:
+        data = data.astype(dtype)
+
+    # planes were generated in (other axes..., Y, X) order
+    other = [a for a in axes if a not in 'YX']
+    data = data.reshape(tuple(shape[axes.index(a)] for a in other) + (ny, nx))
+    return np.transpose(data, [(other + ['Y', 'X']).index(a) for a in axes])
+
+
+def downsample(data, axes, factor):
+    """Strided downsample of the Y and X axes."""
+    index = [slice(None)] * data.ndim
+    index[axes.index('Y')] = slice(None, None, factor)
+    index[axes.index('X')] = slice(None, None, factor)
+    return np.ascontiguousarray(data[tuple(index)])
+
+
+def write_ome_tiff(
+    path,
+    axes='CYX',
+    size=2048,
+    channels=4,
+    z=1,
+    dtype='uint16',
+    tile=256,
+    compression=None,
+    pyramid='subifd',
+    levels=3,
+    factor=2,
+    physical_size=0.5,
+    seed=0,
+):
+    """
+    Write a synthetic OME-TIFF and return its path.
+    pyramid: 'none' (single level), 'subifd' (reduced levels as SubIFDs of the
+    base pages) or 'series' (one OME image per level).
+    """
+    if axes not in AXES:
+        raise ValueError(f"Unsupported axes {axes}, expected one of {AXES}")
+    if pyramid not in PYRAMIDS:
+        raise ValueError(f"Unsupported pyramid layout {pyramid}, expected one of {PYRAMIDS}")
+
+    data = synthetic_image(image_shape(axes, size, channels, z), axes, dtype, seed)
+    levels = 1 if pyramid == 'none' else levels
+    tiles = (tile, tile) if tile else None
+    resolution = (1e4 / physical_size, 1e4 / physical_size)
+
+    def metadata(level):
+        mpp = physical_size * factor ** level
+        meta = {
+            'axes': axes,
+            'PhysicalSizeX': mpp,
+            'PhysicalSizeXUnit': 'µm',
+            'PhysicalSizeY': mpp,
+            'PhysicalSizeYUnit': 'µm',
+        }
+        if 'C' in axes:
+            meta['Channel'] = {'Name': [f'CH{c}' for c in range(channels)]}
+        return meta
+
+    options = dict(
+        photometric='minisblack',
+        planarconfig='contig' if axes == 'YXC' else None,
+        tile=tiles,
+        compression=compression,
+        resolutionunit='CENTIMETER',
+    )
+    bigtiff = data.nbytes > 2**31
+    with tifffile.TiffWriter(path, bigtiff=bigtiff, ome=True) as tw:
+        if pyramid == 'subifd':
+            tw.write(data, subifds=levels - 1, metadata=metadata(0), resolution=resolution, **options)
+            for level in range(1, levels):
+                scale = factor ** level
+                tw.write(
+                    downsample(data, axes, scale), subfiletype=1, metadata=None,
+                    resolution=(resolution[0] / scale, resolution[1] / scale), **options,
+                )
+        else:
+            for level in range(levels):
+                scale = factor ** level
+                tw.write(
+                    downsample(data, axes, scale), metadata=metadata(level),
+                    resolution=(resolution[0] / scale, resolution[1] / scale), **options,
+                )
+    return Path(path)
+
+
+def write_indica_tiff(path, channels=4, size=4096, tile=256, levels=3, compression='zlib', seed=0):
+    """
+    Write a tiled multi-channel pyramid with an Indica-style XML description.
+    Returns the total number of tile bytes in the file.
+    """
+    data = synthetic_image((channels, size, size), 'CYX', 'uint16', seed)
+    xml = '<root>' + ''.join(f'<channel name="CH{i}"/>' for i in range(channels)) + '</root>'
+    with tifffile.TiffWriter(path, bigtiff=True) as tw:
+        tw.write(
+            data, tile=(tile, tile), subifds=levels - 1, photometric='minisblack',
+            compression=compression, description=xml, metadata=None,
+            resolution=(20000.0, 20000.0), resolutionunit='CENTIMETER',
+        )
+        for level in range(1, levels):
+            factor = 2 ** level
+            tw.write(
+                data[:, ::factor, ::factor], tile=(tile, tile), subfiletype=1,
+                photometric='minisblack', compression=compression, metadata=None,
+            )
+    with tifffile.TiffFile(path) as tif:
+        return sum(sum(page.databytecounts) for page in tif.pages)
+
+
+def label_mask(size, cells=2000, radius=8, dtype='uint32', seed=0):
+    """Instance mask of non-overlapping-ish disks labelled 1..cells (later cells win)."""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((size, size), dtype=dtype)
+    offsets = np.arange(-radius, radius + 1)
+    disk = offsets[:, None] ** 2 + offsets[None, :] ** 2 <= radius ** 2
+    centres = rng.integers(radius, size - radius, size=(cells, 2))
+    for label, (y, x) in enumerate(centres, start=1):
+        window = mask[y - radius:y + radius + 1, x - radius:x + radius + 1]
+        window[disk] = label
+    return mask
+
+
+def write_label_mask(path, size=2048, cells=2000, radius=8, dtype='uint32', seed=0):
+    tifffile.imwrite(path, label_mask(size, cells, radius, dtype, seed))
+    return Path(path)
+
+
+def write_quant_csv(path, cells=100_000, markers=('CH0', 'CH1', 'CH2', 'CH3'), size=8192, seed=0):
+    """MCQUANT-style cell-by-feature CSV: CellID, one mean intensity per marker, then morphology."""
+    rng = np.random.default_rng(seed)
+    area = rng.lognormal(4.5, 0.5, cells)
+    major = np.sqrt(area / np.pi) * rng.uniform(1.0, 1.8, cells)
+    minor = area / (np.pi * major)
+    columns = {'CellID': np.arange(1, cells + 1)}
+    for i, name in enumerate(markers):
+        columns[name] = rng.lognormal(5 + i % 3, 0.8, cells) * (rng.random(cells) < 0.7 + 0.1 * (i % 3))
+    columns.update({
+        'X_centroid': rng.uniform(0, size, cells),
+        'Y_centroid': rng.uniform(0, size, cells),
+        'Area': np.round(area),
+        'MajorAxisLength': major,
+        'MinorAxisLength': minor,
+        'Eccentricity': np.sqrt(1 - (minor / major) ** 2),
+        'Solidity': rng.uniform(0.8, 1.0, cells),
+        'Extent': rng.uniform(0.6, 0.9, cells),
+        'Orientation': rng.uniform(-np.pi / 2, np.pi / 2, cells),
+    })
+    with open(path, 'w') as f:
+        f.write(','.join(columns) + '\n')
+        np.savetxt(f, np.column_stack(list(columns.values())), delimiter=',', fmt='%.10g')
+    return Path(path)
+
+
+def write_markers(path, names):
+    Path(path).write_text('marker_name\n' + ''.join(f'{name}\n' for name in names))
+    return Path(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic benchmark inputs")
+    sub = parser.add_subparsers(dest='kind', required=True)
+
+    ome = sub.add_parser('ome', help='Synthetic OME-TIFF')
+    ome.add_argument('output', type=Path)
+    ome.add_argument('--axes', choices=AXES, default='CYX')
+    ome.add_argument('--size', type=int, default=2048, help='Base level width/height in pixels')
+    ome.add_argument('--channels', type=int, default=4)
+    ome.add_argument('--z', type=int, default=1, help='Z planes (CZYX only)')
+    ome.add_argument('--dtype', default='uint16')
+    ome.add_argument('--tile', type=int, default=256, help='Tile size, 0 for strips')
+    ome.add_argument('--compression', default=None, help='e.g. zlib (default: none)')
+    ome.add_argument('--pyramid', choices=PYRAMIDS, default='subifd')
+    ome.add_argument('--levels', type=int, default=3)
+    ome.add_argument('--factor', type=int, choices=[2, 4], default=2)
+    ome.add_argument('--physical-size', type=float, default=0.5, help='Base level µm/pixel')
+
+    indica = sub.add_parser('indica', help='Synthetic HALO/Indica fused TIFF')
+    indica.add_argument('output', type=Path)
+    indica.add_argument('--size', type=int, default=4096)
+    indica.add_argument('--channels', type=int, default=4)
+    indica.add_argument('--tile', type=int, default=256)
+    indica.add_argument('--levels', type=int, default=3)
+
+    mask = sub.add_parser('mask', help='Synthetic instance label mask')
+    mask.add_argument('output', type=Path)
+    mask.add_argument('--size', type=int, default=2048)
+    mask.add_argument('--cells', type=int, default=2000)
+    mask.add_argument('--radius', type=int, default=8)
+    mask.add_argument('--dtype', default='uint32')
+
+    quant = sub.add_parser('quant', help='Synthetic MCQUANT cell-by-feature CSV')
+    quant.add_argument('output', type=Path)
+    quant.add_argument('--cells', type=int, default=100_000)
+    quant.add_argument('--markers', type=int, default=4)
+    quant.add_argument('--size', type=int, default=8192, help='Image width/height the centroids fall in')
+
+    args = parser.parse_args()
+    if args.kind == 'ome':
+        write_ome_tiff(
+            args.output, args.axes, args.size, args.channels, args.z, args.dtype, args.tile,
+            args.compression, args.pyramid, args.levels, args.factor, args.physical_size,
+        )
+    elif args.kind == 'indica':
+        write_indica_tiff(args.output, args.channels, args.size, args.tile, args.levels)
+    elif args.kind == 'quant':
+        write_quant_csv(args.output, args.cells, [f'CH{c}' for c in range(args.markers)], args.size)
+    else:
+        write_label_mask(args.output, args.size, args.cells, args.radius, args.dtype)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
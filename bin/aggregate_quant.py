@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+
+# Version: 0.0.1
+# Reduces the MCQUANT cell-by-feature CSV to the small bundle of tables QCreport.Rmd
+# plots from, so that the report no longer loads every cell into R. The CSV is streamed in
+# chunks: per-marker (raw and CLR) and morphology moments, histograms and quantiles, the
+# marker correlation matrix and cell counts per spatial tile are accumulated exactly or
+# to within one histogram bin, and a random pool of twice the sample size is kept, from
+# which each tile gets its proportional share of the stratified cell sample at the end.
+
+import argparse
+import csv
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterator, List, Sequence, Tuple
+import numpy as np
+import perf
+
+DEFAULT_CHUNK = 100_000
+DEFAULT_SAMPLE = 50_000
+# side of the spatial tiles the sample is stratified over and cells are counted in, in pixels
+DEFAULT_STRATUM = 512
+# bins per feature in histograms.csv; quantiles come from the finer bins below
+DEFAULT_BINS = 200
+MORPHOLOGY = ('Area', 'MajorAxisLength', 'MinorAxisLength', 'Eccentricity', 'Solidity', 'Extent', 'Orientation')
+CENTROID = ('Y_centroid', 'X_centroid')
+# bin widths, on log1p(value) for the intensities and sizes, on the value for the rest
+LOG_WIDTH = 0.005
+CLR_WIDTH = 0.01
+SHAPE_WIDTH = 0.001
+LOG_FEATURES = ('Area', 'MajorAxisLength', 'MinorAxisLength')
+# rows whose marker intensities sum to more than this are dropped, as by QCreport.Rmd before
+OUTLIER_SUM = 1e30
+MAX_OUTLIER_ROWS = 1000
+PROBS = np.r_[0.001, 0.005, np.arange(1, 100) / 100, 0.995, 0.999]
+
+
+class Histogram:
+    """
+    Counts in fixed-width bins that grow to cover the values added, so no range is needed
+    up front; log histograms bin sign(x) * log1p(|x|).
+    """
+
+    def __init__(self, width: float, log: bool = False):
+        self.width = width
+        self.log = log
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.min = np.inf
+        self.max = -np.inf
+
+    def _forward(self, values: np.ndarray) -> np.ndarray:
+        return np.sign(values) * np.log1p(np.abs(values)) if self.log else values
+
+    def _inverse(self, values: np.ndarray) -> np.ndarray:
+        return np.sign(values) * np.expm1(np.abs(values)) if self.log else values
+
+    def add(self, values: np.ndarray):
+        if not len(values):
+            return
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        index = np.floor(self._forward(values) / self.width).astype(np.int64)
+        lo, hi = int(index.min()), int(index.max()) + 1
+        if not len(self.counts):
+            self.offset, self.counts = lo, np.zeros(hi - lo, dtype=np.int64)
+        elif lo < self.offset or hi > self.offset + len(self.counts):
+            start = min(lo, self.offset)
+            counts = np.zeros(max(hi, self.offset + len(self.counts)) - start, dtype=np.int64)
+            counts[self.offset - start:self.offset - start + len(self.counts)] = self.counts
+            self.offset, self.counts = start, counts
+        self.counts += np.bincount(index - self.offset, minlength=len(self.counts))
+
+    def edges(self, step: int = 1) -> np.ndarray:
+        bins = np.arange(0, len(self.counts) + step, step)
+        return self._inverse((self.offset + np.minimum(bins, len(self.counts))) * self.width)
+
+    def quantiles(self, probs: Sequence[float]) -> np.ndarray:
+        """Quantiles interpolated within their bin, clipped to the observed range."""
+        if not len(self.counts):
+            return np.full(len(probs), np.nan)
+        cumulative = np.cumsum(self.counts)
+        target = np.asarray(probs) * cumulative[-1]
+        index = np.minimum(np.searchsorted(cumulative, target), len(cumulative) - 1)
+        before = cumulative[index] - self.counts[index]
+        fraction = (target - before) / np.maximum(self.counts[index], 1)
+        values = self._inverse((self.offset + index + fraction) * self.width)
+        return np.clip(values, self.min, self.max)
+
+    def coarse(self, bins: int) -> Tuple[np.ndarray, np.ndarray]:
+        """(edges, counts) with adjacent bins merged down to at most bins."""
+        step = max(1, -(-len(self.counts) // bins))
+        padded = np.zeros(-(-len(self.counts) // step) * step, dtype=np.int64)
+        padded[:len(self.counts)] = self.counts
+        return self.edges(step), padded.reshape(-1, step).sum(axis=1)
+
+
+class Moments:
+    """Count, mean and sum of squared deviations per column (and across columns if cross), merged per chunk."""
+
+    def __init__(self, columns: int, cross: bool = False):
+        self.cross = cross
+        self.n = 0
+        self.mean = np.zeros(columns)
+        self.m2 = np.zeros((columns, columns) if cross else columns)
+
+    def add(self, values: np.ndarray):
+        n = len(values)
+        if not n:
+            return
+        mean = values.mean(axis=0)
+        centred = values - mean
+        m2 = centred.T @ centred if self.cross else np.einsum('ij,ij->j', centred, centred)
+        delta = mean - self.mean
+        total = self.n + n
+        # Chan et al.'s pairwise update, stable however many chunks are merged
+        correction = np.outer(delta, delta) if self.cross else delta ** 2
+        self.m2 += m2 + correction * (self.n * n / total)
+        self.mean += delta * (n / total)
+        self.n = total
+
+    @property
+    def sd(self) -> np.ndarray:
+        m2 = np.diag(self.m2) if self.cross else self.m2
+        return np.sqrt(m2 / (self.n - 1)) if self.n > 1 else np.full(len(self.mean), np.nan)
+
+    def correlation(self) -> np.ndarray:
+        scale = np.sqrt(np.diag(self.m2))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.m2 / np.outer(scale, scale)
+
+
+class SamplePool:
+    """The rows with the smallest random keys seen so far, i.e. a uniform sample of at most size rows."""
+
+    def __init__(self, size: int, columns: int, seed: int = 0):
+        self.size = size
+        self.rng = np.random.default_rng(seed)
+        self.keys = np.zeros(0)
+        self.rows = np.zeros((0, columns))
+        self.strata = np.zeros(0, dtype=np.int64)
+
+    def add(self, rows: np.ndarray, strata: np.ndarray):
+        keys = self.rng.random(len(rows))
+        if len(self.keys) >= self.size:
+            # only rows that beat the current largest key can enter
+            keep = keys < self.keys.max()
+            keys, rows, strata = keys[keep], rows[keep], strata[keep]
+        self.keys = np.concatenate([self.keys, keys])
+        self.rows = np.concatenate([self.rows, rows])
+        self.strata = np.concatenate([self.strata, strata])
+        if len(self.keys) > self.size:
+            keep = np.argpartition(self.keys, self.size - 1)[:self.size]
+            self.keys, self.rows, self.strata = self.keys[keep], self.rows[keep], self.strata[keep]
+
+
+def proportional_quotas(counts: np.ndarray, size: int) -> np.ndarray:
+    """Split size over strata in proportion to counts, by largest remainder."""
+    exact = counts * (size / counts.sum())
+    quotas = np.floor(exact).astype(np.int64)
+    remainder = size - int(quotas.sum())
+    if remainder > 0:
+        quotas[np.argsort(quotas - exact, kind='stable')[:remainder]] += 1
+    return quotas
+
+
+def stratified_sample(pool: SamplePool, tile_keys: np.ndarray, tile_counts: np.ndarray, size: int) -> np.ndarray:
+    """
+    Indices into the pool of a sample of size rows where each stratum gets its share of
+    size by its cell count; strata short of their share are topped up with the lowest keys.
+    """
+    if len(pool.keys) <= size:
+        return np.argsort(pool.keys)
+    quotas = proportional_quotas(tile_counts, size)[np.searchsorted(tile_keys, pool.strata)]
+    order = np.lexsort((pool.keys, pool.strata))
+    strata = pool.strata[order]
+    first = np.flatnonzero(np.r_[True, strata[1:] != strata[:-1]])
+    rank = np.arange(len(order)) - np.repeat(first, np.diff(np.r_[first, len(order)]))
+    chosen = np.zeros(len(order), dtype=bool)
+    chosen[order[rank < quotas[order]]] = True
+    missing = size - int(chosen.sum())
+    if missing > 0:
+        rest = np.flatnonzero(~chosen)
+        chosen[rest[np.argsort(pool.keys[rest])[:missing]]] = True
+    selected = np.flatnonzero(chosen)
+    return selected[np.argsort(pool.keys[selected])]
+
+
+def parse_rows(lines: List[str], columns: int) -> np.ndarray:
+    try:
+        return np.loadtxt(lines, delimiter=',', dtype=np.float64, ndmin=2)
+    except ValueError:
+        # empty fields (missing values) are not accepted by loadtxt
+        return np.array([[float(v) if v.strip() else np.nan for v in line.split(',')]
+                         for line in lines if line.strip()], dtype=np.float64).reshape(-1, columns)
+
+
+def read_chunks(path: str, chunk: int) -> Tuple[List[str], Iterator[np.ndarray]]:
+    """Header and an iterator over row chunks of a numeric CSV."""
+    f = open(path, newline='')
+    header = next(csv.reader([f.readline()]))
+
+    def chunks():
+        with f:
+            while True:
+                lines = list(islice(f, chunk))
+                if not lines:
+                    return
+                yield parse_rows(lines, len(header))
+
+    return header, chunks()
+
+
+def read_markers(path: str) -> List[str]:
+    with open(path, newline='') as f:
+        return [row['marker_name'].strip() for row in csv.DictReader(f)]
+
+
+def write_table(path: Path, header: Sequence[str], rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def write_rows(path: Path, header: Sequence[str], rows: np.ndarray):
+    with open(path, 'w') as f:
+        f.write(','.join(header) + '\n')
+        np.savetxt(f, rows, delimiter=',', fmt='%.10g')
+
+
+def aggregate_quant(
+    csv_path: str,
+    markers: List[str],
+    output: str,
+    sample: int = DEFAULT_SAMPLE,
+    stratum: int = DEFAULT_STRATUM,
+    bins: int = DEFAULT_BINS,
+    chunk: int = DEFAULT_CHUNK,
+    seed: int = 0,
+) -> Dict:
+    """Write the QC bundle of csv_path to the directory output; returns the summary counts."""
+    header, chunks = read_chunks(csv_path, chunk)
+    missing = [m for m in markers if m not in header]
+    markers = [m for m in markers if m in header]
+    if not markers:
+        raise ValueError(f"None of the markers are columns of {csv_path}")
+    morphology = [m for m in MORPHOLOGY if m in header]
+    marker_index = [header.index(m) for m in markers]
+    morphology_index = [header.index(m) for m in morphology]
+    centroid_index = [header.index(c) for c in CENTROID] if all(c in header for c in CENTROID) else None
+
+    raw, clr, shape = Moments(len(markers), cross=True), Moments(len(markers)), Moments(len(morphology))
+    histograms = {
+        ('marker', 'raw'): [Histogram(LOG_WIDTH, log=True) for _ in markers],
+        ('marker', 'clr'): [Histogram(CLR_WIDTH) for _ in markers],
+        ('morphology', 'raw'): [Histogram(LOG_WIDTH, log=True) if m in LOG_FEATURES else Histogram(SHAPE_WIDTH)
+                                for m in morphology],
+    }
+    pool = SamplePool(2 * sample, len(header), seed)
+    tiles: Dict[int, int] = {}
+    outliers = []
+    counts = {'cells_read': 0, 'cells_nonfinite': 0, 'cells_outlier': 0}
+
+    with perf.phase('aggregate'):
+        for rows in chunks:
+            counts['cells_read'] += len(rows)
+            finite = np.isfinite(rows).all(axis=1)
+            counts['cells_nonfinite'] += int((~finite).sum())
+            rows = rows[finite]
+            outlier = rows[:, marker_index].sum(axis=1) > OUTLIER_SUM
+            if outlier.any():
+                counts['cells_outlier'] += int(outlier.sum())
+                outliers.extend(rows[outlier][:MAX_OUTLIER_ROWS - len(outliers)])
+                rows = rows[~outlier]
+
+            values = rows[:, marker_index]
+            logged = np.log1p(np.maximum(values, 0))
+            clr_values = logged - logged.mean(axis=1, keepdims=True)
+            raw.add(values)
+            clr.add(clr_values)
+            shape.add(rows[:, morphology_index])
+            for group, data in ((('marker', 'raw'), values), (('marker', 'clr'), clr_values),
+                                (('morphology', 'raw'), rows[:, morphology_index])):
+                for i, histogram in enumerate(histograms[group]):
+                    histogram.add(data[:, i])
+
+            if centroid_index is None:
+                strata = np.zeros(len(rows), dtype=np.int64)
+            else:
+                ty, tx = (np.floor(rows[:, i] / stratum).astype(np.int64) for i in centroid_index)
+                strata = (ty << 32) + tx
+            for key, n in zip(*np.unique(strata, return_counts=True)):
+                tiles[int(key)] = tiles.get(int(key), 0) + int(n)
+            pool.add(rows, strata)
+        perf.add('cells', counts['cells_read'])
+
+    with perf.phase('write'):
+        out = Path(output)
+        out.mkdir(parents=True, exist_ok=True)
+        tile_keys = np.array(sorted(tiles), dtype=np.int64)
+        tile_counts = np.array([tiles[k] for k in tile_keys], dtype=np.int64)
+        selected = stratified_sample(pool, tile_keys, tile_counts, sample) if len(tile_keys) else []
+        counts['cells'] = raw.n
+        counts['sample_cells'] = len(selected)
+
+        names = {'marker': markers, 'morphology': morphology}
+        moments = {('marker', 'raw'): raw, ('marker', 'clr'): clr, ('morphology', 'raw'): shape}
+        feature_rows, quantile_rows, histogram_rows = [], [], []
+        for (kind, transform), group in histograms.items():
+            stats = moments[(kind, transform)]
+            for i, (name, histogram) in enumerate(zip(names[kind], group)):
+                q25, median, q75 = histogram.quantiles([0.25, 0.5, 0.75])
+                feature_rows.append([name, kind, transform, stats.n, stats.mean[i], stats.sd[i],
+                                     histogram.min, q25, median, q75, histogram.max])
+                quantile_rows += [[name, kind, transform, p, v] for p, v in zip(PROBS, histogram.quantiles(PROBS))]
+                edges, binned = histogram.coarse(bins)
+                widths = np.diff(edges)
+                density = binned / (max(stats.n, 1) * np.where(widths > 0, widths, 1))
+                histogram_rows += [[name, kind, transform, lo, hi, c, d]
+                                   for lo, hi, c, d in zip(edges[:-1], edges[1:], binned, density)]
+
+        write_table(out / 'features.csv',
+                    ['feature', 'kind', 'transform', 'n', 'mean', 'sd', 'min', 'q25', 'median', 'q75', 'max'],
+                    feature_rows)
+        write_table(out / 'quantiles.csv', ['feature', 'kind', 'transform', 'prob', 'value'], quantile_rows)
+        write_table(out / 'histograms.csv', ['feature', 'kind', 'transform', 'lower', 'upper', 'count', 'density'],
+                    histogram_rows)
+        write_table(out / 'correlation.csv', ['marker'] + markers,
+                    [[m] + list(row) for m, row in zip(markers, raw.correlation())])
+        write_table(out / 'tiles.csv', ['tile_y', 'tile_x', 'cells'],
+                    [[int(k >> 32), int(k & 0xFFFFFFFF), int(n)] for k, n in zip(tile_keys, tile_counts)])
+        write_rows(out / 'sample.csv', header, pool.rows[selected] if len(selected) else np.zeros((0, len(header))))
+        write_rows(out / 'outliers.csv', header, np.array(outliers).reshape(-1, len(header)))
+        summary = dict(counts, stratum_px=stratum, markers=';'.join(markers), markers_missing=';'.join(missing))
+        write_table(out / 'summary.csv', ['name', 'value'], summary.items())
+
+    print(f"{csv_path}: {counts['cells_read']} rows, {counts['cells']} cells summarised "
+          f"({counts['cells_nonfinite']} with missing values, {counts['cells_outlier']} outliers dropped), "
+          f"{counts['sample_cells']} sampled from {len(tile_keys)} tiles")
+    print(f"Saved QC bundle to {output}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream an MCQUANT cell-by-feature CSV into the summary tables of the QC report.")
+    parser.add_argument("-i", "--input", type=str, required=True, help="MCQUANT cell-by-feature CSV")
+    parser.add_argument("-m", "--markers", type=str, required=True, help="Marker file with a marker_name column")
+    parser.add_argument("-o", "--output", type=str, required=True, help="Output directory for the bundle")
+    parser.add_argument("--sample", type=int, default=DEFAULT_SAMPLE,
+                        help=f"Cells in the stratified sample used for clustering (default: {DEFAULT_SAMPLE})")
+    parser.add_argument("--stratum", type=int, default=DEFAULT_STRATUM,
+                        help=f"Size of the spatial tiles the sample is stratified over, in pixels (default: {DEFAULT_STRATUM})")
+    parser.add_argument("--bins", type=int, default=DEFAULT_BINS, help=f"Histogram bins per feature (default: {DEFAULT_BINS})")
+    parser.add_argument("--chunk", type=int, default=DEFAULT_CHUNK, help=f"Rows read at a time (default: {DEFAULT_CHUNK})")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the cell sample (default: 0)")
+    perf.add_argument(parser)
+    args = parser.parse_args()
+    perf.enable(args.perf)
+
+    aggregate_quant(args.input, read_markers(args.markers), args.output, args.sample, args.stratum,
+                    args.bins, args.chunk, args.seed)
+    perf.write(args.output)
+
+
+if __name__ == "__main__":
+    main()
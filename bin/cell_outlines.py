@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+
+# Version: 0.0.1
+# Exports the cells of a segmentation label mask as vector outlines (GeoJSON polygons),
+# which load in QuPath as objects and are far smaller than raster boundary overlays.
+# Cells are grouped by the mask tile holding the top-left corner of their bounding box
+# (from the compact_mask.py CSV, or one streamed scan); each tile reads only the region
+# covering its cells, so a cell crossing a tile edge is traced whole, exactly once, and
+# memory is bounded by the tile size plus the largest cell. Tiles are traced in parallel
+# and written in order, as a GeoJSON FeatureCollection or gzipped newline-delimited
+# GeoJSON (GeoJSONSeq), in micrometers from the OME PhysicalSize. Outlines follow the pixel
+# edges, so an unsimplified outline encloses exactly the cell's pixels.
+
+import argparse
+import gzip
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
+from compact_mask import LabelMask, bbox_path, scan_boxes
+import perf
+
+DEFAULT_TILE = 1024
+DEFAULT_TOLERANCE = 0.75
+# tiles in flight per worker, bounding the outlines held before they are written
+TILES_PER_WORKER = 2
+
+# region reader of a worker process, see _init_worker
+_mask = None
+
+
+def pixel_size(image: str) -> Tuple[float, float]:
+    """(PhysicalSizeX, PhysicalSizeY) in µm of an OME-TIFF or OME-Zarr image."""
+    from ngff_store import OMEZarrImage, is_zarr
+
+    if is_zarr(image):
+        size_x, size_y = OMEZarrImage(image).physical_size
+    else:
+        import tifffile
+        from ome_tiff_rescaler import OMETIFFRescaler
+
+        with tifffile.TiffFile(image) as tif:
+            size_x, size_y = OMETIFFRescaler(image, image).extract_physical_size(tif)
+    if size_x is None or size_y is None:
+        raise ValueError(f"No PhysicalSizeX/Y in {image}, pass --pixel-size or --pixel-units")
+    return size_x, size_y
+
+
+def crop_offset(metadata: str) -> Tuple[int, int]:
+    """(y, x) of the tissue crop in the uncropped image, from a <prefix>.downscaled.ome.json."""
+    with open(metadata) as f:
+        crop = json.load(f).get('tissue_crop')
+    return (crop['output_offset_y'], crop['output_offset_x']) if crop else (0, 0)
+
+
+def simplify(ring: np.ndarray, tolerance: float) -> np.ndarray:
+    """Douglas-Peucker simplification of a closed ring, keeping its first (= last) point."""
+    keep = np.zeros(len(ring), dtype=bool)
+    keep[[0, -1]] = True
+    # the closing segment is degenerate, so split the ring at its farthest point first
+    far = int(np.argmax(np.sum((ring - ring[0]) ** 2, axis=1)))
+    keep[far] = True
+    stack = [(0, far), (far, len(ring) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        points = ring[start + 1:end] - ring[start]
+        dy, dx = ring[end] - ring[start]
+        # distance to the chord, scaled by the chord length
+        distance = np.abs(dy * points[:, 1] - dx * points[:, 0])
+        i = int(distance.argmax())
+        if distance[i] > tolerance * np.hypot(dy, dx):
+            keep[start + 1 + i] = True
+            stack += [(start, start + 1 + i), (start + 1 + i, end)]
+    return ring[keep]
+
+
+# the sides of a pixel (r, c) as (neighbour offset, start corner, end corner), in the order
+# of a clockwise walk on screen, so that the cell is always on the right of its edges
+SIDES = (
+    ((-1, 0), (0, 0), (0, 1)),
+    ((0, 1), (0, 1), (1, 1)),
+    ((1, 0), (1, 1), (1, 0)),
+    ((0, -1), (1, 0), (0, 0)),
+)
+
+
+def split_ring(ring: np.ndarray) -> List[np.ndarray]:
+    """Split a closed ring that touches itself at corners into simple closed rings."""
+    rings, path, index = [], [], {}
+    for point in map(tuple, ring[:-1]):
+        if point in index:
+            start = index[point]
+            rings.append(np.array(path[start:] + [point], dtype=float))
+            for visited in path[start + 1:]:
+                del index[visited]
+            del path[start + 1:]
+        else:
+            index[point] = len(path)
+            path.append(point)
+    rings.append(np.array(path + path[:1], dtype=float))
+    return rings
+
+
+def boundary_rings(cell: np.ndarray) -> List[np.ndarray]:
+    """
+    Every boundary of a boolean mask as simple closed (row, col) rings of pixel corners,
+    keeping only the corners where they turn; outer boundaries have a negative shoelace
+    area, holes a positive one. Pixels touching at a corner only are kept apart.
+    """
+    padded = np.pad(cell.astype(bool), 1)
+    inside = padded[1:-1, 1:-1]
+    starts, directions = [], []
+    for (dr, dc), start, end in SIDES:
+        rows, cols = np.nonzero(inside & ~padded[1 + dr:padded.shape[0] - 1 + dr, 1 + dc:padded.shape[1] - 1 + dc])
+        starts.append(np.column_stack([rows + start[0], cols + start[1]]))
+        directions.append(np.broadcast_to(np.subtract(end, start), (len(rows), 2)))
+    starts, directions = np.concatenate(starts), np.concatenate(directions)
+    if not len(starts):
+        return []
+
+    # link each edge to the one starting where it ends; where two cells' pixels touch at a
+    # corner, two edges start there and the right turn stays around the same pixel
+    width = cell.shape[1] + 1
+    order = np.lexsort((directions[:, 1], directions[:, 0], starts[:, 1] + starts[:, 0] * width))
+    starts, directions = starts[order], directions[order]
+    keys = starts[:, 0] * width + starts[:, 1]
+    ends = starts + directions
+    end_keys = ends[:, 0] * width + ends[:, 1]
+    first = np.searchsorted(keys, end_keys, side='left')
+    count = np.searchsorted(keys, end_keys, side='right') - first
+    following = first.copy()
+    pinched = np.flatnonzero(count == 2)
+    right_turn = np.column_stack([directions[pinched, 1], -directions[pinched, 0]])
+    second = np.all(directions[first[pinched] + 1] == right_turn, axis=1)
+    following[pinched[second]] += 1
+
+    rings = []
+    following = following.tolist()
+    seen = bytearray(len(starts))
+    for edge in range(len(starts)):
+        if seen[edge]:
+            continue
+        ring = []
+        while not seen[edge]:
+            seen[edge] = 1
+            ring.append(edge)
+            edge = following[edge]
+        ring = np.array(ring)
+        # corners where the direction changes
+        turns = np.any(directions[ring] != directions[np.roll(ring, 1)], axis=1)
+        corners = np.vstack([starts[ring[turns]], starts[ring[turns][:1]]]).astype(float)
+        # a boundary passing a corner twice encloses a hole open only at that corner
+        if len(np.unique(keys[ring[turns]])) < len(corners) - 1:
+            rings += split_ring(corners)
+        else:
+            rings.append(corners)
+    return rings
+
+
+def ring_area(ring: np.ndarray) -> float:
+    """Shoelace area of a closed (row, col) ring, negative for outer boundaries."""
+    return (np.dot(ring[:-1, 0], ring[1:, 1]) - np.dot(ring[1:, 0], ring[:-1, 1])) / 2
+
+
+def trace_cell(cell: np.ndarray, tolerance: float) -> Optional[np.ndarray]:
+    """
+    Outer outline of a boolean cell mask as a simple closed (row, col) ring along pixel
+    edges, relative to the mask's top-left corner, simplified to within tolerance pixels;
+    None if empty. Unsimplified, it encloses exactly the cell's pixels and any holes in it.
+    """
+    rings = boundary_rings(cell)
+    if not rings:
+        return None
+    # the largest outer boundary; holes and pieces attached only at a corner (or not at
+    # all) are dropped
+    ring = min(rings, key=ring_area)
+    if tolerance > 0:
+        simplified = simplify(ring, tolerance)
+        # tiny cells would collapse to a line, keep their full outline
+        if len(simplified) >= 4:
+            ring = simplified
+    return ring
+
+
+def ring_coordinates(ring: np.ndarray, origin: Tuple[int, int], scale: Tuple[float, float], decimals: int) -> List:
+    """[[x, y], ...] of a (row, col) ring, counter-clockwise, shifted by origin and scaled."""
+    y = (ring[:, 0] + origin[0]) * scale[1]
+    x = (ring[:, 1] + origin[1]) * scale[0]
+    # exterior rings are counter-clockwise in (x, y) (RFC 7946), i.e. have a positive shoelace area
+    if np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1]) < 0:
+        x, y = x[::-1], y[::-1]
+    return np.round(np.column_stack([x, y]), decimals).tolist()
+
+
+def _init_worker(mask_path: str):
+    global _mask
+    # workers only read regions, the bounding boxes stay with the parent
+    _mask = LabelMask(mask_path, boxes={})
+
+
+def trace_tile(cells: Dict[str, np.ndarray], scale: Tuple[float, float], tolerance: float,
+               decimals: int, offset: Tuple[int, int] = (0, 0)) -> Tuple[List[Dict], int]:
+    """
+    GeoJSON features for the cells of one tile, with offset (y, x) added to their pixel
+    coordinates, and the number of mask pixels decoded.
+    """
+    y0, x0 = int(cells['y0'].min()), int(cells['x0'].min())
+    y1, x1 = int(cells['y1'].max()), int(cells['x1'].max())
+    region = _mask.read_region(y0, x0, y1, x1)
+
+    features = []
+    for label, area, cy0, cx0, cy1, cx1 in zip(*(cells[k] for k in ('label', 'area', 'y0', 'x0', 'y1', 'x1'))):
+        ring = trace_cell(region[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0] == label, tolerance)
+        if ring is None:
+            continue
+        features.append({
+            'type': 'Feature',
+            'id': int(label),
+            'geometry': {'type': 'Polygon', 'coordinates': [ring_coordinates(ring, (cy0 + offset[0], cx0 + offset[1]), scale, decimals)]},
+            'properties': {'objectType': 'detection', 'label': int(label), 'area_px': int(area)},
+        })
+    return features, region.size
+
+
+def tile_groups(boxes: Dict[str, np.ndarray], tile: int) -> Iterator[Dict[str, np.ndarray]]:
+    """Cells grouped by the tile holding their bbox's top-left corner, tiles in row-major order."""
+    columns = int(boxes['x0'].max()) // tile + 1 if len(boxes['label']) else 1
+    key = (boxes['y0'] // tile) * columns + boxes['x0'] // tile
+    order = np.argsort(key, kind='stable')
+    key = key[order]
+    starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]]) if len(key) else []
+    ends = list(starts[1:]) + [len(key)]
+    for start, end in zip(starts, ends):
+        yield {name: values[order[start:end]] for name, values in boxes.items()}
+
+
+class FeatureWriter:
+    """Stream features to a GeoJSON FeatureCollection, or to gzipped GeoJSONSeq for *.gz outputs."""
+
+    def __init__(self, path: str, scale: Tuple[float, float], units: str):
+        self.sequence = path.endswith('.gz')
+        self.f = gzip.open(path, 'wt', compresslevel=6) if self.sequence else open(path, 'w')
+        self.count = 0
+        if not self.sequence:
+            self.f.write('{"type": "FeatureCollection", ')
+            self.f.write(f'"properties": {json.dumps({"units": units, "pixel_size": list(scale)})}, ')
+            self.f.write('"features": [\n')
+
+    def write(self, features: List[Dict]):
+        for feature in features:
+            if self.sequence:
+                self.f.write(json.dumps(feature, separators=(',', ':')) + '\n')
+            else:
+                self.f.write((',\n' if self.count else '') + json.dumps(feature, separators=(',', ':')))
+            self.count += 1
+
+    def close(self):
+        if not self.sequence:
+            self.f.write('\n]}\n')
+        self.f.close()
+
+
+def export_outlines(
+    mask_path: str,
+    output: str,
+    bbox: Optional[str] = None,
+    scale: Tuple[float, float] = (1.0, 1.0),
+    units: str = 'µm',
+    tolerance: float = DEFAULT_TOLERANCE,
+    tile: int = DEFAULT_TILE,
+    workers: int = 1,
+    decimals: int = 3,
+    offset: Tuple[int, int] = (0, 0),
+) -> int:
+    """
+    Write the outline of every cell in mask_path to output, shifted by offset (y, x) pixels;
+    returns the number of cells written.
+    """
+    bbox = bbox or bbox_path(mask_path)
+    with perf.phase('boxes'):
+        if Path(bbox).exists():
+            mask = LabelMask(mask_path, bbox)
+            boxes = mask.boxes
+            mask.close()
+        else:
+            print(f"No bounding boxes at {bbox}, scanning {mask_path}")
+            boxes = scan_boxes(mask_path)
+    print(f"{mask_path}: {len(boxes['label'])} cells, tracing in {tile}px tiles with {workers} worker(s)")
+
+    writer = FeatureWriter(output, scale, units)
+    try:
+        with perf.phase('trace'):
+            groups = tile_groups(boxes, tile)
+            args = (scale, tolerance, decimals, offset)
+            if workers <= 1:
+                _init_worker(mask_path)
+                try:
+                    for cells in groups:
+                        features, decoded = trace_tile(cells, *args)
+                        perf.add('pixels_decoded', decoded)
+                        writer.write(features)
+                finally:
+                    _mask.close()
+            else:
+                with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(mask_path,)) as pool:
+                    pending = deque()
+                    for cells in groups:
+                        pending.append(pool.submit(trace_tile, cells, *args))
+                        if len(pending) >= workers * TILES_PER_WORKER:
+                            features, decoded = pending.popleft().result()
+                            perf.add('pixels_decoded', decoded)
+                            writer.write(features)
+                    while pending:
+                        features, decoded = pending.popleft().result()
+                        perf.add('pixels_decoded', decoded)
+                        writer.write(features)
+            perf.add('cells', writer.count)
+    finally:
+        writer.close()
+
+    print(f"Saved {writer.count} cell outlines to {output}")
+    return writer.count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the cells of a label mask as GeoJSON outlines in physical units.")
+    parser.add_argument("-i", "--input", type=str, required=True, help="Label mask TIFF (2D)")
+    parser.add_argument("-o", "--output", type=str, required=True,
+                        help="Output .geojson (FeatureCollection), or .geojsonl.gz for gzipped GeoJSONSeq")
+    parser.add_argument("--bbox", type=str, help="Bounding-box CSV from compact_mask.py (default: <input>.bbox.csv; scanned from the mask if missing)")
+    parser.add_argument("--image", type=str, help="OME-TIFF or OME-Zarr the mask was segmented from, for its PhysicalSize")
+    parser.add_argument("--pixel-size", type=float, help="Pixel size in µm, instead of reading it from --image")
+    parser.add_argument("--pixel-units", action='store_true', help="Write pixel coordinates instead of µm (e.g. to import onto the same image in QuPath)")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help=f"Simplify outlines to within this many pixels, 0 to keep every vertex (default: {DEFAULT_TOLERANCE})")
+    parser.add_argument("--tile", type=int, default=DEFAULT_TILE, help=f"Tile size in pixels (default: {DEFAULT_TILE})")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Parallel tile workers (default: all CPUs)")
+    parser.add_argument("--decimals", type=int, default=3, help="Decimal places of the coordinates (default: 3)")
+    parser.add_argument("--offset-json", type=str,
+                        help="<prefix>.downscaled.ome.json of the image; with a tissue crop, outlines are placed on the uncropped image")
+    perf.add_argument(parser)
+    args = parser.parse_args()
+    perf.enable(args.perf)
+
+    if args.pixel_units:
+        scale, units = (1.0, 1.0), 'pixel'
+    elif args.pixel_size:
+        scale, units = (args.pixel_size, args.pixel_size), 'µm'
+    elif args.image:
+        scale, units = pixel_size(args.image), 'µm'
+    else:
+        parser.error("one of --image, --pixel-size or --pixel-units is required")
+
+    offset = crop_offset(args.offset_json) if args.offset_json else (0, 0)
+    export_outlines(args.input, args.output, args.bbox, scale, units, args.tolerance, args.tile,
+                    args.workers, args.decimals, offset)
+    perf.write(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+# Version: 0.0.1
+# Rewrites a segmentation label mask compactly: cells relabelled 1..N (in order of their
+# original label), the smallest unsigned dtype that holds N, tiled and compressed, with a
+# CSV of per-label bounding boxes so that consumers can read only the tiles they need.
+# The mask is streamed in row bands and never held in memory as a whole.
+
+import argparse
+import warnings
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple
+import numpy as np
+import tifffile
+from stack_segmentation_input import BandReader
+import perf
+
+BBOX_COLUMNS = ['label', 'original_label', 'area', 'y0', 'x0', 'y1', 'x1']
+# labels above this are indexed through np.unique instead of a dense lookup table
+DENSE_LABEL_LIMIT = 1 << 27
+# pixels per band while collecting label statistics
+SCAN_PIXELS = 1 << 22
+
+
+def bbox_path(mask_path) -> Path:
+    """<mask without .tif/.tiff>.bbox.csv, next to the mask."""
+    path = Path(mask_path)
+    name = path.name
+    for suffix in ('.tiff', '.tif'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return path.with_name(f"{name}.bbox.csv")
+
+
+def label_dtype(n_labels: int) -> np.dtype:
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if n_labels <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+class LabelStats:
+    """Area and bounding box per label, accumulated over row bands."""
+
+    def __init__(self, size: int = 1024):
+        empty = np.zeros(0, dtype=np.int64)
+        self.area, self.y0, self.x0, self.y1, self.x1 = empty, empty, empty, empty, empty
+        self._grow(size)
+
+    def _grow(self, size: int):
+        old = len(self.area)
+        if size <= old:
+            return
+        extra = max(size, 2 * old) - old
+        big = np.iinfo(np.int64).max
+        self.area = np.concatenate([self.area, np.zeros(extra, dtype=np.int64)])
+        self.y0 = np.concatenate([self.y0, np.full(extra, big)])
+        self.x0 = np.concatenate([self.x0, np.full(extra, big)])
+        self.y1 = np.concatenate([self.y1, np.full(extra, -1)])
+        self.x1 = np.concatenate([self.x1, np.full(extra, -1)])
+
+    def add(self, ids: np.ndarray, y: int):
+        """ids: label index per pixel of a band starting at row y (0 = background)."""
+        ys, xs = np.nonzero(ids)
+        if not len(ys):
+            return
+        labels = ids[ys, xs].astype(np.intp)
+        self._grow(int(labels.max()) + 1)
+        ys += y
+        self.area += np.bincount(labels, minlength=len(self.area))
+        np.minimum.at(self.y0, labels, ys)
+        np.maximum.at(self.y1, labels, ys)
+        np.minimum.at(self.x0, labels, xs)
+        np.maximum.at(self.x1, labels, xs)
+
+
+def scan_labels(reader: BandReader) -> Tuple[np.ndarray, LabelStats, bool]:
+    """
+    Sorted original labels and their statistics. Statistics are indexed by original label,
+    or by rank + 1 when labels are too large for that (sparse).
+    """
+    rows = max(1, SCAN_PIXELS // reader.shape[1])
+    stats = LabelStats()
+    y = 0
+    for band in reader.bands(rows):
+        if band.size and int(band.max()) > DENSE_LABEL_LIMIT:
+            break
+        perf.add('pixels_decoded', band.size)
+        stats.add(band, y)
+        y += len(band)
+    else:
+        return np.flatnonzero(stats.area[1:] > 0) + 1, stats, False
+
+    # very large label values: collect them once, then index statistics by rank
+    uniques = np.unique(np.concatenate([np.unique(band) for band in reader.bands(rows)]))
+    uniques = uniques[uniques != 0]
+    stats = LabelStats(len(uniques) + 1)
+    y = 0
+    for band in reader.bands(rows):
+        perf.add('pixels_decoded', band.size)
+        stats.add(np.where(band != 0, np.searchsorted(uniques, band) + 1, 0), y)
+        y += len(band)
+    return uniques, stats, True
+
+
+def scan_boxes(input_path: str) -> Dict[str, np.ndarray]:
+    """
+    Bounding-box table (BBOX_COLUMNS) of a mask that was not compacted, from one streamed
+    pass; label and original_label are both the value in the mask.
+    """
+    reader = BandReader(input_path)
+    try:
+        labels, stats, sparse = scan_labels(reader)
+    finally:
+        reader.close()
+    index = np.arange(1, len(labels) + 1) if sparse else labels
+    return {
+        'label': labels, 'original_label': labels, 'area': stats.area[index],
+        'y0': stats.y0[index], 'x0': stats.x0[index], 'y1': stats.y1[index] + 1, 'x1': stats.x1[index] + 1,
+    }
+
+
+def compact_mask(input_path: str, output_path: str, tile: int = 256, compression: str = 'zlib') -> int:
+    """Relabel, downcast and rewrite input_path as a tiled compressed TIFF plus its bbox CSV; returns the label count."""
+    reader = BandReader(input_path)
+    try:
+        height, width = reader.shape
+        with perf.phase('scan'):
+            labels, stats, sparse = scan_labels(reader)
+        n_labels = len(labels)
+        out_dtype = label_dtype(n_labels)
+        print(f"{input_path}: shape={reader.shape}, dtype={reader.dtype}, {n_labels} labels "
+              f"(max {int(labels[-1]) if n_labels else 0}) -> {out_dtype}")
+
+        index = np.arange(1, n_labels + 1) if sparse else labels
+        consecutive = not sparse and (n_labels == 0 or int(labels[-1]) == n_labels)
+        if not sparse and not consecutive:
+            lookup = np.zeros(len(stats.area), dtype=out_dtype)
+            lookup[labels] = np.arange(1, n_labels + 1, dtype=out_dtype)
+
+        def tiles() -> Iterator[np.ndarray]:
+            for band in reader.bands(tile):
+                if consecutive:
+                    band = band.astype(out_dtype)
+                elif sparse:
+                    band = np.where(band != 0, np.searchsorted(labels, band) + 1, 0).astype(out_dtype)
+                else:
+                    band = lookup[band]
+                for x in range(0, width, tile):
+                    yield band[:, x:x + tile]
+
+        with perf.phase('write'):
+            tifffile.imwrite(
+                output_path,
+                tiles(),
+                shape=(height, width),
+                dtype=out_dtype,
+                tile=(tile, tile),
+                photometric='minisblack',
+                compression=compression,
+                predictor=True,
+                bigtiff=height * width * out_dtype.itemsize > 3.5 * (1024**3),
+                metadata={'axes': 'YX'},
+            )
+
+        with perf.phase('write_bbox'):
+            # exclusive upper bounds, so that mask[y0:y1, x0:x1] is the label's box
+            table = np.column_stack([
+                np.arange(1, n_labels + 1), labels, stats.area[index],
+                stats.y0[index], stats.x0[index], stats.y1[index] + 1, stats.x1[index] + 1,
+            ])
+            np.savetxt(bbox_path(output_path), table, fmt='%d', delimiter=',',
+                       header=','.join(BBOX_COLUMNS), comments='')
+    finally:
+        reader.close()
+
+    print(f"Saved {n_labels} labels as {out_dtype} to {output_path} and {bbox_path(output_path)}")
+    return n_labels
+
+
+class LabelMask:
+    """
+    A compact mask and its bounding boxes. Regions and single labels are decoded from the
+    tiles (or strips) they overlap only, so a consumer looking at a few cells does not read
+    the whole mask. boxes (e.g. from scan_boxes) replaces the bbox CSV.
+    """
+
+    def __init__(self, path: str, bbox: Optional[str] = None, boxes: Optional[Dict[str, np.ndarray]] = None):
+        self.tif = tifffile.TiffFile(path)
+        self.page = self.tif.pages.first
+        self.shape = tuple(s for s in self.page.shape if s != 1)
+        if len(self.shape) != 2:
+            raise ValueError(f"Expected a 2D label mask, got shape {self.page.shape} in {path}")
+        self.dtype = self.page.dtype
+
+        if boxes is None:
+            bbox = Path(bbox) if bbox else bbox_path(path)
+            with warnings.catch_warnings():
+                # a mask without cells has a header-only CSV, which loads (with a warning) as shape (0, 1)
+                warnings.simplefilter('ignore', UserWarning)
+                table = np.loadtxt(bbox, delimiter=',', skiprows=1, dtype=np.int64, ndmin=2)
+            table = table.reshape(-1, len(BBOX_COLUMNS))
+            boxes = {name: table[:, i] for i, name in enumerate(BBOX_COLUMNS)}
+        self.boxes = boxes
+
+        if self.page.is_tiled:
+            self.segment_shape = (self.page.tilelength, self.page.tilewidth)
+        else:
+            self.segment_shape = (self.page.rowsperstrip, self.shape[1])
+
+    def close(self):
+        self.tif.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.boxes['label'])
+
+    def bbox(self, label: int) -> Tuple[int, int, int, int]:
+        """(y0, x0, y1, x1) of a label, upper bounds exclusive."""
+        i = label - 1
+        return tuple(int(self.boxes[k][i]) for k in ('y0', 'x0', 'y1', 'x1'))
+
+    def read_region(self, y0: int, x0: int, y1: int, x1: int) -> np.ndarray:
+        """mask[y0:y1, x0:x1], decoding only the segments that overlap it."""
+        th, tw = self.segment_shape
+        columns = -(-self.shape[1] // tw)
+        out = np.zeros((y1 - y0, x1 - x0), dtype=self.dtype)
+        fh = self.tif.filehandle
+        for ty in range(y0 // th, -(-y1 // th)):
+            for tx in range(x0 // tw, -(-x1 // tw)):
+                index = ty * columns + tx
+                fh.seek(self.page.dataoffsets[index])
+                data = fh.read(self.page.databytecounts[index])
+                segment = self.page.decode(data, index, jpegtables=self.page.jpegtables)[0]
+                perf.add('pixels_decoded', segment.size)
+                segment = segment.reshape(segment.shape[1], segment.shape[2])
+                sy, sx = ty * th, tx * tw
+                ry0, ry1 = max(y0, sy), min(y1, sy + segment.shape[0], self.shape[0])
+                rx0, rx1 = max(x0, sx), min(x1, sx + segment.shape[1], self.shape[1])
+                out[ry0 - y0:ry1 - y0, rx0 - x0:rx1 - x0] = segment[ry0 - sy:ry1 - sy, rx0 - sx:rx1 - sx]
+        return out
+
+    def read_label(self, label: int, pad: int = 0) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """Boolean mask of one label within its (padded) bounding box, and the box's top-left corner."""
+        y0, x0, y1, x1 = self.bbox(label)
+        y0, x0 = max(0, y0 - pad), max(0, x0 - pad)
+        y1, x1 = min(self.shape[0], y1 + pad), min(self.shape[1], x1 + pad)
+        return self.read_region(y0, x0, y1, x1) == label, (y0, x0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relabel a segmentation mask consecutively and write it as a compact tiled TIFF with per-label bounding boxes.")
+    parser.add_argument("-i", "--input", type=str, required=True, help="Label mask TIFF (2D, any integer dtype)")
+    parser.add_argument("-o", "--output", type=str, required=True, help="Output .tif; bounding boxes go to <output>.bbox.csv")
+    parser.add_argument("--tile", type=int, default=256, help="Output tile size (default: 256)")
+    parser.add_argument("--compression", type=str, default='zlib', help="TIFF compression (default: zlib)")
+    perf.add_argument(parser)
+    args = parser.parse_args()
+    perf.enable(args.perf)
+
+    compact_mask(args.input, args.output, args.tile, args.compression)
+    perf.write(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,30 +4,33 @@
 # Version: 0.0.2 Changed default order to match upstream outputs.
 
 import argparse
+import csv
+import os
 import tifffile
 import numpy as np
-import pandas as pd
 import xml.etree.ElementTree as ET
+from ngff_store import OMEZarrImage, is_zarr, imwrite
+import perf
+from result_cache import add_arguments as add_cache_arguments, open_cache, run_cached
 
-def main():
-    parser = argparse.ArgumentParser(description="Extract channel from image")
-    parser.add_argument("-m", "--markers", type=str, required=True, help="Marker list from markerfile for markers to keep in image")
-    parser.add_argument("-o", "--output", type=str, required=True, help="Output .tif file for extracted channel")
-    parser.add_argument("-i", "--image", type=str, required=True, help="Input .tif image")
-    parser.add_argument("--order", type=str, default='0,1,2', help="Transpose dimensions, assuming X,Y,C input dimension order")
-
-    args = parser.parse_args()
+def convert(args):
+    if is_zarr(args.image):
+        image = OMEZarrImage(args.image)
+        channel_names = image.channel_names
+    else:
+        with perf.phase('read'):
+            img = tifffile.imread(args.image)
+            perf.add('pixels_decoded', img.size)
 
-    img = tifffile.imread(args.image)
+        with tifffile.TiffFile(args.image) as tif:
+            ome_xml = tif.ome_metadata
 
-    with tifffile.TiffFile(args.image) as tif:
-        ome_xml = tif.ome_metadata
+        root = ET.fromstring(ome_xml)
+        ns = {'ome': 'http://www.openmicroscopy.org/Schemas/OME/2016-06'}
+        channel_names = [channel.get('Name', '') for channel in root.findall('.//ome:Channel', ns)]
 
-    root = ET.fromstring(ome_xml)
-    ns = {'ome': 'http://www.openmicroscopy.org/Schemas/OME/2016-06'}
-    channels = root.findall('.//ome:Channel', ns)
-
-    markerfile = pd.read_csv(args.markers).marker_name
+    with open(args.markers, newline='', encoding='utf-8-sig') as f:
+        markerfile = [row['marker_name'] for row in csv.DictReader(f) if row['marker_name']]
 
     channel_indices = []
 
@@ -35,8 +38,8 @@ def main():
         channel_name_upper = channel_name.upper()
         matches = []
 
-        for i, channel in enumerate(channels):
-            name = channel.get('Name', '').upper()
+        for i, name in enumerate(channel_names):
+            name = name.upper()
             if channel_name_upper in name:
                 matches.append((i, name))
 
@@ -48,11 +51,41 @@ def main():
         else:
             channel_indices.append(matches[0][0])
 
-    order = [int(item) for item in args.order.split(',')]
-    img_transposed = np.transpose(img, order)
-    img_out = img_transposed[channel_indices]
+    if is_zarr(args.image):
+        # store axes are explicit, so only the selected channels are read and no transpose is needed
+        with perf.phase('read'):
+            img_out = np.moveaxis(image.read(channels=channel_indices), image.axes.index('C'), 0)
+            perf.add('pixels_decoded', img_out.size)
+    else:
+        with perf.phase('select_channels'):
+            order = [int(item) for item in args.order.split(',')]
+            img_transposed = np.transpose(img, order)
+            img_out = img_transposed[channel_indices]
+
+    with perf.phase('write'):
+        imwrite(args.output, img_out, channel_names=[channel_names[i] for i in channel_indices])
 
-    tifffile.imwrite(args.output, img_out, photometric='minisblack')
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract channel from image")
+    parser.add_argument("-m", "--markers", type=str, required=True, help="Marker list from markerfile for markers to keep in image")
+    parser.add_argument("-o", "--output", type=str, required=True, help="Output .tif file for extracted channel")
+    parser.add_argument("-i", "--image", type=str, required=True, help="Input .tif image")
+    parser.add_argument("--order", type=str, default='0,1,2', help="Transpose dimensions, assuming X,Y,C input dimension order")
+    perf.add_argument(parser)
+    add_cache_arguments(parser)
+
+    args = parser.parse_args()
+    perf.enable(args.perf)
+
+    run_cached(
+        open_cache(args.cache_dir, args.cache_max_size),
+        inputs=[args.image, args.markers],
+        params={'order': args.order, 'output_format': os.path.splitext(args.output)[1]},
+        outputs={'image': args.output},
+        func=lambda: convert(args),
+    )
+    perf.write(args.output)
 
 
 if __name__ == "__main__":
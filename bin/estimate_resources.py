@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+# Version: 0.0.1
+# Predicts the peak memory and run time of each per-sample Python step from the image
+# header alone (OME-XML plus one IFD per pyramid level, see ome_tiff_rescaler.py), so that
+# tasks can request what the sample needs instead of the label defaults. Each step is a
+# linear model in the megapixels it decodes, fitted with `fit` from the *.perf.json files
+# written with --perf; `fit` also writes a report of how well the model matches them.
+
+import argparse
+import json
+import math
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+MODEL_VERSION = 1
+DEFAULT_MODEL = Path(__file__).resolve().parent.parent / 'assets' / 'resource_model.json'
+
+# step -> (script, background removal method); the pixels each step decodes, as recorded
+# in its pixels_decoded counter, are given by step_pixels
+STEPS = {
+    'downscale': ('ome_tiff_rescaler.py', None),
+    'extract': ('extract_image_channel.py', None),
+    'bg_otsu_only': ('otsu_thresholding.py', 'otsu_only'),
+    'bg_mean': ('otsu_thresholding.py', 'mean'),
+    'bg_gaussian': ('otsu_thresholding.py', 'gaussian'),
+    'bg_rollingball': ('otsu_thresholding.py', 'rollingball'),
+    'bg_af': ('otsu_thresholding.py', 'af'),
+    'seg_input': ('stack_segmentation_input.py', None),
+    'render': ('render_boundaries.py', None),
+    'separate': ('convert_ome_tiff.py', None),
+}
+METRICS = {'memory_mb': 'peak_rss_mib', 'time_s': 'wall_seconds'}
+
+# never request less than this, whatever the model says
+DEFAULT_FLOORS = {'memory_mb': 1024, 'time_s': 600}
+# quantile of measured/predicted over the calibration runs used as the safety factor
+SAFETY_QUANTILE = 0.95
+# how far past the largest calibration run (as a multiple of its Mpix) a step is still
+# predicted; larger inputs are left to the label defaults
+DEFAULT_MAX_EXTRAPOLATION = 1.0
+
+
+def step_of(record: Dict) -> Optional[str]:
+    """Step a perf record belongs to, from its script name and (for background removal) -m."""
+    argv = record.get('argv', [])
+    method = None
+    if record.get('script') == 'otsu_thresholding.py':
+        for flag in ('-m', '--method'):
+            if flag in argv[:-1]:
+                method = argv[argv.index(flag) + 1]
+    for step, (script, step_method) in STEPS.items():
+        if record.get('script') == script and step_method == method:
+            return step
+    return None
+
+
+def image_features(image: str, target_mpp: Optional[float] = 1.0) -> Dict:
+    """
+    Sizes that drive the cost of the downstream steps, from the headers of image.
+    target_mpp=None plans for no downscaling, i.e. every later step sees the base level.
+    """
+    from ome_tiff_rescaler import OMETIFFRescaler
+
+    rescaler = OMETIFFRescaler(image, image, target_mpp or 1.0)
+    with rescaler.plan_pyramid() as plan:
+        info = plan.info
+        base = info['levels'][0]
+        channels = base['shape'][base['axes'].index('C')] if 'C' in base['axes'] else 1
+
+        if target_mpp is None:
+            level, scale = base, 1
+        else:
+            level = info['levels'][info['optimal_level']]
+            scale = level['additional_scale_integer']
+
+        return {
+            'channels': int(channels),
+            'base_plane': [int(base['shape'][base['y_index']]), int(base['shape'][base['x_index']])],
+            'level': int(level['level']),
+            'level_pixels': int(np.prod(level['shape'])) if target_mpp is not None else 0,
+            'plane': [int(level['shape'][level['y_index']]) // scale, int(level['shape'][level['x_index']]) // scale],
+            'dtype': str(np.dtype(level['dtype'])),
+        }
+
+
+def step_pixels(features: Dict) -> Dict[str, int]:
+    """Predicted pixels_decoded of each step for an image with these features."""
+    plane = features['plane'][0] * features['plane'][1]
+    channels = features['channels']
+    return {
+        'downscale': features['level_pixels'],
+        # the whole image is read to take one channel
+        'extract': channels * plane,
+        'bg_otsu_only': plane,
+        'bg_mean': plane,
+        'bg_gaussian': plane,
+        'bg_rollingball': plane,
+        # DAPI and AF, read from the downscaled image
+        'bg_af': 2 * plane,
+        # nuclear plus membrane
+        'seg_input': 2 * plane,
+        # the boundary mask
+        'render': plane,
+        # the whole image is read before the marker channels are selected
+        'separate': channels * plane,
+    }
+
+
+def predict(model: Dict, pixels: int, step: str) -> Dict[str, int]:
+    """Memory (MB) and time (s) to request for a step that decodes pixels."""
+    mpix = pixels / 1e6
+    fits = model['steps'][step]
+    prediction = {'pixels': int(pixels)}
+    for metric in METRICS:
+        fit = fits[metric]
+        value = (fit['intercept'] + fit['slope'] * mpix) * fit['safety']
+        prediction[metric] = int(math.ceil(max(model['floors'][metric], value)))
+    return prediction
+
+
+def estimate(image: str, model: Dict, target_mpp: Optional[float] = 1.0,
+             max_extrapolation: float = DEFAULT_MAX_EXTRAPOLATION) -> Dict:
+    """
+    Predictions of each fitted step for image. Steps that decode more than max_extrapolation
+    times the largest calibration run are not predicted but listed under 'outside_model',
+    so that their tasks keep the label defaults.
+    """
+    features = image_features(image, target_mpp)
+    resources = {'image': features, 'outside_model': {}}
+    for step, pixels in step_pixels(features).items():
+        if step not in model['steps']:
+            continue
+        mpix_max = model['steps'][step]['mpix_range'][1]
+        # mpix_range is rounded to 0.01 Mpix
+        if round(pixels / 1e6, 2) > mpix_max * max_extrapolation:
+            resources['outside_model'][step] = {'pixels': int(pixels), 'mpix_max': mpix_max}
+        else:
+            resources[step] = predict(model, pixels, step)
+    return resources
+
+
+def linear_fit(x: np.ndarray, y: np.ndarray) -> Dict[str, float]:
+    """Least-squares y = intercept + slope * x, with both terms kept non-negative."""
+    if len(x) > 1 and np.ptp(x) > 0:
+        slope, intercept = np.polyfit(x, y, 1)
+    else:
+        slope, intercept = 0.0, float(np.mean(y))
+    if slope < 0:
+        slope, intercept = 0.0, float(np.mean(y))
+    if intercept < 0:
+        slope, intercept = float(np.dot(x, y) / np.dot(x, x)), 0.0
+    return {'intercept': float(intercept), 'slope': float(slope)}
+
+
+def fit_quality(x: np.ndarray, y: np.ndarray, fit: Dict[str, float]) -> Dict[str, float]:
+    predicted = fit['intercept'] + fit['slope'] * x
+    ratio = y / predicted
+    residual = float(np.sum((y - predicted) ** 2))
+    total = float(np.sum((y - np.mean(y)) ** 2))
+    return {
+        'r2': 1 - residual / total if total > 0 else 1.0,
+        'median_abs_error': float(np.median(np.abs(ratio - 1))),
+        'worst_under': float(max(0.0, np.max(ratio) - 1)),
+        # round the safety factor up to the next 0.05
+        'safety': math.ceil(max(1.0, float(np.quantile(ratio, SAFETY_QUANTILE))) * 20) / 20,
+    }
+
+
+def fit(records: List[Dict], floors: Optional[Dict] = None) -> Dict:
+    """Fit each step with records from the perf files; steps without records are left out."""
+    groups = defaultdict(list)
+    for record in records:
+        step = step_of(record)
+        if step is not None and record.get('counters', {}).get('pixels_decoded'):
+            groups[step].append(record)
+
+    model = {'version': MODEL_VERSION, 'floors': dict(floors or DEFAULT_FLOORS), 'steps': {}}
+    for step in STEPS:
+        group = groups.get(step)
+        if not group:
+            continue
+        x = np.array([r['counters']['pixels_decoded'] / 1e6 for r in group])
+        fits = {'runs': len(group), 'mpix_range': [round(float(x.min()), 2), round(float(x.max()), 2)]}
+        for metric, field in METRICS.items():
+            y = np.array([float(r[field]) for r in group])
+            line = linear_fit(x, y)
+            quality = fit_quality(x, y, line)
+            fits[metric] = {
+                'intercept': round(line['intercept'], 3),
+                'slope': round(line['slope'], 3),
+                'safety': quality.pop('safety'),
+                'quality': {k: round(v, 3) for k, v in quality.items()},
+            }
+        model['steps'][step] = fits
+    return model
+
+
+def report(model: Dict) -> str:
+    """Markdown fit-quality table of a fitted model."""
+    lines = [
+        '# Resource model fit',
+        '',
+        'Per step, `value = (intercept + slope * Mpix) * safety`, where Mpix is the predicted '
+        f"`pixels_decoded` / 1e6, the safety factor is the {SAFETY_QUANTILE:.0%} quantile of "
+        'measured/predicted (at least 1) and requests never go below the floors '
+        f"({model['floors']['memory_mb']} MB, {model['floors']['time_s']} s). "
+        'R², median |error| and worst under-prediction are before the safety factor.',
+        '',
+        '| step | metric | runs | Mpix range | intercept | slope / Mpix | R² | median abs error | worst under-prediction | safety |',
+        '|---|---|---|---|---|---|---|---|---|---|',
+    ]
+    for step, fits in model['steps'].items():
+        for metric in METRICS:
+            f = fits[metric]
+            q = f['quality']
+            lines.append(
+                f"| {step} | {metric} | {fits['runs']} | {fits['mpix_range'][0]}-{fits['mpix_range'][1]} "
+                f"| {f['intercept']} | {f['slope']} | {q['r2']:.3f} | {q['median_abs_error']:.1%} "
+                f"| {q['worst_under']:.1%} | {f['safety']} |"
+            )
+    lines += [
+        '',
+        'The model is only applied within the Mpix range it was fitted on: `estimate` leaves a step '
+        'whose predicted Mpix exceeds the largest calibration run (times `--max-extrapolation`, '
+        f"default {DEFAULT_MAX_EXTRAPOLATION:g}) to the label defaults and warns. To cover whole slides, "
+        'fit the model on perf files from slide-sized images.',
+    ]
+    missing = [step for step in STEPS if step not in model['steps']]
+    if missing:
+        lines += ['', f"No runs for: {', '.join(missing)}; these steps keep the label defaults."]
+    return '\n'.join(lines) + '\n'
+
+
+def load_model(path) -> Dict:
+    with open(path) as f:
+        model = json.load(f)
+    if model.get('version') != MODEL_VERSION:
+        raise ValueError(f"{path}: expected resource model version {MODEL_VERSION}, got {model.get('version')}")
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate per-step memory and time of a sample from its image header, or fit the estimator.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_estimate = subparsers.add_parser('estimate', help="Write <prefix>.resources.json for one image")
+    parser_estimate.add_argument("image", type=str, help="Input OME-TIFF")
+    parser_estimate.add_argument("-p", "--prefix", type=str, required=True, help="Output prefix for <prefix>.resources.json")
+    parser_estimate.add_argument("-m", "--model", type=str, default=str(DEFAULT_MODEL), help=f"Fitted model (default: {DEFAULT_MODEL})")
+    parser_estimate.add_argument("--target-mpp", type=float, default=1.0, help="Resolution the image is downscaled to (default: 1.0)")
+    parser_estimate.add_argument("--no-downscale", action='store_true', help="The image is used as is (downscale_mode none)")
+    parser_estimate.add_argument("--max-extrapolation", type=float, default=DEFAULT_MAX_EXTRAPOLATION,
+                                 help="Predict steps up to this multiple of the largest calibration run; larger ones keep the label defaults "
+                                      f"(default: {DEFAULT_MAX_EXTRAPOLATION:g})")
+
+    parser_fit = subparsers.add_parser('fit', help="Fit the model to *.perf.json files")
+    parser_fit.add_argument("perf_files", nargs='+', help="*.perf.json files written with --perf or MIHCRO_PERF=1")
+    parser_fit.add_argument("-o", "--output", type=str, required=True, help="Output model .json")
+    parser_fit.add_argument("--report", type=str, help="Write the fit-quality report (markdown) here")
+    parser_fit.add_argument("--min-memory", type=int, default=DEFAULT_FLOORS['memory_mb'], help="Memory floor in MB")
+    parser_fit.add_argument("--min-time", type=int, default=DEFAULT_FLOORS['time_s'], help="Time floor in seconds")
+    args = parser.parse_args()
+
+    if args.command == 'estimate':
+        model = load_model(args.model)
+        resources = estimate(args.image, model, None if args.no_downscale else args.target_mpp, args.max_extrapolation)
+        output = f"{args.prefix}.resources.json"
+        Path(output).write_text(json.dumps(resources, indent=2) + '\n')
+        for step, values in resources.items():
+            if step not in ('image', 'outside_model'):
+                print(f"{step}: {values['pixels'] / 1e6:.1f} Mpix, {values['memory_mb']} MB, {values['time_s']} s")
+        for step, values in resources['outside_model'].items():
+            print(f"Warning: {step} decodes {values['pixels'] / 1e6:.1f} Mpix, beyond the {values['mpix_max']} Mpix "
+                  f"the model was fitted on; keeping the label defaults")
+        print(f"Saved resource estimates to {output}")
+    else:
+        records = [json.loads(Path(path).read_text()) for path in args.perf_files]
+        model = fit(records, {'memory_mb': args.min_memory, 'time_s': args.min_time})
+        Path(args.output).write_text(json.dumps(model, indent=2) + '\n')
+        print(f"Fitted {len(model['steps'])} steps from {len(records)} perf files, saved to {args.output}")
+        if args.report:
+            Path(args.report).write_text(report(model))
+            print(f"Saved fit report to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
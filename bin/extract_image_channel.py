@@ -5,9 +5,20 @@
 import sys, os
 import argparse
 import xml.etree.ElementTree as ET
-import skimage.io
 import tifffile
 import numpy as np
+from ngff_store import OMEZarrImage, is_zarr, imwrite
+import perf
+from result_cache import add_arguments as add_cache_arguments, open_cache, run_cached
+
+def find_channel(channel_names, channel_name):
+    channel_name_upper = channel_name.upper()
+
+    for i, name in enumerate(channel_names):
+        if channel_name_upper in name.upper():
+            return i  # Return the channel index directly
+
+    return None
 
 def extract_channel(xml, channel_name):
     tree = ET.parse(xml)
@@ -17,19 +28,39 @@ def extract_channel(xml, channel_name):
     ns = {'ome': 'http://www.openmicroscopy.org/Schemas/OME/2016-06'}
     channels = root.findall('.//ome:Channel', ns)
 
-    channel_name_upper = channel_name.upper()
+    return find_channel([channel.get('Name', '') for channel in channels], channel_name)
 
-    for i, channel in enumerate(channels):
-        name = channel.get('Name', '').upper()
-        if channel_name_upper in name:
-            return i  # Return the channel index directly
+def save_zarr_channel_image(ch, img_path, out_path):
+    # read only the chunks of the requested channel
+    image = OMEZarrImage(img_path)
+    print("Store shape:", image.shape, "Axes:", image.axes)
 
-    return None
+    if "C" not in image.axes:
+        raise RuntimeError(f"No channel axis in axes string {image.axes}")
+
+    c_index = image.axes.index("C")
+    if ch >= image.shape[c_index]:
+        print(f"Error: Channel {ch} not found, image has {image.shape[c_index]} channels")
+        sys.exit(os.EX_SOFTWARE)
+
+    with perf.phase('read'):
+        channel = np.take(image.read(channels=[ch]), 0, axis=c_index)
+        perf.add('pixels_decoded', channel.size)
+    with perf.phase('write'):
+        if out_path.endswith('.zarr'):
+            imwrite(out_path, channel, axes=image.axes.replace("C", ""),
+                    physical_size=image.physical_size)
+        else:
+            tifffile.imwrite(out_path, channel)
 
 def save_channel_image(ch, img_path, out_path):
-    with tifffile.TiffFile(img_path) as tif:
+    if is_zarr(img_path):
+        return save_zarr_channel_image(ch, img_path, out_path)
+
+    with perf.phase('read'), tifffile.TiffFile(img_path) as tif:
         arr = tif.asarray()
         axes = tif.series[0].axes
+        perf.add('pixels_decoded', arr.size)
         print("Array shape:", arr.shape, "Axes:", axes)
 
     if "C" in axes:
@@ -47,21 +78,38 @@ def save_channel_image(ch, img_path, out_path):
         sys.exit(os.EX_SOFTWARE)
 
     channel = arr[..., ch]
-    skimage.io.imsave(out_path, channel)
+    with perf.phase('write'):
+        tifffile.imwrite(out_path, channel)
 
 def main():
     parser = argparse.ArgumentParser(description="Extract channel from image")
     parser.add_argument("-o", "--output", type=str, required=True, help="Output .tif file for extracted channel")
     parser.add_argument("-i", "--image", type=str, required=True, help="Input .tif image")
-    parser.add_argument("-x", "--xml", type=str, required=True, help="Metadata .xml for .tif image")
+    parser.add_argument("-x", "--xml", type=str, required=False, help="Metadata .xml for .tif image (optional for OME-Zarr input)")
     parser.add_argument("-c", "--channel", type=str, default='DAPI', help="Channel name to extract")
+    perf.add_argument(parser)
+    add_cache_arguments(parser)
 
     args = parser.parse_args()
-    channel_extracted = extract_channel(args.xml, args.channel)
+    perf.enable(args.perf)
+    with perf.phase('find_channel'):
+        if args.xml:
+            channel_extracted = extract_channel(args.xml, args.channel)
+        elif is_zarr(args.image):
+            channel_extracted = find_channel(OMEZarrImage(args.image).channel_names, args.channel)
+        else:
+            parser.error("--xml is required for TIFF input")
 
     if channel_extracted is not None:
-        save_channel_image(channel_extracted, args.image, args.output)
+        run_cached(
+            open_cache(args.cache_dir, args.cache_max_size),
+            inputs=[args.image] + ([args.xml] if args.xml else []),
+            params={'channel': channel_extracted, 'output_format': os.path.splitext(args.output)[1]},
+            outputs={'image': args.output},
+            func=lambda: save_channel_image(channel_extracted, args.image, args.output),
+        )
         print(f"Successfully extracted channel {channel_extracted} ({args.channel}) to {args.output}")
+        perf.write(args.output)
     else:
         print(f"{args.channel} channel could not be found")
         sys.exit(os.EX_SOFTWARE)
@@ -3,29 +3,222 @@
 ## from: https://forum.image.sc/t/trouble-generating-ome-tiffs-in-the-right-shape/89191/7
 
 import argparse
+import mmap
+import queue
+import threading
+from pathlib import Path
 from xml.etree import ElementTree
-from tifffile import TiffFile, TiffWriter
+import numpy as np
+from tifffile import OmeXml, TiffFile, TiffWriter
 from xml.dom import minidom
+from ome_tiff_rescaler import OMETIFFRescaler
+import perf
 
-def tiles(series):
-    # yield raw tiles from all pages in TIFF series
-    fh = series.parent.filehandle
+# tiles closer than this are read in one request and the gap is discarded
+DEFAULT_MAX_GAP = 64 * 1024
+# upper bound on a single coalesced read, also the unit handed to the prefetcher
+DEFAULT_READ_SIZE = 8 * 1024 * 1024
+DEFAULT_PREFETCH = 4
+
+
+def coalesce_ranges(offsets, bytecounts, max_gap=DEFAULT_MAX_GAP, read_size=DEFAULT_READ_SIZE):
+    # group tile indices into contiguous byte ranges, sorted by file offset
+    # returns a list of (start, end, [tile indices]) tuples
+    order = sorted(
+        (i for i, bytecount in enumerate(bytecounts) if bytecount > 0),
+        key=lambda i: offsets[i],
+    )
+    ranges = []
+    for i in order:
+        start, end = offsets[i], offsets[i] + bytecounts[i]
+        if ranges:
+            run_start, run_end, indices = ranges[-1]
+            if start - run_end <= max_gap and max(end, run_end) - run_start <= read_size:
+                ranges[-1] = (run_start, max(end, run_end), indices + [i])
+                continue
+        ranges.append((start, end, [i]))
+    return ranges
+
+
+def tile_windows(series, read_size=DEFAULT_READ_SIZE):
+    # split the (offset, bytecount) list of a series into windows of at most
+    # read_size bytes, keeping the order in which TiffWriter expects the tiles
+    window = ([], [])
+    window_bytes = 0
     for page in series:
         for offset, bytecount in zip(page.dataoffsets, page.databytecounts):
-            fh.seek(offset)
-            yield fh.read(bytecount)
+            if window[0] and window_bytes + bytecount > read_size:
+                yield window
+                window = ([], [])
+                window_bytes = 0
+            window[0].append(offset)
+            window[1].append(bytecount)
+            window_bytes += bytecount
+    if window[0]:
+        yield window
+
+
+def read_window(read_range, offsets, bytecounts, max_gap=DEFAULT_MAX_GAP, read_size=DEFAULT_READ_SIZE):
+    # read one window with as few range reads as possible, return tiles in input order
+    chunks = [b''] * len(offsets)
+    for start, end, indices in coalesce_ranges(offsets, bytecounts, max_gap, read_size):
+        buffer = read_range(start, end - start)
+        for i in indices:
+            chunks[i] = bytes(buffer[offsets[i] - start:offsets[i] - start + bytecounts[i]])
+    return chunks
+
+
+def prefetch(iterable, depth=DEFAULT_PREFETCH):
+    # run iterable in a background thread, holding at most depth items in memory
+    if depth < 1:
+        yield from iterable
+        return
+
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def producer():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                items.put(item)
+        except BaseException as e:
+            items.put(e)
+            return
+        items.put(done)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        # unblock the producer if it is waiting on a full queue
+        while thread.is_alive():
+            try:
+                items.get_nowait()
+            except queue.Empty:
+                thread.join(0.1)
+
+
+def tiles(series, max_gap=DEFAULT_MAX_GAP, read_size=DEFAULT_READ_SIZE, depth=DEFAULT_PREFETCH, mapped=None):
+    # yield raw tiles from all pages in TIFF series
+    # reads are sorted by offset and merged into large ranges, served from a
+    # memory map when one is given, and run ahead of the writer in a thread
+    fh = series.parent.filehandle
+
+    if mapped is not None:
+        def read_range(start, size):
+            return memoryview(mapped)[start:start + size]
+    else:
+        def read_range(start, size):
+            with fh.lock:
+                fh.seek(start)
+                return fh.read(size)
+
+    # resolve page offsets up front so that the reader thread never parses headers
+    windows = list(tile_windows(series, read_size))
+    reads = (
+        read_window(read_range, offsets, bytecounts, max_gap, read_size)
+        for offsets, bytecounts in windows
+    )
+    for chunks in prefetch(reads, depth):
+        yield from chunks
+
+
+def inferred_level_shape(series, level):
+    # compute rows/cols and samples confidently from page tags
+    page = level.keyframe
+    rows = getattr(page, 'imagelength', None)
+    cols = getattr(page, 'imagewidth', None)
+    # number of channels/samples (fall back to level.shape if unsure)
+    samples = series.shape[0] if series.shape else (level.shape[0] if len(level.shape) == 3 else 1)
+
+    # If level.shape looks like (rows, cols, samples) convert to (samples, rows, cols)
+    if len(level.shape) == 3:
+        a, b, c = level.shape
+        if (a == rows and b == cols and c == samples):
+            return (samples, rows, cols)
+        elif (a == samples and b == rows and c == cols):
+            return (a, b, c)  # already (samples, rows, cols)
+        # fallback to explicit (samples, rows, cols)
+        return (samples, rows, cols)
+    return (rows, cols)
+
+
+def physical_size(page):
+    resx, resy = page.get_resolution('micrometer')
+
+    # Correct resolution by objective magnification
+    #resx = resx / objective_value
+    #resy = resy / objective_value
+    ## get_resolution seems to return #pixels per micrometer; OME physical unit specifies micrometer per pixel instead..
+    ## need to invert it.
+    ## objective_value is the magnification (eg. 20X), is not necessary in this PhysicalSize
+    return 1.0/resx, 1.0/resy
+
+
+def output_dtype(level):
+    return 'float32' if level.dtype == 'uint32' else level.dtype
+
+
+def decode_level(chunks, level, out):
+    # decode the raw tiles of a level into out (pages, rows, cols) while passing them on unchanged
+    decode = level.keyframe.decode
+    for p, page in enumerate(level):
+        jpegtables = getattr(page, 'jpegtables', None)
+        for index in range(len(page.dataoffsets)):
+            chunk = next(chunks)
+            if chunk:
+                segment, (_, _, y, x, _), _ = decode(chunk, index, jpegtables=jpegtables)
+                h = min(segment.shape[1], out.shape[1] - y)
+                w = min(segment.shape[2], out.shape[2] - x)
+                out[p, y:y + h, x:x + w] = segment[0, :h, :w, 0].view(out.dtype)
+                perf.add('pixels_decoded', h * w)
+            yield chunk
+
+
+def plan_downscale(rescaler, series, channel_names):
+    # pick the pyramid level to downscale from the geometry the converted file will have
+    resx, resy = physical_size(series.levels[0].keyframe)
+    levels = [
+        (i, inferred_level_shape(series, level), np.dtype(output_dtype(level)), 'CYX')
+        for i, level in enumerate(series.levels)
+    ]
+    return rescaler.plan_levels(resx, resy, channel_names, levels)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Convert HALO/Indica tif to OME tif")
     parser.add_argument("-o", "--output", type=str, required=True, help="Output .ome.tif file")
     parser.add_argument("-i", "--image", type=str, required=True, help="Input .tif image")
+    parser.add_argument("--max-gap", type=int, default=DEFAULT_MAX_GAP, help="Merge tile reads separated by at most this many bytes")
+    parser.add_argument("--read-size", type=int, default=DEFAULT_READ_SIZE, help="Maximum size in bytes of a single coalesced read")
+    parser.add_argument("--prefetch", type=int, default=DEFAULT_PREFETCH, help="Number of reads to buffer ahead of the writer (0 disables the background reader)")
+    parser.add_argument("--mmap", action="store_true", help="Serve tile reads from a memory-mapped input file")
+    parser.add_argument("--downscale-prefix", type=str, default=None,
+                        help="Also write <prefix>.downscaled.ome.tiff and <prefix>.downscaled.ome.json as ome_tiff_rescaler.py would, from the level data being converted")
+    parser.add_argument("--target-mpp", type=float, default=1.0, help="Target microns per pixel for the downscaled output (default: 1.0)")
+    parser.add_argument("--crop-to-tissue", action="store_true",
+                        help="Crop the downscaled output to the tissue found on the smallest pyramid level, as ome_tiff_rescaler.py --crop-to-tissue does")
+    perf.add_argument(parser)
 
     args = parser.parse_args()
+    perf.enable(args.perf)
 
-    with TiffFile(args.image) as tif:
+    with TiffFile(args.image) as tif, open(args.image, 'rb') as raw:
         print(tif)
 
+        mapped = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) if args.mmap else None
+
         tree = ElementTree.fromstring(tif.pages.first.description)
         channel_names = [
             channel.attrib['name'] for channel in tree.iter('channel')
@@ -34,10 +227,27 @@ def main():
         # some fused tiff does not have objective value, just skip this..
         #objective_value = float(tree.find('.//objective').attrib['value'])
 
+        rescaler = None
+        plan = None
+        source_xml = None
+        level_data = None
+        coarse = None
+        if args.downscale_prefix:
+            rescaler = OMETIFFRescaler(
+                args.output, Path(f"{args.downscale_prefix}.downscaled.ome.tiff"), args.target_mpp
+            )
+            with perf.phase('plan'):
+                plan = plan_downscale(rescaler, tif.series[0], channel_names)
+            if args.crop_to_tissue:
+                with perf.phase('read_coarse'):
+                    smallest = tif.series[0].levels[-1]
+                    coarse = smallest.asarray().reshape(inferred_level_shape(tif.series[0], smallest))
+                    perf.add('pixels_decoded', coarse.size)
+
         with TiffWriter(
             args.output, bigtiff=True, ome=True, byteorder=tif.byteorder
         ) as ome:
-            for series in tif.series:
+            for series_idx, series in enumerate(tif.series):
                 print("SERIES:", series)
                 print("  series.axes:", series.axes, "series.shape:", series.shape)
                 # assert series.axes == 'IYX'
@@ -55,24 +265,7 @@ def main():
 
                     assert page.is_tiled
 
-                    # --- compute rows/cols and samples confidently from page tags ---
-                    rows = getattr(page, 'imagelength', None)
-                    cols = getattr(page, 'imagewidth', None)
-                    # number of channels/samples (fall back to level.shape if unsure)
-                    samples = series.shape[0] if series.shape else (level.shape[0] if len(level.shape) == 3 else 1)
-
-                    # If level.shape looks like (rows, cols, samples) convert to (samples, rows, cols)
-                    if len(level.shape) == 3:
-                        a, b, c = level.shape
-                        if (a == rows and b == cols and c == samples):
-                            inferred_shape = (samples, rows, cols)
-                        elif (a == samples and b == rows and c == cols):
-                            inferred_shape = (a, b, c)  # already (samples, rows, cols)
-                        else:
-                            # fallback to explicit (samples, rows, cols)
-                            inferred_shape = (samples, rows, cols)
-                    else:
-                        inferred_shape = (rows, cols)
+                    inferred_shape = inferred_level_shape(series, level)
 
                     # get tile dims from tags if present (TileWidth, TileLength)
                     try:
@@ -88,16 +281,7 @@ def main():
                             subifds = len(series.levels) - 1
                         else:
                             subifds = None
-                        resx, resy = page.get_resolution('micrometer')
-
-                        # Correct resolution by objective magnification
-                        #resx = resx / objective_value
-                        #resy = resy / objective_value
-                        ## get_resolution seems to return #pixels per micrometer; OME physical unit specifies micrometer per pixel instead..
-                        ## need to invert it.
-                        ## objective_value is the magnification (eg. 20X), is not necessary in this PhysicalSize
-                        resx = 1.0/resx 
-                        resy = 1.0/resy 
+                        resx, resy = physical_size(page)
 
                         metadata = {
                             'axes': 'CYX',
@@ -111,23 +295,59 @@ def main():
                         subifds = None
                         metadata = None
 
-                    dtype = 'float32' if level.dtype == 'uint32' else level.dtype
+                    dtype = output_dtype(level)
+                    if rescaler is not None and series_idx == 0 and i == 0:
+                        # the OME-XML this write produces, for save_output, without reading it back
+                        ome_xml = OmeXml()
+                        ome_xml.addimage(dtype, inferred_shape, (inferred_shape[0], 1, 1) + tuple(inferred_shape[-2:]) + (1,), **metadata)
+                        source_xml = ome_xml.tostring()
 
                     print("    -> writing with shape:", inferred_shape, "tile:", tile)
 
-                    ome.write(
-                        tiles(level),
-                        shape=inferred_shape,
-                        dtype=dtype,
-                        photometric=page.photometric,
-                        compression=page.compression,
-                        resolution=page.resolution,
-                        resolutionunit=page.resolutionunit,
-                        tile=tile,
-                        subifds=subifds,
-                        metadata=metadata,
-                    )
+                    chunks = tiles(level, args.max_gap, args.read_size, args.prefetch, mapped)
+                    if plan is not None and series_idx == 0 and i == plan['optimal_level']:
+                        print("    -> decoding level", i, "for downscaled output")
+                        level_data = np.zeros(inferred_shape, dtype=dtype)
+                        chunks = decode_level(chunks, level, level_data.reshape((-1,) + inferred_shape[-2:]))
+
+                    with perf.phase(f'copy_level{i}'):
+                        ome.write(
+                            chunks,
+                            shape=inferred_shape,
+                            dtype=dtype,
+                            photometric=page.photometric,
+                            compression=page.compression,
+                            resolution=page.resolution,
+                            resolutionunit=page.resolutionunit,
+                            tile=tile,
+                            subifds=subifds,
+                            metadata=metadata,
+                        )
+                        perf.add('tiles_copied', sum(len(p.dataoffsets) for p in level))
+
+        if mapped is not None:
+            mapped.close()
+
+    if rescaler is not None:
+        level_info = plan['levels'][plan['optimal_level']]
+        if coarse is not None:
+            with perf.phase('detect_tissue'):
+                region = rescaler.tissue_region(coarse, 'CYX' if coarse.ndim == 3 else 'YX', level_info)
+            if region is not None:
+                y0, x0, y1, x1 = region
+                level_data = level_data[..., y0:y1, x0:x1]
+        with perf.phase('downsample'):
+            data = rescaler._downsample_integer(
+                level_data,
+                level_info['additional_scale_integer'],
+                level_info['y_index'],
+                level_info['x_index'],
+            )
+        with perf.phase('save_downscaled'):
+            rescaler.save_output(data, source_xml)
+        print("Successfully created rescaled image:", rescaler.output_path)
 
+    perf.write(args.output)
     return
 
 
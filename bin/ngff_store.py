@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+OME-Zarr (NGFF 0.4) chunked image store
+Minimal local-directory reader/writer for Zarr v2 arrays with multiscales metadata,
+used as an alternative to monolithic TIFFs for intermediate images.
+Reads touch only the chunks overlapping the requested channels/region and decode them concurrently.
+"""
+
+import argparse
+import json
+import os
+import zlib
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+from pathlib import Path
+from typing import Optional, Tuple, Dict, Any, List, Sequence, Union
+import numpy as np
+
+
+NGFF_VERSION = '0.4'
+DEFAULT_CHUNK_YX = 1024
+DEFAULT_COMPRESSION_LEVEL = 6
+
+AXIS_TYPES = {'T': 'time', 'C': 'channel', 'Z': 'space', 'Y': 'space', 'X': 'space'}
+# bioformats2raw convention for carrying the full OME-XML alongside the image
+OME_XML_PATH = Path('OME') / 'METADATA.ome.xml'
+
+
+def is_zarr(path: Union[str, Path]) -> bool:
+    """True if path is a Zarr group/array directory."""
+    path = Path(path)
+    return path.is_dir() and ((path / '.zgroup').exists() or (path / '.zarray').exists())
+
+
+def _default_workers() -> int:
+    return min(32, os.cpu_count() or 1)
+
+
+def _compress(data: bytes, compressor: Optional[Dict[str, Any]]) -> bytes:
+    if compressor is None:
+        return data
+    if compressor['id'] == 'zlib':
+        return zlib.compress(data, compressor.get('level', DEFAULT_COMPRESSION_LEVEL))
+    if compressor['id'] == 'gzip':
+        return gzip.compress(data, compressor.get('level', DEFAULT_COMPRESSION_LEVEL))
+    raise ValueError(f"Unsupported compressor for writing: {compressor['id']}")
+
+
+def _decompress(data: bytes, compressor: Optional[Dict[str, Any]]) -> bytes:
+    if compressor is None:
+        return data
+    if compressor['id'] == 'zlib':
+        return zlib.decompress(data)
+    if compressor['id'] == 'gzip':
+        return gzip.decompress(data)
+    # stores written by other tools (blosc, zstd, ...) need numcodecs
+    try:
+        import numcodecs
+    except ImportError:
+        raise ValueError(f"Compressor '{compressor['id']}' requires numcodecs, which is not installed")
+    return numcodecs.get_codec(compressor).decode(data)
+
+
+def _as_index(indices: np.ndarray):
+    """Use a slice for contiguous indices so that numpy returns views instead of copies."""
+    if len(indices) and np.all(np.diff(indices) == 1):
+        return slice(int(indices[0]), int(indices[-1]) + 1)
+    return indices
+
+
+class ZarrArray:
+    """A single Zarr v2 array stored as one file per chunk in a local directory."""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        with open(self.path / '.zarray') as f:
+            self.meta = json.load(f)
+        self.shape = tuple(self.meta['shape'])
+        self.chunks = tuple(self.meta['chunks'])
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.compressor = self.meta.get('compressor')
+        self.fill_value = self.meta.get('fill_value') or 0
+        self.separator = self.meta.get('dimension_separator', '.')
+
+        if self.meta.get('order', 'C') != 'C' or self.meta.get('filters'):
+            raise ValueError(f"Only C-order arrays without filters are supported: {self.path}")
+
+    @classmethod
+    def create(
+        cls,
+        path: Union[str, Path],
+        shape: Sequence[int],
+        dtype,
+        chunks: Sequence[int],
+        compression_level: int = DEFAULT_COMPRESSION_LEVEL,
+    ) -> 'ZarrArray':
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        dtype = np.dtype(dtype)
+        meta = {
+            'zarr_format': 2,
+            'shape': [int(s) for s in shape],
+            'chunks': [int(min(c, s)) or 1 for c, s in zip(chunks, shape)],
+            'dtype': dtype.str,
+            'compressor': {'id': 'zlib', 'level': compression_level} if compression_level else None,
+            'fill_value': 0,
+            'order': 'C',
+            'filters': None,
+            'dimension_separator': '/',
+        }
+        with open(path / '.zarray', 'w') as f:
+            json.dump(meta, f, indent=2)
+        return cls(path)
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def chunk_path(self, key: Tuple[int, ...]) -> Path:
+        return self.path / self.separator.join(str(k) for k in key)
+
+    def read_chunk(self, key: Tuple[int, ...]) -> np.ndarray:
+        try:
+            with open(self.chunk_path(key), 'rb') as f:
+                data = _decompress(f.read(), self.compressor)
+        except FileNotFoundError:
+            return np.full(self.chunks, self.fill_value, dtype=self.dtype)
+        return np.frombuffer(data, dtype=self.dtype).reshape(self.chunks)
+
+    def write_chunk(self, key: Tuple[int, ...], chunk: np.ndarray):
+        # Zarr v2 stores edge chunks at full chunk size
+        if chunk.shape != self.chunks:
+            padded = np.full(self.chunks, self.fill_value, dtype=self.dtype)
+            padded[tuple(slice(0, s) for s in chunk.shape)] = chunk
+            chunk = padded
+        target = self.chunk_path(key)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(f".{target.name}.tmp")
+        with open(tmp, 'wb') as f:
+            f.write(_compress(np.ascontiguousarray(chunk, dtype=self.dtype).tobytes(), self.compressor))
+        os.replace(tmp, target)
+
+    def write_block(self, data: np.ndarray, origin: Optional[Sequence[int]] = None, workers: Optional[int] = None):
+        """Write a block whose origin and extent are aligned to chunk boundaries (or the array edge)."""
+        origin = tuple(origin) if origin is not None else (0,) * len(self.shape)
+        data = np.asarray(data)
+        if data.ndim != len(self.shape):
+            raise ValueError(f"Block has {data.ndim} dimensions, array has {len(self.shape)}")
+
+        ranges = []
+        for o, n, c, s in zip(origin, data.shape, self.chunks, self.shape):
+            end = o + n
+            if o % c or (end % c and end != s) or end > s:
+                raise ValueError(f"Block {origin}+{data.shape} is not aligned to chunks {self.chunks} of {self.shape}")
+            ranges.append(range(o // c, -(-end // c)))
+
+        def write_one(key):
+            sel = tuple(
+                slice(k * c - o, min((k + 1) * c, o + n) - o)
+                for k, c, o, n in zip(key, self.chunks, origin, data.shape)
+            )
+            self.write_chunk(key, data[sel])
+
+        with ThreadPoolExecutor(max_workers=workers or _default_workers()) as pool:
+            list(pool.map(write_one, product(*ranges)))
+
+    def read(self, selection: Optional[Sequence[Any]] = None, workers: Optional[int] = None) -> np.ndarray:
+        """
+        Read a selection; each entry is None (all), a slice (step 1) or a sequence of indices.
+        Only the chunks overlapping the selection are read and they are decoded in parallel.
+        """
+        selection = list(selection) if selection is not None else []
+        selection += [None] * (len(self.shape) - len(selection))
+
+        requested = []
+        for sel, size in zip(selection, self.shape):
+            if sel is None:
+                requested.append(np.arange(size))
+            elif isinstance(sel, slice):
+                start, stop, step = sel.indices(size)
+                if step != 1:
+                    raise ValueError("Strided selections are not supported")
+                requested.append(np.arange(start, stop))
+            else:
+                requested.append(np.asarray(sel, dtype=np.int64).reshape(-1))
+
+        out = np.empty(tuple(len(r) for r in requested), dtype=self.dtype)
+        if out.size == 0:
+            return out
+
+        # per dimension: chunk index -> (positions in output, positions within chunk)
+        plans = []
+        for idx, c in zip(requested, self.chunks):
+            plan = {}
+            for k in np.unique(idx // c):
+                positions = np.nonzero(idx // c == k)[0]
+                plan[int(k)] = (positions, idx[positions] - k * c)
+            plans.append(plan)
+
+        def read_one(key):
+            chunk = self.read_chunk(key)
+            dst = [plans[d][k][0] for d, k in enumerate(key)]
+            src = [plans[d][k][1] for d, k in enumerate(key)]
+            dst_idx = [_as_index(p) for p in dst]
+            src_idx = [_as_index(p) for p in src]
+            if not all(isinstance(i, slice) for i in dst_idx + src_idx):
+                out[np.ix_(*dst)] = chunk[np.ix_(*src)]
+            else:
+                out[tuple(dst_idx)] = chunk[tuple(src_idx)]
+
+        keys = list(product(*(sorted(plan) for plan in plans)))
+        with ThreadPoolExecutor(max_workers=workers or _default_workers()) as pool:
+            list(pool.map(read_one, keys))
+        return out
+
+
+class OMEZarrImage:
+    """Reader for an NGFF multiscale image group."""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        with open(self.path / '.zattrs') as f:
+            self.attrs = json.load(f)
+        if 'multiscales' not in self.attrs:
+            raise ValueError(f"No multiscales metadata in {self.path}")
+
+        multiscale = self.attrs['multiscales'][0]
+        self.axes = ''.join(axis['name'].upper() for axis in multiscale['axes'])
+        self.datasets = multiscale['datasets']
+        self.levels = [ZarrArray(self.path / ds['path']) for ds in self.datasets]
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.levels[0].shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.levels[0].dtype
+
+    @property
+    def channel_names(self) -> List[str]:
+        channels = self.attrs.get('omero', {}).get('channels', [])
+        return [channel.get('label', '') for channel in channels]
+
+    @property
+    def physical_size(self) -> Tuple[Optional[float], Optional[float]]:
+        """(PhysicalSizeX, PhysicalSizeY) of the base level in micrometers."""
+        for transform in self.datasets[0].get('coordinateTransformations', []):
+            if transform['type'] == 'scale':
+                scale = transform['scale']
+                return scale[self.axes.index('X')], scale[self.axes.index('Y')]
+        return None, None
+
+    @property
+    def ome_xml(self) -> Optional[str]:
+        path = self.path / OME_XML_PATH
+        return path.read_text() if path.exists() else None
+
+    def read(
+        self,
+        level: int = 0,
+        channels: Optional[Sequence[int]] = None,
+        region: Optional[Tuple[int, int, int, int]] = None,
+        workers: Optional[int] = None,
+    ) -> np.ndarray:
+        """
+        Read channels and region (y0, x0, y1, x1) of a level, in the store's axis order.
+        Cost is proportional to the chunks overlapping the request, not the image size.
+        """
+        selection = [None] * len(self.axes)
+        if channels is not None:
+            if 'C' not in self.axes:
+                raise ValueError(f"No channel axis in {self.axes}")
+            selection[self.axes.index('C')] = list(channels)
+        if region is not None:
+            y0, x0, y1, x1 = region
+            selection[self.axes.index('Y')] = slice(y0, y1)
+            selection[self.axes.index('X')] = slice(x0, x1)
+        return self.levels[level].read(selection, workers=workers)
+
+
+def _downsample_2x(data: np.ndarray, y_idx: int, x_idx: int) -> np.ndarray:
+    """Mean of 2x2 blocks over Y/X, dropping an odd trailing row/column."""
+    slices = [slice(None)] * data.ndim
+    slices[y_idx] = slice(0, data.shape[y_idx] // 2 * 2)
+    slices[x_idx] = slice(0, data.shape[x_idx] // 2 * 2)
+    data_cropped = data[tuple(slices)]
+
+    shape = []
+    for i, size in enumerate(data_cropped.shape):
+        shape.extend([size // 2, 2] if i in (y_idx, x_idx) else [size])
+    reduce_axes = (y_idx + 1, x_idx + 2) if y_idx < x_idx else (x_idx + 1, y_idx + 2)
+    downsampled = data_cropped.reshape(shape).mean(axis=reduce_axes)
+
+    if np.issubdtype(data.dtype, np.integer):
+        return np.round(downsampled).astype(data.dtype)
+    return downsampled.astype(data.dtype)
+
+
+def write_ome_zarr(
+    path: Union[str, Path],
+    data: np.ndarray,
+    axes: str,
+    channel_names: Optional[List[str]] = None,
+    physical_size: Tuple[Optional[float], Optional[float]] = (None, None),
+    chunk_yx: int = DEFAULT_CHUNK_YX,
+    levels: int = 1,
+    compression_level: int = DEFAULT_COMPRESSION_LEVEL,
+    ome_xml: Optional[str] = None,
+    workers: Optional[int] = None,
+) -> Path:
+    """
+    Write an array as an NGFF multiscale image with one chunk per channel and chunk_yx tiles.
+    Additional levels are 2x mean-downsampled.
+    """
+    path = Path(path)
+    axes = axes.upper()
+    if data.ndim != len(axes):
+        raise ValueError(f"Data has {data.ndim} dimensions but axes are {axes}")
+    if [a for a in 'TCZYX' if a in axes] != list(axes):
+        raise ValueError(f"NGFF requires axes in TCZYX order, got {axes}")
+
+    path.mkdir(parents=True, exist_ok=True)
+    with open(path / '.zgroup', 'w') as f:
+        json.dump({'zarr_format': 2}, f)
+
+    y_idx, x_idx = axes.index('Y'), axes.index('X')
+    chunks = [chunk_yx if a in 'YX' else 1 for a in axes]
+    physical_x, physical_y = physical_size
+
+    datasets = []
+    level_data = data
+    for level in range(levels):
+        factor = 2 ** level
+        array = ZarrArray.create(path / str(level), level_data.shape, level_data.dtype, chunks, compression_level)
+        array.write_block(level_data, workers=workers)
+
+        scale = [1.0] * len(axes)
+        if physical_x is not None:
+            scale[x_idx] = physical_x * factor
+        if physical_y is not None:
+            scale[y_idx] = physical_y * factor
+        datasets.append({
+            'path': str(level),
+            'coordinateTransformations': [{'type': 'scale', 'scale': scale}],
+        })
+
+        if level + 1 < levels:
+            level_data = _downsample_2x(level_data, y_idx, x_idx)
+
+    axes_meta = []
+    for a in axes:
+        axis = {'name': a.lower(), 'type': AXIS_TYPES[a]}
+        if a in 'YX' and physical_x is not None:
+            axis['unit'] = 'micrometer'
+        axes_meta.append(axis)
+
+    attrs = {
+        'multiscales': [{
+            'version': NGFF_VERSION,
+            'name': path.name,
+            'axes': axes_meta,
+            'datasets': datasets,
+            'type': 'mean',
+        }],
+    }
+    if channel_names:
+        attrs['omero'] = {
+            'version': NGFF_VERSION,
+            'channels': [{'label': name, 'active': True, 'color': 'FFFFFF'} for name in channel_names],
+        }
+    with open(path / '.zattrs', 'w') as f:
+        json.dump(attrs, f, indent=2)
+
+    if ome_xml:
+        (path / OME_XML_PATH).parent.mkdir(exist_ok=True)
+        (path / OME_XML_PATH).write_text(ome_xml)
+
+    return path
+
+
+def imread(path: Union[str, Path], level: int = 0) -> np.ndarray:
+    """Read a whole image level from an OME-Zarr store, or a TIFF with tifffile."""
+    if is_zarr(path):
+        return OMEZarrImage(path).read(level=level)
+    import tifffile
+    return tifffile.imread(path)
+
+
+def imwrite(
+    path: Union[str, Path],
+    data: np.ndarray,
+    axes: Optional[str] = None,
+    channel_names: Optional[List[str]] = None,
+    **kwargs,
+):
+    """Write a .zarr path as OME-Zarr, anything else as a minisblack TIFF."""
+    if str(path).rstrip('/').endswith('.zarr'):
+        if axes is None:
+            axes = {2: 'YX', 3: 'CYX', 4: 'CZYX', 5: 'TCZYX'}[data.ndim]
+        write_ome_zarr(path, data, axes, channel_names, **kwargs)
+    else:
+        import tifffile
+        tifffile.imwrite(path, data, photometric='minisblack')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect an OME-Zarr store or convert an OME-TIFF into one")
+    parser.add_argument('input', type=Path, help='Input OME-Zarr store or OME-TIFF')
+    parser.add_argument('-o', '--output', type=Path, help='Output .ome.zarr store (convert OME-TIFF input)')
+    parser.add_argument('--levels', type=int, default=1, help='Number of 2x pyramid levels to write (default: 1)')
+    parser.add_argument('--chunk', type=int, default=DEFAULT_CHUNK_YX, help=f'Y/X chunk size (default: {DEFAULT_CHUNK_YX})')
+    args = parser.parse_args()
+
+    if args.output is None:
+        image = OMEZarrImage(args.input)
+        print(f"Axes: {image.axes}, dtype: {image.dtype}")
+        for i, level in enumerate(image.levels):
+            print(f"  Level {i}: shape={level.shape}, chunks={level.chunks}")
+        print(f"Channels: {image.channel_names}")
+        print(f"PhysicalSize (X, Y): {image.physical_size}")
+        return
+
+    import tifffile
+    from ome_tiff_rescaler import OMETIFFRescaler
+
+    rescaler = OMETIFFRescaler(args.input, args.output)
+    with tifffile.TiffFile(args.input) as tif:
+        series = tif.series[0]
+        data = series.asarray()
+        axes, _, _ = rescaler.detect_axes_order(series.axes, data.shape)
+        physical_size = rescaler.extract_physical_size(tif)
+        channel_names = rescaler.extract_channel_info(tif)
+        ome_xml = tif.ome_metadata
+
+    if axes == 'YXC':
+        data = np.moveaxis(data, -1, 0)
+        axes = 'CYX'
+
+    write_ome_zarr(
+        args.output, data, axes, channel_names, physical_size,
+        chunk_yx=args.chunk, levels=args.levels, ome_xml=ome_xml,
+    )
+    print(f"Successfully wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -12,15 +12,155 @@ from typing import Optional, Tuple, Dict, Any, List
 import numpy as np
 import tifffile
 from xml.etree import ElementTree as ET
+from ngff_store import write_ome_zarr
+import perf
+from result_cache import add_arguments as add_cache_arguments, open_cache, run_cached
+
+
+OME_NS = {'ome': 'http://www.openmicroscopy.org/Schemas/OME/2016-06'}
+
+
+class PlannedLevel:
+    """
+    One pyramid level as found by the planner: geometry from the OME-XML and the level's
+    keyframe (first IFD) only, and how to find its pages when it is read.
+    """
+
+    def __init__(self, index: int, shape: Tuple[int, ...], dtype: np.dtype, axes: str,
+                 keyframe: Optional[tifffile.TiffPage], ifds: List[int] = (), subifd: Optional[int] = None,
+                 series_level: Any = None):
+        self.index = index
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.axes = axes
+        self.keyframe = keyframe
+        # IFDs of the level's planes, or of the base planes whose SubIFD `subifd` it is
+        self.ifds = list(ifds)
+        self.subifd = subifd
+        # tifffile series/level, for files the planner cannot lay out from the header
+        self.series_level = series_level
+
+    @property
+    def planes(self) -> int:
+        return max(1, len(self.ifds))
+
+    @property
+    def bytes_to_read(self) -> int:
+        """Compressed bytes of the level, from its keyframe's tile byte counts times its plane count."""
+        if self.keyframe is None:
+            return int(sum(sum(page.databytecounts) for page in self.series_level.pages if page is not None))
+        return int(sum(self.keyframe.databytecounts)) * self.planes
+
+    @property
+    def decoded_bytes(self) -> int:
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    @property
+    def layout(self) -> str:
+        page = self.keyframe if self.keyframe is not None else self.series_level.keyframe
+        if page.is_tiled:
+            segments = f"tiles {page.tilelength}x{page.tilewidth}"
+        else:
+            segments = f"strips of {page.rowsperstrip} rows"
+        return f"{segments}, {page.compression.name.lower()}"
+
+
+class PyramidPlan:
+    """
+    Pyramid levels, physical size and channels of an OME-TIFF, with the file kept open so
+    that the chosen level is read without parsing the file again. `info` is the level
+    selection of OMETIFFRescaler.plan_levels.
+    """
+
+    def __init__(self, tif: tifffile.TiffFile, levels: List[PlannedLevel], info: Dict[str, Any]):
+        self.tif = tif
+        self.levels = levels
+        self.info = info
+        self.ome_xml = tif.ome_metadata
+
+    def close(self):
+        self.tif.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def coarsest_level(self) -> PlannedLevel:
+        """The level with the fewest pixels."""
+        return min(self.levels, key=lambda level: int(np.prod(level.shape)))
+
+    def read_level(self, index: int, region: Optional[Tuple[int, int, int, int]] = None) -> np.ndarray:
+        """
+        Decode one level into an array of its planned shape, or only region (y0, x0, y1, x1)
+        of it, in which case only the tiles or strips overlapping the region are decoded.
+        """
+        level = self.levels[index]
+        if level.series_level is not None:
+            data = level.series_level.asarray()
+            if region is None:
+                return data
+            y0, x0, y1, x1 = region
+            index = [slice(None)] * data.ndim
+            index[level.axes.index('Y')] = slice(y0, y1)
+            index[level.axes.index('X')] = slice(x0, x1)
+            return data[tuple(index)]
+
+        fh = self.tif.filehandle
+        keyframe = level.keyframe
+        if region is None:
+            region = (0, 0, keyframe.imagelength, keyframe.imagewidth)
+        y0, x0, y1, x1 = region
+        out = np.zeros((level.planes, y1 - y0, x1 - x0) + keyframe.shape[2:], dtype=keyframe.dtype)
+        whole = region == (0, 0, keyframe.imagelength, keyframe.imagewidth)
+        for p, ifd in enumerate(level.ifds):
+            page = self.tif.pages[ifd]
+            if level.subifd is not None:
+                fh.seek(page.subifds[level.subifd])
+                page = tifffile.TiffPage(self.tif, index=(ifd, level.subifd))
+            if whole:
+                page.asarray(out=out[p])
+            else:
+                self._read_page_region(page, region, out[p])
+
+        y_idx = level.axes.index('Y')
+        shape = level.shape[:y_idx] + (y1 - y0, x1 - x0) + level.shape[y_idx + 2:]
+        return out.reshape(shape)
+
+    def _read_page_region(self, page: tifffile.TiffPage, region: Tuple[int, int, int, int], out: np.ndarray):
+        y0, x0, y1, x1 = region
+        if page.is_tiled:
+            th, tw = page.tilelength, page.tilewidth
+        else:
+            th, tw = min(page.rowsperstrip, page.imagelength), page.imagewidth
+        columns = -(-page.imagewidth // tw)
+        fh = self.tif.filehandle
+        for ty in range(y0 // th, -(-y1 // th)):
+            for tx in range(x0 // tw, -(-x1 // tw)):
+                index = ty * columns + tx
+                if not page.databytecounts[index]:
+                    continue
+                fh.seek(page.dataoffsets[index])
+                data = fh.read(page.databytecounts[index])
+                segment = page.decode(data, index, jpegtables=page.jpegtables)[0][0]
+                if page.samplesperpixel == 1:
+                    segment = segment[..., 0]
+                sy, sx = ty * th, tx * tw
+                ry0, ry1 = max(y0, sy), min(y1, sy + segment.shape[0])
+                rx0, rx1 = max(x0, sx), min(x1, sx + segment.shape[1])
+                out[ry0 - y0:ry1 - y0, rx0 - x0:rx1 - x0] = segment[ry0 - sy:ry1 - sy, rx0 - sx:rx1 - sx]
 
 
 class OMETIFFRescaler:
     """Rescale OME-TIFF to 1:1 micron-to-pixel ratio using optimal pyramid level."""
 
-    def __init__(self, input_path: Path, output_path: Path, target_micron_per_pixel: float = 1.0):
+    def __init__(self, input_path: Path, output_path: Path, target_micron_per_pixel: float = 1.0,
+                 crop_to_tissue: bool = False):
         self.input_path = Path(input_path)
         self.output_path = Path(output_path)
         self.target_mpp = target_micron_per_pixel
+        self.crop_to_tissue = crop_to_tissue
         self.metadata = {}
 
         logging.basicConfig(
@@ -62,86 +202,92 @@ class OMETIFFRescaler:
             root = ET.fromstring(tif.ome_metadata)
             ns = {'ome': 'http://www.openmicroscopy.org/Schemas/OME/2016-06'}
 
-            for channel in root.findall('.//ome:Channel', ns):
+            # only the first image; series pyramids describe each level as another image
+            image = root.find('ome:Image', ns)
+            for channel in (image if image is not None else root).findall('.//ome:Channel', ns):
                 channel_names.append(channel.get('Name', ''))
         except Exception as e:
             self.logger.error(f"Failed to parse channel info: {e}")
 
         return channel_names
 
-    def extract_and_modify_ome_xml(self, new_shape: tuple, new_mpp: float, final_axes: str) -> Optional[str]:
-        """Extract OME-XML from input and modify for new dimensions and physical size."""
-        with tifffile.TiffFile(self.input_path) as tif:
-            if not tif.ome_metadata:
-                self.logger.warning("No OME metadata to preserve")
-                return None
-
-            try:
-                # Register namespace to avoid ns0: prefixes
-                ns = {'ome': 'http://www.openmicroscopy.org/Schemas/OME/2016-06'}
-                ET.register_namespace('', ns['ome'])
+    def extract_and_modify_ome_xml(self, ome_xml: Optional[str], new_shape: tuple, new_mpp: float,
+                                   final_axes: str) -> Optional[str]:
+        """Modify the input's OME-XML (e.g. PyramidPlan.ome_xml) for new dimensions and physical size."""
+        if not ome_xml:
+            self.logger.warning("No OME metadata to preserve")
+            return None
 
-                root = ET.fromstring(tif.ome_metadata)
-
-                pixels = root.find('.//ome:Pixels', ns)
-                if pixels is not None:
-                    pixels.set('PhysicalSizeX', str(new_mpp))
-                    pixels.set('PhysicalSizeY', str(new_mpp))
-                    pixels.set('PhysicalSizeXUnit', 'um')
-                    pixels.set('PhysicalSizeYUnit', 'um')
-
-                    y_idx = final_axes.index('Y') if 'Y' in final_axes else -2
-                    x_idx = final_axes.index('X') if 'X' in final_axes else -1
+        try:
+            # Register namespace to avoid ns0: prefixes
+            ns = {'ome': 'http://www.openmicroscopy.org/Schemas/OME/2016-06'}
+            ET.register_namespace('', ns['ome'])
 
-                    pixels.set('SizeX', str(new_shape[x_idx]))
-                    pixels.set('SizeY', str(new_shape[y_idx]))
+            root = ET.fromstring(ome_xml)
+            # the output holds the first series only
+            for image in root.findall('ome:Image', ns)[1:]:
+                root.remove(image)
 
-                    if 'C' in final_axes:
-                        c_idx = final_axes.index('C')
-                        pixels.set('SizeC', str(new_shape[c_idx]))
-                    else:
-                        pixels.set('SizeC', '1')
-
-                    channels = pixels.findall('.//ome:Channel', ns)
-                    existing_channels = len(channels)
-                    expected_channels = len(self.metadata.get("channel_names", []))
-
-                    if expected_channels > 0:
-                        if existing_channels != expected_channels:
-                            self.logger.warning(f"Adjusting channel count from {existing_channels} to {expected_channels}")
-                            for ch in channels:
-                                pixels.remove(ch)
-                            for i, name in enumerate(self.metadata["channel_names"]):
-                                ch_elem = ET.SubElement(
-                                    pixels, "Channel",
-                                    attrib={"ID": f"Channel:{i}", "Name": name}
-                                )
-                                ET.SubElement(ch_elem, "LightPath")
-                        else:
-                            for ch_elem, name in zip(channels, self.metadata["channel_names"]):
-                                ch_elem.set("Name", name)
-
-                    if 'Z' in final_axes:
-                        z_idx = final_axes.index('Z')
-                        pixels.set('SizeZ', str(new_shape[z_idx]))
+            pixels = root.find('.//ome:Pixels', ns)
+            if pixels is not None:
+                pixels.set('PhysicalSizeX', str(new_mpp))
+                pixels.set('PhysicalSizeY', str(new_mpp))
+                pixels.set('PhysicalSizeXUnit', 'um')
+                pixels.set('PhysicalSizeYUnit', 'um')
+
+                y_idx = final_axes.index('Y') if 'Y' in final_axes else -2
+                x_idx = final_axes.index('X') if 'X' in final_axes else -1
+
+                pixels.set('SizeX', str(new_shape[x_idx]))
+                pixels.set('SizeY', str(new_shape[y_idx]))
+
+                if 'C' in final_axes:
+                    c_idx = final_axes.index('C')
+                    pixels.set('SizeC', str(new_shape[c_idx]))
+                else:
+                    pixels.set('SizeC', '1')
+
+                channels = pixels.findall('.//ome:Channel', ns)
+                existing_channels = len(channels)
+                expected_channels = len(self.metadata.get("channel_names", []))
+
+                if expected_channels > 0:
+                    if existing_channels != expected_channels:
+                        self.logger.warning(f"Adjusting channel count from {existing_channels} to {expected_channels}")
+                        for ch in channels:
+                            pixels.remove(ch)
+                        for i, name in enumerate(self.metadata["channel_names"]):
+                            ch_elem = ET.SubElement(
+                                pixels, "Channel",
+                                attrib={"ID": f"Channel:{i}", "Name": name}
+                            )
+                            ET.SubElement(ch_elem, "LightPath")
                     else:
-                        pixels.set('SizeZ', '1')
+                        for ch_elem, name in zip(channels, self.metadata["channel_names"]):
+                            ch_elem.set("Name", name)
 
-                    if 'T' in final_axes:
-                        t_idx = final_axes.index('T')
-                        pixels.set('SizeT', str(new_shape[t_idx]))
-                    else:
-                        pixels.set('SizeT', '1')
+                if 'Z' in final_axes:
+                    z_idx = final_axes.index('Z')
+                    pixels.set('SizeZ', str(new_shape[z_idx]))
+                else:
+                    pixels.set('SizeZ', '1')
 
-                    pixels.set('DimensionOrder', final_axes)
+                if 'T' in final_axes:
+                    t_idx = final_axes.index('T')
+                    pixels.set('SizeT', str(new_shape[t_idx]))
+                else:
+                    pixels.set('SizeT', '1')
 
-                modified_xml = ET.tostring(root, encoding='unicode')
-                self.logger.info(f"Successfully modified OME-XML metadata (DimensionOrder={final_axes})")
-                return modified_xml
+                pixels.set('DimensionOrder', final_axes)
 
-            except Exception as e:
-                self.logger.error(f"Failed to modify OME-XML: {e}")
-                return None
+            # TIFF descriptions must be 7-bit ASCII, so e.g. the µ of PhysicalSizeXUnit becomes &#181;
+            modified_xml = ET.tostring(root, encoding='unicode').encode('ascii', 'xmlcharrefreplace').decode('ascii')
+            self.logger.info(f"Successfully modified OME-XML metadata (DimensionOrder={final_axes})")
+            return modified_xml
+
+        except Exception as e:
+            self.logger.error(f"Failed to modify OME-XML: {e}")
+            return None
 
     def detect_axes_order(self, ome_axes: Optional[str], shape: Tuple[int, ...]) -> Tuple[str, int, int]:
         """
@@ -176,78 +322,199 @@ class OMETIFFRescaler:
 
     def analyze_pyramid_scales(self) -> Dict[str, Any]:
         """Analyze pyramid levels and their effective scales."""
-        self.logger.info(f"Analyzing {self.input_path}")
+        with self.plan_pyramid() as plan:
+            return plan.info
 
-        pyramid_info = {
-            'levels': [],
-            'physical_size_x': None,
-            'physical_size_y': None,
-            'channel_names': [],
-            'optimal_level': None
-        }
+    def plan_pyramid(self) -> PyramidPlan:
+        """
+        Plan the pyramid from the OME-XML and one keyframe per level, without parsing the
+        other IFDs. The returned plan keeps the file open for extract_and_rescale.
+        """
+        self.logger.info(f"Analyzing {self.input_path}")
 
-        with tifffile.TiffFile(self.input_path) as tif:
+        tif = tifffile.TiffFile(self.input_path)
+        try:
             physical_x, physical_y = self.extract_physical_size(tif)
-            pyramid_info['physical_size_x'] = physical_x
-            pyramid_info['physical_size_y'] = physical_y
-
             channel_names = self.extract_channel_info(tif)
-            pyramid_info['channel_names'] = channel_names
 
-            if physical_x is None:
-                raise ValueError("Cannot extract PhysicalSizeX from OME metadata")
+            levels = self._header_levels(tif)
+            if levels is None:
+                self.logger.info("Pyramid layout not fully described by the OME header, reading all series")
+                levels = self._series_levels(tif)
+
+            info = self.plan_levels(
+                physical_x, physical_y, channel_names,
+                [(level.index, level.shape, level.dtype, level.axes) for level in levels],
+            )
+        except Exception:
+            tif.close()
+            raise
 
-            self.logger.info(f"Base PhysicalSizeX: {physical_x} µm/pixel")
+        for level_info, level in zip(info['levels'], levels):
+            level_info['bytes_to_read'] = level.bytes_to_read
+            level_info['decoded_bytes'] = level.decoded_bytes
+            level_info['layout'] = level.layout
+        return PyramidPlan(tif, levels, info)
 
-            series = tif.series[0]
-            detected_axes, y_idx, x_idx = self.detect_axes_order(series.axes, series.shape)
+    def _header_levels(self, tif: tifffile.TiffFile) -> Optional[List[PlannedLevel]]:
+        """
+        Levels from the OME-XML: every Image is a level (as with several series), and a
+        single Image's SubIFDs are its reduced levels. Only the first IFD of each level is
+        parsed. Returns None for layouts that need tifffile's full series parsing
+        (multi-file datasets, planes out of IFD order, separate sample planes).
+        """
+        if not tif.is_ome:
+            return None
+        try:
+            root = ET.fromstring(tif.ome_metadata)
+        except ET.ParseError:
+            return None
 
-            base_size_x = series.shape[x_idx]
+        levels = []
+        for image in root.findall('ome:Image', OME_NS):
+            pixels = image.find('ome:Pixels', OME_NS)
+            if pixels is None:
+                return None
+            sizes = {a: int(pixels.get(f'Size{a}', 1)) for a in 'XYCZT'}
+            # outer axes, slowest first, e.g. XYCZT -> TZC
+            outer = pixels.get('DimensionOrder', 'XYCZT')[:1:-1]
 
-            ### NOTE: forcing to use series0, since the assumption of existing pyramid image with 2X scaling is not always met, it could use 4X or others,
-            ###       so proper fix would need to calculate scale factor from the series dimension directly.
-            ###
-            if len(tif.series) > 1:
-               levels_to_check = [(i, s) for i, s in enumerate(tif.series)]
-            elif hasattr(series, 'levels') and series.levels:
-               levels_to_check = [(i, level) for i, level in enumerate(series.levels)]
-            else:
-                levels_to_check = [(0, series)]
+            tiffdata = pixels.findall('ome:TiffData', OME_NS)
+            if not tiffdata:
+                return None
+            first_ifd = int(tiffdata[0].get('IFD', 0))
+            keyframe = tif.pages[first_ifd]
+            samples = keyframe.samplesperpixel
+            if samples > 1 and (keyframe.planarconfig != 1 or sizes['C'] % samples):
+                return None
+            sizes['C'] //= samples
+            if (keyframe.imagelength, keyframe.imagewidth) != (sizes['Y'], sizes['X']):
+                return None
 
-            for level_idx, level in levels_to_check:
+            # planes must be stored in DimensionOrder from the first IFD on
+            strides = {}
+            stride = 1
+            for a in outer[::-1]:
+                strides[a] = stride
+                stride *= sizes[a]
+            planes = stride
+            covered = 0
+            for block in tiffdata:
+                uuid = block.find('ome:UUID', OME_NS)
+                if uuid is not None and uuid.get('FileName') not in (None, self.input_path.name):
+                    return None
+                plane = sum(int(block.get(f'First{a}', 0)) * strides[a] for a in outer)
+                # PlaneCount defaults to 1 with an IFD, otherwise to all planes
+                count = int(block.get('PlaneCount', 1 if 'IFD' in block.attrib else planes))
+                if int(block.get('IFD', 0)) - first_ifd != plane or plane != covered:
+                    return None
+                covered += count
+            if covered != planes:
+                return None
 
-                ome_axes = level.axes if hasattr(level, 'axes') else (series.axes if hasattr(series, 'axes') else '')
-                detected_axes, y_idx, x_idx = self.detect_axes_order(ome_axes, level.shape)
+            kept = [a for a in outer if sizes[a] > 1]
+            axes = ''.join(kept) + 'YX' + ('S' if samples > 1 else '')
+            shape = tuple(sizes[a] for a in kept) + (sizes['Y'], sizes['X']) + ((samples,) if samples > 1 else ())
+            ifds = range(first_ifd, first_ifd + planes)
+            levels.append(PlannedLevel(len(levels), shape, keyframe.dtype, axes, keyframe, ifds))
+
+        if len(levels) == 1:
+            base = levels[0]
+            fh = tif.filehandle
+            for k, offset in enumerate(base.keyframe.subifds or ()):
+                fh.seek(offset)
+                keyframe = tifffile.TiffPage(tif, index=(base.ifds[0], k))
+                outer = len(base.axes.rstrip('S')) - 2
+                shape = base.shape[:outer] + (keyframe.imagelength, keyframe.imagewidth) + base.shape[outer + 2:]
+                levels.append(PlannedLevel(k + 1, shape, keyframe.dtype, base.axes, keyframe, base.ifds, subifd=k))
+        return levels or None
+
+    def _series_levels(self, tif: tifffile.TiffFile) -> List[PlannedLevel]:
+        series = tif.series[0]
+
+        ### NOTE: forcing to use series0, since the assumption of existing pyramid image with 2X scaling is not always met, it could use 4X or others,
+        ###       so proper fix would need to calculate scale factor from the series dimension directly.
+        ###
+        if len(tif.series) > 1:
+           levels_to_check = [(i, s) for i, s in enumerate(tif.series)]
+        elif hasattr(series, 'levels') and series.levels:
+           levels_to_check = [(i, level) for i, level in enumerate(series.levels)]
+        else:
+            levels_to_check = [(0, series)]
+
+        return [
+            PlannedLevel(
+                level_idx,
+                level.shape,
+                getattr(level, 'dtype', None),
+                level.axes if hasattr(level, 'axes') else (series.axes if hasattr(series, 'axes') else ''),
+                keyframe=None,
+                series_level=level,
+            )
+            for level_idx, level in levels_to_check
+        ]
+
+    def plan_levels(
+        self,
+        physical_x: Optional[float],
+        physical_y: Optional[float],
+        channel_names: List[str],
+        levels: List[Tuple[int, Tuple[int, ...], Any, str]],
+    ) -> Dict[str, Any]:
+        """
+        Compute effective scales and select the optimal level from already known level geometry.
+        levels: (level_index, shape, dtype, axes) per pyramid level, base level first.
+        """
+        pyramid_info = {
+            'levels': [],
+            'physical_size_x': physical_x,
+            'physical_size_y': physical_y,
+            'channel_names': channel_names,
+            'optimal_level': None
+        }
 
-                scale_factor_ratio = base_size_x / level.shape[x_idx]
-                scale_factor = int(np.floor(scale_factor_ratio + 0.5))
+        if physical_x is None:
+            raise ValueError("Cannot extract PhysicalSizeX from OME metadata")
 
-                effective_mpp = physical_x * scale_factor
-                ratio = self.target_mpp / effective_mpp
-                integer_scale = int(np.floor(ratio + 0.5))
-                final_mpp = effective_mpp * integer_scale
+        self.logger.info(f"Base PhysicalSizeX: {physical_x} µm/pixel")
 
-                level_info = {
-                    'level': level_idx,
-                    'shape': level.shape,
-                    'dtype': getattr(level, 'dtype', None),
-                    'axes': detected_axes,
-                    'y_index': y_idx,
-                    'x_index': x_idx,
-                    'scale_factor': scale_factor,
-                    'effective_mpp': effective_mpp,
-                    'additional_scale_integer': integer_scale,
-                    'final_mpp': final_mpp,
-                    'scale_error': abs(final_mpp - self.target_mpp)
-                }
+        _, base_shape, _, base_axes = levels[0]
+        detected_axes, y_idx, x_idx = self.detect_axes_order(base_axes, base_shape)
+        base_size_x = base_shape[x_idx]
 
-                pyramid_info['levels'].append(level_info)
+        for level_idx, shape, dtype, ome_axes in levels:
 
-                self.logger.info(
-                    f"Level {level_idx}: shape={level.shape}, axes={detected_axes}, "
-                    f"scale={scale_factor}x, effective_mpp={effective_mpp:.4f}, "
-                    f"int_scale_needed={integer_scale}, final_mpp={final_mpp:.4f}"
-                )
+            detected_axes, y_idx, x_idx = self.detect_axes_order(ome_axes, shape)
+
+            scale_factor_ratio = base_size_x / shape[x_idx]
+            scale_factor = int(np.floor(scale_factor_ratio + 0.5))
+
+            effective_mpp = physical_x * scale_factor
+            ratio = self.target_mpp / effective_mpp
+            integer_scale = int(np.floor(ratio + 0.5))
+            final_mpp = effective_mpp * integer_scale
+
+            level_info = {
+                'level': level_idx,
+                'shape': shape,
+                'dtype': dtype,
+                'axes': detected_axes,
+                'y_index': y_idx,
+                'x_index': x_idx,
+                'scale_factor': scale_factor,
+                'effective_mpp': effective_mpp,
+                'additional_scale_integer': integer_scale,
+                'final_mpp': final_mpp,
+                'scale_error': abs(final_mpp - self.target_mpp)
+            }
+
+            pyramid_info['levels'].append(level_info)
+
+            self.logger.info(
+                f"Level {level_idx}: shape={shape}, axes={detected_axes}, "
+                f"scale={scale_factor}x, effective_mpp={effective_mpp:.4f}, "
+                f"int_scale_needed={integer_scale}, final_mpp={final_mpp:.4f}"
+            )
 
         best_level = self._select_optimal_level(pyramid_info['levels'])
         pyramid_info['optimal_level'] = best_level
@@ -307,26 +574,29 @@ class OMETIFFRescaler:
         )
         return best_level
 
-    def extract_and_rescale(self) -> np.ndarray:
+    def extract_and_rescale(self, plan: Optional[PyramidPlan] = None) -> np.ndarray:
         """Extract optimal level and rescale to target if needed."""
-        if not self.metadata:
-            self.analyze_pyramid_scales()
+        if plan is None:
+            with self.plan_pyramid() as plan:
+                return self.extract_and_rescale(plan)
 
         optimal_level = self.metadata['optimal_level']
         level_info = self.metadata['levels'][optimal_level]
         integer_scale = level_info['additional_scale_integer']
 
-        self.logger.info(f"Extracting level {optimal_level}")
+        self.logger.info(f"Extracting level {optimal_level} ({level_info['bytes_to_read'] / 2**20:.1f} MiB to read)")
 
-        with tifffile.TiffFile(self.input_path) as tif:
-            series = tif.series[0]
+        region = None
+        if self.crop_to_tissue:
+            coarse = plan.coarsest_level()
+            with perf.phase('detect_tissue'):
+                image = plan.read_level(coarse.index)
+                perf.add('pixels_decoded', image.size)
+                region = self.tissue_region(image, coarse.axes, level_info)
 
-            if len(tif.series) > 1 and optimal_level < len(tif.series):
-                data = tif.series[optimal_level].asarray()
-            elif hasattr(series, 'levels') and series.levels and optimal_level < len(series.levels):
-                data = series.levels[optimal_level].asarray()
-            else:
-                data = series.asarray()
+        with perf.phase('read'):
+            data = plan.read_level(optimal_level, region)
+            perf.add('pixels_decoded', data.size)
 
         self.logger.info(f"Extracted shape: {data.shape}, dtype: {data.dtype}")
 
@@ -335,15 +605,52 @@ class OMETIFFRescaler:
             return data
 
         self.logger.info(f"Downsampling by integer factor {integer_scale}")
-        data = self._downsample_integer(
-            data,
-            integer_scale,
-            level_info['y_index'],
-            level_info['x_index']
-        )
+        with perf.phase('downsample'):
+            data = self._downsample_integer(
+                data,
+                integer_scale,
+                level_info['y_index'],
+                level_info['x_index']
+            )
 
         return data
 
+    def tissue_region(self, coarse: np.ndarray, coarse_axes: str, level_info: Dict) -> Optional[Tuple[int, int, int, int]]:
+        """
+        Tissue bounding box (y0, x0, y1, x1) on the level being extracted, detected on a coarse
+        image of the same slide, or None to keep the whole level. The crop is recorded in
+        self.metadata['tissue_crop'] for the JSON sidecar.
+        """
+        from tissue_detection import detect_tissue, scale_bbox
+
+        tissue = detect_tissue(coarse, coarse_axes)
+        if tissue['bbox'] is None:
+            self.logger.warning("No tissue found on the coarse level, keeping the whole image")
+            return None
+
+        shape = level_info['shape']
+        level_yx = (shape[level_info['y_index']], shape[level_info['x_index']])
+        integer_scale = level_info['additional_scale_integer']
+        # the origin stays on the downsampling grid, so output pixels match the uncropped output
+        region = scale_bbox(tissue['bbox'], tissue['mask'].shape, level_yx, align=integer_scale)
+        y0, x0, y1, x1 = region
+        scale = level_info['scale_factor']
+        base = self.metadata['levels'][0]
+        base_y, base_x = base['shape'][base['y_index']], base['shape'][base['x_index']]
+        self.metadata['tissue_crop'] = {
+            'level_bbox': [y0, x0, y1, x1],
+            'original_bbox': [y0 * scale, x0 * scale, min(base_y, y1 * scale), min(base_x, x1 * scale)],
+            'output_offset_y': y0 // integer_scale,
+            'output_offset_x': x0 // integer_scale,
+            'tissue_fraction': round(tissue['tissue_fraction'], 4),
+            'kept_fraction': round((y1 - y0) * (x1 - x0) / (level_yx[0] * level_yx[1]), 4),
+        }
+        self.logger.info(
+            f"Cropping level to tissue {region} ({self.metadata['tissue_crop']['kept_fraction']:.1%} of the image, "
+            f"tissue covers {tissue['tissue_fraction']:.1%})"
+        )
+        return region
+
     def _downsample_integer(self, data: np.ndarray, factor: int, y_idx: int, x_idx: int) -> np.ndarray:
         """Downsample by integer factor using block averaging for spatial dims only."""
         if factor == 1:
@@ -389,8 +696,8 @@ class OMETIFFRescaler:
         self.logger.info(f"Downsampled shape: {data_downsampled.shape}")
         return data_downsampled
 
-    def save_output(self, data: np.ndarray):
-        """Save rescaled image with corrected metadata."""
+    def save_output(self, data: np.ndarray, ome_xml: Optional[str]):
+        """Save rescaled image with corrected metadata; ome_xml is the input's OME-XML."""
         level_info = self.metadata['levels'][self.metadata['optimal_level']]
         final_mpp = level_info['final_mpp']
         original_axes = level_info['axes']
@@ -410,7 +717,7 @@ class OMETIFFRescaler:
 
         self.logger.info(f"Final shape after normalization: {data.shape}, axes: {normalized_axes}")
 
-        ome_xml = self.extract_and_modify_ome_xml(data.shape, final_mpp, normalized_axes)
+        ome_xml = self.extract_and_modify_ome_xml(ome_xml, data.shape, final_mpp, normalized_axes)
 
         estimated_size = data.nbytes
         use_bigtiff = estimated_size > 3.5 * (1024**3)
@@ -418,19 +725,30 @@ class OMETIFFRescaler:
         self.logger.info(f"Saving to {self.output_path}")
         self.logger.info(f"Output shape: {data.shape}, size: {estimated_size/(1024**3):.2f}GB")
 
-        self.logger.info(f"Writing OME-TIFF with axes='{normalized_axes}'")
-
-        tifffile.imwrite(
-            self.output_path,
-            data,
-            photometric='minisblack',
-            compression='deflate',
-            compressionargs={'level': 6},
-            tile=(256, 256),
-            bigtiff=use_bigtiff,
-            description=ome_xml,
-            metadata={'axes': 'CYX'},
-        )
+        if self.output_path.suffix == '.zarr':
+            self.logger.info(f"Writing OME-Zarr with axes='{normalized_axes}'")
+            write_ome_zarr(
+                self.output_path,
+                data,
+                normalized_axes,
+                channel_names=self.metadata.get('channel_names', []),
+                physical_size=(final_mpp, final_mpp),
+                ome_xml=ome_xml,
+            )
+        else:
+            self.logger.info(f"Writing OME-TIFF with axes='{normalized_axes}'")
+
+            tifffile.imwrite(
+                self.output_path,
+                data,
+                photometric='minisblack',
+                compression='deflate',
+                compressionargs={'level': 6},
+                tile=(256, 256),
+                bigtiff=use_bigtiff,
+                description=ome_xml,
+                metadata={'axes': 'CYX'},
+            )
 
         metadata_path = self.output_path.with_suffix('.json')
         with open(metadata_path, 'w') as f:
@@ -447,7 +765,10 @@ class OMETIFFRescaler:
                 'output_shape': list(data.shape),
                 'output_axes': normalized_axes,
                 'original_axes': original_axes,
-                'channel_names': self.metadata.get('channel_names', [])
+                'channel_names': self.metadata.get('channel_names', []),
+                # output pixel (y, x) is original pixel ((y + output_offset_y) * f, (x + output_offset_x) * f),
+                # f = pyramid_scale_factor * integer_scale_applied; null when not cropped
+                'tissue_crop': self.metadata.get('tissue_crop'),
             }, f, indent=2)
 
         self.logger.info(f"Metadata saved to {metadata_path}")
@@ -456,9 +777,12 @@ class OMETIFFRescaler:
         """Main processing pipeline."""
         try:
 
-            self.analyze_pyramid_scales()
-            data = self.extract_and_rescale()
-            self.save_output(data)
+            with perf.phase('analyze'):
+                plan = self.plan_pyramid()
+            with plan:
+                data = self.extract_and_rescale(plan)
+            with perf.phase('save'):
+                self.save_output(data, plan.ome_xml)
 
             self.logger.info("Processing complete")
             return self.output_path
@@ -480,16 +804,33 @@ def main():
         default=1.0,
         help='Target microns per pixel (default: 1.0)'
     )
+    parser.add_argument(
+        '--output-format',
+        choices=['tiff', 'zarr'],
+        default='tiff',
+        help='Write the rescaled image as OME-TIFF or as a chunked OME-Zarr store (default: tiff)'
+    )
+    parser.add_argument(
+        '--crop-to-tissue',
+        action='store_true',
+        help='Detect the tissue on the smallest pyramid level and only read and write its bounding box; '
+             'the offsets are recorded in the JSON sidecar'
+    )
     parser.add_argument(
         '--analyze-only',
         action='store_true',
         help='Only analyze pyramid structure'
     )
 
+    perf.add_argument(parser)
+    add_cache_arguments(parser)
+
     args = parser.parse_args()
+    perf.enable(args.perf)
 
-    output_path = Path(f"{args.prefix}.downscaled.ome.tiff")
-    rescaler = OMETIFFRescaler(args.input, output_path, args.target_mpp)
+    extension = 'ome.zarr' if args.output_format == 'zarr' else 'ome.tiff'
+    output_path = Path(f"{args.prefix}.downscaled.{extension}")
+    rescaler = OMETIFFRescaler(args.input, output_path, args.target_mpp, args.crop_to_tissue)
 
     if args.analyze_only:
         info = rescaler.analyze_pyramid_scales()
@@ -503,10 +844,26 @@ def main():
             print(f"    Effective MPP: {level['effective_mpp']:.4f}")
             print(f"    Integer scale needed: {level['additional_scale_integer']}")
             print(f"    Final MPP: {level['final_mpp']:.4f}")
-        print(f"\nOptimal level: {info['optimal_level']}")
+            print(f"    Layout: {level['layout']}")
+            print(f"    Bytes to read: {level['bytes_to_read'] / 2**20:.1f} MiB ({level['decoded_bytes'] / 2**20:.1f} MiB decoded)")
+        optimal = info['levels'][info['optimal_level']]
+        print(f"\nOptimal level: {info['optimal_level']} ({optimal['bytes_to_read'] / 2**20:.1f} MiB to read)")
     else:
-        output_path = rescaler.process()
+        # the JSON sidecar records the input path as given, so it is part of the key
+        run_cached(
+            open_cache(args.cache_dir, args.cache_max_size),
+            inputs=[args.input],
+            params={
+                'target_mpp': args.target_mpp,
+                'output_format': args.output_format,
+                'input_path': str(args.input),
+                'crop_to_tissue': args.crop_to_tissue,
+            },
+            outputs={'image': output_path, 'metadata': output_path.with_suffix('.json')},
+            func=rescaler.process,
+        )
         print(f"Successfully created rescaled image: {output_path}")
+        perf.write(output_path)
 
 
 if __name__ == '__main__':
@@ -4,29 +4,48 @@
 # Version: 0.0.1
 
 import argparse
+import io
 import tifffile
 import numpy as np
-from skimage.filters import threshold_otsu, gaussian  # ADD gaussian import
-from skimage.restoration import rolling_ball
-import matplotlib.pyplot as plt
-from typing import Optional, Tuple  # ADD type hints
+from skimage.filters import threshold_otsu
+from typing import Iterator, List, Optional, Tuple  # ADD type hints
+from ngff_store import OMEZarrImage, is_zarr
+import perf
+from result_cache import add_arguments as add_cache_arguments, open_cache, run_cached
 
 
+# gaussian, rolling_ball and matplotlib are imported where they are used, so that a
+# run only pays the import time of the method it asks for
+
 def remove_background_gaussian(img: np.ndarray, sigma: float) -> np.ndarray:
+    from skimage.filters import gaussian
     background = gaussian(img, sigma=sigma)
     img_bg_subtracted = img - background
     return np.clip(img_bg_subtracted, 0, None)
 
 def remove_background_rollingball(img: np.ndarray, radius: int) -> np.ndarray:
+    from skimage.restoration import rolling_ball
     background = rolling_ball(img, radius=radius)
     img_bg_subtracted = img - background
     return np.clip(img_bg_subtracted, 0, None)
 
-def remove_background_af(img: np.ndarray, af_img: np.ndarray) -> np.ndarray:
+def subtract_af(img: np.ndarray, af_img: np.ndarray, scale: float = 1.0) -> np.ndarray:
+    """max(img - scale * af_img, 0) in the dtype of img, without unsigned wrap-around."""
+    if scale == 1.0 and af_img.dtype == img.dtype:
+        # img - min(img, af) never underflows and needs no wider temporary
+        return img - np.minimum(img, af_img)
+    out = img.astype(np.float32)
+    out -= np.float32(scale) * af_img
+    np.clip(out, 0, None, out=out)
+    if np.issubdtype(img.dtype, np.integer):
+        np.rint(out, out=out)
+    return out.astype(img.dtype, copy=False)
+
+def remove_background_af(img: np.ndarray, af_img: np.ndarray, scale: float = 1.0) -> np.ndarray:
     if img.shape != af_img.shape:
         raise ValueError(f"Shape mismatch: DAPI {img.shape} vs AF {af_img.shape}")
 
-    newimg = np.clip(img - af_img, 0, None)
+    newimg = subtract_af(img, af_img, scale)
     # Check if image has any valid data
     if np.all(newimg == 0):
         raise ValueError("DAPI channel contains only zeros after AF subtraction")
@@ -52,8 +71,13 @@ def save_diagnostic_png(
     post_binary: np.ndarray,
     otsu_thresh: float,
     adjusted_thresh: float,
-    output_path: str
+    output_path: str,
+    hist: Optional[Tuple[np.ndarray, np.ndarray]] = None
 ):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
     fig, axes = plt.subplots(1, 3, figsize=(15, 5))
 
     axes[0].imshow(pre_binary, cmap='gray')
@@ -64,7 +88,12 @@ def save_diagnostic_png(
     axes[1].set_title('Post-binarisation')
     axes[1].axis('off')
 
-    axes[2].hist(pre_binary.ravel(), bins=256, color='gray', alpha=0.7)
+    if hist is not None:
+        # same 256 bins over the data range, from the (counts, values) histogram already collected
+        counts, values = hist
+        axes[2].hist(values, bins=256, weights=counts, color='gray', alpha=0.7)
+    else:
+        axes[2].hist(pre_binary.ravel(), bins=256, color='gray', alpha=0.7)
     axes[2].axvline(otsu_thresh, color='red', linestyle='--', linewidth=2, label=f'Otsu: {otsu_thresh:.2f}')
     axes[2].axvline(adjusted_thresh, color='blue', linestyle='-', linewidth=2, label=f'Adjusted: {adjusted_thresh:.2f}')
     axes[2].set_xlabel('Pixel Intensity')
@@ -78,24 +107,14 @@ def save_diagnostic_png(
     plt.close()
     print(f"Saved diagnostic PNG to {output_path}")
 
-def process_dapi(
+def remove_background(
     img: np.ndarray,
     method: str,
     sigma: Optional[float] = None,
     radius: Optional[int] = None,
     af_img: Optional[np.ndarray] = None,
-    leniency: float = 0.0
-) -> Tuple[np.ndarray, np.ndarray, float, float]:  # ADD return type
-
-    # Clean data: remove NaN and Inf values
-    if np.any(~np.isfinite(img)):
-        print(f"Warning: Found {np.sum(~np.isfinite(img))} non-finite values (NaN/Inf), replacing with 0")
-        img = np.nan_to_num(img, nan=0.0, posinf=0.0, neginf=0.0)
-
-    # Check if image has any valid data
-    if np.all(img == 0):
-        raise ValueError("Image contains only zeros after cleaning non-finite values")
-
+    af_scale: float = 1.0
+) -> np.ndarray:
     if method == "otsu_only":
         processed = img
 
@@ -112,7 +131,7 @@ def process_dapi(
     elif method == "af":
         if af_img is None:
             raise ValueError("--af_image required for af method")
-        processed = remove_background_af(img, af_img)
+        processed = remove_background_af(img, af_img, af_scale)
 
     elif method == "mean":
         processed = remove_background_mean(img)  # REMOVE af_img argument
@@ -120,44 +139,254 @@ def process_dapi(
     else:
         raise ValueError(f"Unknown method: {method}")
 
-    binary, otsu_thresh, adjusted_thresh = apply_otsu_threshold(processed, leniency)
+    return processed
+
+def process_dapi(
+    img: np.ndarray,
+    method: str,
+    sigma: Optional[float] = None,
+    radius: Optional[int] = None,
+    af_img: Optional[np.ndarray] = None,
+    leniency: float = 0.0,
+    af_scale: float = 1.0
+) -> Tuple[np.ndarray, np.ndarray, float, float]:  # ADD return type
+
+    # Clean data: remove NaN and Inf values
+    if np.any(~np.isfinite(img)):
+        print(f"Warning: Found {np.sum(~np.isfinite(img))} non-finite values (NaN/Inf), replacing with 0")
+        img = np.nan_to_num(img, nan=0.0, posinf=0.0, neginf=0.0)
+
+    # Check if image has any valid data
+    if np.all(img == 0):
+        raise ValueError("Image contains only zeros after cleaning non-finite values")
+
+    with perf.phase(f'background_{method}'):
+        processed = remove_background(img, method, sigma, radius, af_img, af_scale)
+
+    with perf.phase('otsu'):
+        binary, otsu_thresh, adjusted_thresh = apply_otsu_threshold(processed, leniency)
     return binary, processed, otsu_thresh, adjusted_thresh
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Apply background removal/otsu thresholding to extracted DAPI channel.")
-    parser.add_argument("-i", "--input_dapi", type=str, required=True, help="Path to 32-bit grayscale DAPI TIFF image.")
-    parser.add_argument("-o", "--output", type=str, required=True, help="Output thresholded .tif image.")
-    parser.add_argument("-m", "--method", type=str, required=True, choices=["gaussian", "rollingball", "af", "mean", "otsu_only"],  # ADD choices
-                        help="Method for background removal.")
-    parser.add_argument("-s", "--sigma", type=float, required=False, help="Sigma parameter for gaussian method.")
-    parser.add_argument("-r", "--radius", type=int, required=False, help="Radius parameter for rollingball method.")
-    parser.add_argument("-a", "--af_image", type=str, required=False, help="Autofluorescence .tif image for AF method.")
-    parser.add_argument("-l", "--leniency", type=float, default=0.0, required=False,
-                        help="Leniency parameter for threshold adjustment. (-1 to 1, negative = stricter)")
-    parser.add_argument("-p", "--png_output", type=str, required=True, help="Optional diagnostic PNG output path.")
+# bytes of compressed tiles read ahead while decoding the source image
+SEGMENT_BUFFER = 16 * 1024 * 1024
 
-    args = parser.parse_args()
 
-    img = tifffile.imread(args.input_dapi)
+def plane_shape(image_path: str) -> Tuple[int, int]:
+    if is_zarr(image_path):
+        image = OMEZarrImage(image_path)
+        axes, shape = image.axes, image.shape
+    else:
+        with tifffile.TiffFile(image_path) as tif:
+            axes, shape = tif.series[0].axes, tif.series[0].shape
+    return shape[axes.index('Y')], shape[axes.index('X')]
+
+
+def channel_tiles(image_path: str, channels: List[int]) -> Iterator[Tuple[int, int, List[np.ndarray]]]:
+    """
+    Yield (y, x, [tile of each channel]) over the full-resolution image, decoding every tile
+    once. Planar (CYX) and interleaved (YXS) OME-TIFFs are read tile by tile; other layouts
+    and OME-Zarr stores are read one channel plane at a time.
+    """
+    if is_zarr(image_path):
+        image = OMEZarrImage(image_path)
+        c_index = image.axes.index('C')
+        yield 0, 0, [np.take(image.read(channels=[c]), 0, axis=c_index).squeeze() for c in channels]
+        return
+
+    with tifffile.TiffFile(image_path) as tif:
+        series = tif.series[0]
+        axes = ''.join(a for a, n in zip(series.axes, series.shape) if n != 1 or a in 'YX')
+        height, width = plane_shape(image_path)
+
+        if axes in ('CYX', 'YXS', 'YXC'):
+            planar = axes == 'CYX'
+            pages = [series.pages[c] for c in channels] if planar else [series.pages[0]]
+            segments = [page.segments(maxworkers=1, buffersize=SEGMENT_BUFFER) for page in pages]
+            for decoded in zip(*segments):
+                _, (_, _, y, x, _), _ = decoded[0]
+                rows = min(decoded[0][0].shape[1], height - y)
+                cols = min(decoded[0][0].shape[2], width - x)
+                if planar:
+                    tiles = [segment[0, :rows, :cols, 0] for segment, _, _ in decoded]
+                else:
+                    tiles = [decoded[0][0][0, :rows, :cols, c] for c in channels]
+                yield y, x, tiles
+            return
+
+        # any other layout: decode the image and take whole channel planes
+        arr = np.moveaxis(tif.asarray(), series.axes.index('C' if 'C' in series.axes else 'S'), 0)
+        yield 0, 0, [arr[c].reshape(height, width) for c in channels]
+
+
+def fused_af_otsu(
+    image_path: str,
+    dapi_channel: int,
+    af_channel: int,
+    af_scale: float = 1.0,
+    leniency: float = 0.0
+) -> Tuple[np.ndarray, np.ndarray, float, float, Optional[Tuple[np.ndarray, np.ndarray]]]:
+    """
+    AF-subtracted DAPI straight from the source image: the DAPI and AF channels are read tile
+    by tile, subtracted and clipped into the processed plane, and for 8/16-bit images the
+    Otsu histogram is collected in the same pass. Returns process_dapi's results plus the
+    histogram as (counts, values), or None when it was computed from the plane instead.
+    """
+    processed = None
+    hist = None
+    non_finite = 0
+    with perf.phase('read_subtract'):
+        for y, x, (dapi, af) in channel_tiles(image_path, [dapi_channel, af_channel]):
+            perf.add('pixels_decoded', dapi.size + af.size)
+            if processed is None:
+                processed = np.empty(plane_shape(image_path), dtype=dapi.dtype)
+                if dapi.dtype in (np.uint8, np.uint16):
+                    hist = np.zeros(np.iinfo(dapi.dtype).max + 1, dtype=np.int64)
+            if np.issubdtype(dapi.dtype, np.floating):
+                bad = ~np.isfinite(dapi)
+                if bad.any():
+                    non_finite += int(bad.sum())
+                    dapi = np.nan_to_num(dapi, nan=0.0, posinf=0.0, neginf=0.0)
+            tile = subtract_af(dapi, af, af_scale)
+            processed[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+            if hist is not None:
+                hist += np.bincount(tile.ravel(), minlength=len(hist))
+
+    print(f"Image shape: {processed.shape}, dtype: {processed.dtype}")
+    if non_finite:
+        print(f"Warning: Found {non_finite} non-finite values (NaN/Inf), replacing with 0")
+    if not processed.any():
+        raise ValueError("DAPI channel contains only zeros after AF subtraction")
+
+    with perf.phase('otsu'):
+        if hist is not None:
+            values = np.flatnonzero(hist)
+            counts = hist[values[0]:values[-1] + 1]
+            hist = (counts, np.arange(values[0], values[-1] + 1))
+            # threshold_otsu returns the only value of a constant image
+            otsu_thresh = values[0] if len(values) == 1 else threshold_otsu(hist=hist)
+        else:
+            otsu_thresh = threshold_otsu(processed)
+        print(f"Otsu threshold value: {otsu_thresh}")
+        adjusted_thresh = otsu_thresh * (1 - leniency)
+        print(f"Adjusted Otsu threshold value: {adjusted_thresh}")
+        binary = (processed > adjusted_thresh).view(np.uint8)
+        binary *= 255
+    return binary, processed, otsu_thresh, adjusted_thresh, hist
+
+
+def find_channels(args) -> Tuple[int, int]:
+    """Indices of the DAPI and AF channels of --image, by name from --xml or the image's own metadata."""
+    from extract_image_channel import extract_channel, find_channel
+
+    indices = []
+    for name in (args.dapi_channel, args.af_channel):
+        if args.xml:
+            index = extract_channel(args.xml, name)
+        elif is_zarr(args.image):
+            index = find_channel(OMEZarrImage(args.image).channel_names, name)
+        else:
+            with tifffile.TiffFile(args.image) as tif:
+                index = extract_channel(io.StringIO(tif.ome_metadata or ''), name)
+        if index is None:
+            raise ValueError(f"{name} channel could not be found in {args.image}")
+        indices.append(index)
+    return indices[0], indices[1]
+
+def run(args):
+    """Read the DAPI (and AF) image, threshold it and write the binary TIFF and diagnostic PNG."""
+    hist = None
+    if args.image:
+        with perf.phase('find_channels'):
+            dapi_channel, af_channel = find_channels(args)
+        print(f"Fused AF subtraction from {args.image}: DAPI channel {dapi_channel}, AF channel {af_channel}, AF scale {args.af_scale}")
+        binary, processed, otsu_thresh, adjusted_thresh, hist = fused_af_otsu(
+            args.image, dapi_channel, af_channel, args.af_scale, args.leniency
+        )
+    else:
+        binary, processed, otsu_thresh, adjusted_thresh = read_and_process(args)
+
+    with perf.phase('write'):
+        tifffile.imwrite(args.output, binary)
+    print(f"Saved binarised image to {args.output}")
+    print(f"Otsu threshold: {otsu_thresh:.2f}, Adjusted threshold: {adjusted_thresh:.2f}")
+
+    with perf.phase('diagnostic_png'):
+        save_diagnostic_png(processed, binary, otsu_thresh, adjusted_thresh, args.png_output, hist)
+
+def read_and_process(args):
+    """The DAPI (and AF) images given as separate files, processed in memory."""
+    with perf.phase('read'):
+        img = tifffile.imread(args.input_dapi)
+        perf.add('pixels_decoded', img.size)
 
     print(f"Image shape: {img.shape}, dtype: {img.dtype}")
 
     af_img = None
     if args.af_image:
-        af_img = tifffile.imread(args.af_image)
+        with perf.phase('read_af'):
+            af_img = tifffile.imread(args.af_image)
+            perf.add('pixels_decoded', af_img.size)
         print(f"AF image shape: {af_img.shape}, dtype: {af_img.dtype}")
 
-    binary, processed, otsu_thresh, adjusted_thresh = process_dapi(
+    return process_dapi(
         img=img,
         method=args.method,
         sigma=args.sigma,
         radius=args.radius,
         af_img=af_img,
-        leniency=args.leniency
+        leniency=args.leniency,
+        af_scale=args.af_scale
     )
 
-    tifffile.imwrite(args.output, binary)
-    print(f"Saved binarised image to {args.output}")
-    print(f"Otsu threshold: {otsu_thresh:.2f}, Adjusted threshold: {adjusted_thresh:.2f}")
 
-    save_diagnostic_png(processed, binary, otsu_thresh, adjusted_thresh, args.png_output)
+def main():
+    parser = argparse.ArgumentParser(description="Apply background removal/otsu thresholding to extracted DAPI channel.")
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument("-i", "--input_dapi", type=str, help="Path to 32-bit grayscale DAPI TIFF image.")
+    inputs.add_argument("--image", type=str,
+                        help="Source OME-TIFF (or OME-Zarr) for the af method: DAPI and AF channels are read and subtracted tile by tile, without extracting them first.")
+    parser.add_argument("-o", "--output", type=str, required=True, help="Output thresholded .tif image.")
+    parser.add_argument("-m", "--method", type=str, required=True, choices=["gaussian", "rollingball", "af", "mean", "otsu_only"],  # ADD choices
+                        help="Method for background removal.")
+    parser.add_argument("-s", "--sigma", type=float, required=False, help="Sigma parameter for gaussian method.")
+    parser.add_argument("-r", "--radius", type=int, required=False, help="Radius parameter for rollingball method.")
+    parser.add_argument("-a", "--af_image", type=str, required=False, help="Autofluorescence .tif image for AF method.")
+    parser.add_argument("-x", "--xml", type=str, required=False, help="OME-XML of --image (default: the image's own OME metadata).")
+    parser.add_argument("--dapi_channel", type=str, default="DAPI", help="DAPI channel name in --image.")
+    parser.add_argument("--af_channel", type=str, required=False, help="Autofluorescence channel name in --image.")
+    parser.add_argument("--af_scale", type=float, default=1.0, help="Scale applied to the AF channel before it is subtracted (af method).")
+    parser.add_argument("-l", "--leniency", type=float, default=0.0, required=False,
+                        help="Leniency parameter for threshold adjustment. (-1 to 1, negative = stricter)")
+    parser.add_argument("-p", "--png_output", type=str, required=True, help="Optional diagnostic PNG output path.")
+    perf.add_argument(parser)
+    add_cache_arguments(parser)
+
+    args = parser.parse_args()
+    perf.enable(args.perf)
+    if args.image and (args.method != "af" or not args.af_channel):
+        parser.error("--image is only used by the af method and needs --af_channel")
+
+    if args.image:
+        inputs = [args.image] + ([args.xml] if args.xml else [])
+    else:
+        inputs = [args.input_dapi] + ([args.af_image] if args.af_image else [])
+    run_cached(
+        open_cache(args.cache_dir, args.cache_max_size),
+        inputs=inputs,
+        # sigma/radius only change the result for the method that uses them
+        params={
+            'method': args.method,
+            'sigma': args.sigma if args.method == 'gaussian' else None,
+            'radius': args.radius if args.method == 'rollingball' else None,
+            'leniency': args.leniency,
+            'af_scale': args.af_scale if args.method == 'af' else None,
+            'channels': [args.dapi_channel, args.af_channel] if args.image else None,
+        },
+        outputs={'image': args.output, 'diagnostic': args.png_output},
+        func=lambda: run(args),
+    )
+    perf.write(args.output)
+
+
+if __name__ == "__main__":
+    main()
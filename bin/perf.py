@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+# Version: 0.0.1
+# Optional per-phase instrumentation shared by the bin/ scripts. Disabled unless the
+# script is run with --perf or MIHCRO_PERF is set, in which case named phases record
+# wall time, peak RSS, bytes read/written and pixel counters into <output>.perf.json.
+
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+ENV_VAR = 'MIHCRO_PERF'
+SUFFIXES = ('.ome.tiff', '.ome.tif', '.ome.zarr', '.tiff', '.tif', '.zarr', '.csv', '.png', '.json',
+            '.geojson', '.geojsonl.gz')
+
+
+def _env_enabled() -> bool:
+    return os.environ.get(ENV_VAR, '').lower() not in ('', '0', 'false', 'no')
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def io_counters() -> Optional[Dict[str, int]]:
+    """Bytes read/written by this process so far (all threads), or None where /proc is unavailable."""
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(':') for line in f)
+    except OSError:
+        return None
+    # rchar/wchar count every read()/write() including page cache hits, which is what the
+    # scripts ask for; read_bytes/write_bytes would only count what reached the device
+    return {'read': int(fields['rchar']), 'written': int(fields['wchar'])}
+
+
+def perf_path(output) -> Path:
+    """<output without image/table suffix>.perf.json, next to output."""
+    output = Path(output)
+    name = output.name
+    for suffix in SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return output.with_name(f"{name}.perf.json")
+
+
+class PerfRecorder:
+    """Collect named phases for one script run; every method is a no-op while disabled."""
+
+    def __init__(self, script: Optional[str] = None, enabled: Optional[bool] = None):
+        self.script = script or Path(sys.argv[0]).name
+        self.enabled = _env_enabled() if enabled is None else enabled
+        self.phases: List[dict] = []
+        self.counters: Dict[str, int] = {}
+        self._stack: List[dict] = []
+        self._start = time.perf_counter()
+        self._io_start = io_counters()
+
+    @contextmanager
+    def phase(self, name: str):
+        if not self.enabled:
+            yield
+            return
+
+        record = {
+            'name': '/'.join([p['name'] for p in self._stack] + [name]),
+            'counters': {},
+        }
+        self._stack.append(record)
+        io_start = io_counters()
+        rss_start = peak_rss_bytes()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 4)
+            rss_end = peak_rss_bytes()
+            record['peak_rss_mib'] = round(rss_end / 2**20, 1)
+            # how far this phase pushed the process high-water mark
+            record['rss_growth_mib'] = round((rss_end - rss_start) / 2**20, 1)
+            io_end = io_counters()
+            if io_start is not None and io_end is not None:
+                record['bytes_read'] = io_end['read'] - io_start['read']
+                record['bytes_written'] = io_end['written'] - io_start['written']
+            self._stack.pop()
+            self.phases.append(record)
+
+    def add(self, counter: str, value: int):
+        """Add to a counter (e.g. pixels_decoded) of the innermost phase and of the run total."""
+        if not self.enabled:
+            return
+        value = int(value)
+        self.counters[counter] = self.counters.get(counter, 0) + value
+        if self._stack:
+            counters = self._stack[-1]['counters']
+            counters[counter] = counters.get(counter, 0) + value
+
+    def summary(self) -> dict:
+        io_end = io_counters()
+        summary = {
+            'script': self.script,
+            'argv': sys.argv[1:],
+            'wall_seconds': round(time.perf_counter() - self._start, 4),
+            'peak_rss_mib': round(peak_rss_bytes() / 2**20, 1),
+            'counters': self.counters,
+            'phases': self.phases,
+        }
+        if self._io_start is not None and io_end is not None:
+            summary['bytes_read'] = io_end['read'] - self._io_start['read']
+            summary['bytes_written'] = io_end['written'] - self._io_start['written']
+        return summary
+
+    def write(self, output) -> Optional[Path]:
+        """Write the summary next to output as <stem>.perf.json; returns the path written."""
+        if not self.enabled:
+            return None
+        path = perf_path(output)
+        path.write_text(json.dumps(self.summary(), indent=2) + '\n')
+        print(f"Saved performance metrics to {path}")
+        return path
+
+
+# shared recorder, so that helpers in one script (e.g. OMETIFFRescaler used from
+# indicaTIFF_to_ome.py) record into the same run
+recorder = PerfRecorder()
+
+
+def enable(enabled: bool = True, script: Optional[str] = None):
+    """Turn recording on for a --perf flag; MIHCRO_PERF already enables it at import."""
+    if enabled:
+        recorder.enabled = True
+    if script:
+        recorder.script = script
+
+
+def add_argument(parser):
+    parser.add_argument('--perf', action='store_true',
+                        help=f"Write <output>.perf.json with per-phase timings, peak RSS and I/O (also enabled by {ENV_VAR}=1)")
+
+
+def phase(name: str):
+    return recorder.phase(name)
+
+
+def add(counter: str, value: int):
+    recorder.add(counter, value)
+
+
+def write(output) -> Optional[Path]:
+    return recorder.write(output)
@@ -5,13 +5,59 @@
 
 import numpy as np
 import tifffile
-from skimage.segmentation import find_boundaries
 import argparse
 import os
+from ngff_store import imread, is_zarr
+from stack_segmentation_input import BandReader
+import perf
+
+# find_boundaries is imported where it is used, so that the overlay subcommands do not
+# pay for importing skimage
+
+def _streamed_boundaries(reader, output_path, rows=256):
+    # 2D masks are processed a band at a time, with one row of context on either side so
+    # that boundaries at band edges match those of the whole image
+    from skimage.segmentation import find_boundaries
+
+    height, width = reader.shape
+
+    def tiles():
+        bands = reader.bands(rows)
+        band = next(bands, None)
+        above = None
+        while band is not None:
+            below = next(bands, None)
+            perf.add('pixels_decoded', band.size)
+            block = np.concatenate([b for b in (above, band, None if below is None else below[:1]) if b is not None])
+            top = 0 if above is None else 1
+            boundaries = find_boundaries(block, mode='outer')[top:top + len(band)].astype(np.uint8) * 255
+            for x in range(0, width, rows):
+                yield boundaries[:, x:x + rows]
+            above, band = band[-1:], below
+
+    tifffile.imwrite(output_path, tiles(), shape=(height, width), dtype=np.uint8,
+                     tile=(rows, rows), photometric='minisblack')
+
 
 def instance_mask_to_boundaries(input_path, output_path):
+    if not is_zarr(input_path):
+        try:
+            reader = BandReader(input_path)
+        except ValueError:
+            # 3D masks are handled whole below
+            reader = None
+        if reader is not None:
+            try:
+                _streamed_boundaries(reader, output_path)
+            finally:
+                reader.close()
+            print(f"Saved boundaries to {output_path}")
+            return
+
     # Load instance mask image
-    instance_mask = tifffile.imread(input_path)
+    with perf.phase('read_mask'):
+        instance_mask = imread(input_path)
+        perf.add('pixels_decoded', instance_mask.size)
 
     # Check if 2D or 3D
     if instance_mask.ndim == 2:
@@ -25,6 +71,7 @@ def instance_mask_to_boundaries(input_path, output_path):
     boundary_stack = np.zeros_like(masks, dtype=np.uint8)
 
     # Process each slice (in case of 3D)
+    from skimage.segmentation import find_boundaries
     for i, mask in enumerate(masks):
         boundaries = find_boundaries(mask, mode='outer').astype(np.uint8) * 255
         boundary_stack[i] = boundaries
@@ -39,7 +86,7 @@ def instance_mask_to_boundaries(input_path, output_path):
 
 def create_multichannel_tiff(dapi_path, boundary_path, output_path):
     # Load DAPI image
-    dapi = tifffile.imread(dapi_path)
+    dapi = imread(dapi_path)
     if dapi.ndim != 2:
         raise ValueError("DAPI image must be a 2D grayscale image.")
 
@@ -64,7 +111,7 @@ def create_multichannel_tiff(dapi_path, boundary_path, output_path):
     print(f"Saved multi-channel TIFF to: {output_path}")
 
 def create_rgb_overlay_tiff(dapi_path, boundary_path, output_path):
-    dapi = tifffile.imread(dapi_path)
+    dapi = imread(dapi_path)
     boundary = tifffile.imread(boundary_path)
 
     if dapi.shape != boundary.shape:
@@ -83,24 +130,33 @@ def create_rgb_overlay_tiff(dapi_path, boundary_path, output_path):
     print(f"Saved rgb TIFF to: {output_path}")
 
 
-if __name__ == "__main__":
+def main():
     parser = argparse.ArgumentParser(description="Combine DAPI and boundary mask into stacked greyscale and overlaid rgb TIFFs.")
-    parser.add_argument("--dapi_path", help="Path to 32-bit grayscale DAPI TIFF image")
-    parser.add_argument("--mask_path", help="Path to segmentation boundary TIFF image")
+    parser.add_argument("--dapi_path", help="Path to 32-bit grayscale DAPI TIFF image or OME-Zarr store")
+    parser.add_argument("--mask_path", help="Path to segmentation boundary TIFF image or OME-Zarr store")
     parser.add_argument("--output_prefix", help="Prefix for saved TIFF files")
+    perf.add_argument(parser)
     args = parser.parse_args()
+    perf.enable(args.perf)
 
     boundary_path = f"{args.output_prefix}_temp_boundaries.tiff"
-    instance_mask_to_boundaries(args.mask_path, boundary_path)
+    with perf.phase('boundaries'):
+        instance_mask_to_boundaries(args.mask_path, boundary_path)
     print(f"Converted boundary mask to TIFF!")
 
     output_bw = f"{args.output_prefix}_bw_boundaries.tiff"
-    create_multichannel_tiff(args.dapi_path, boundary_path, output_bw)
+    with perf.phase('render_bw'):
+        create_multichannel_tiff(args.dapi_path, boundary_path, output_bw)
     print(f"Rendered multichannel grayscale boundary/DAPI TIFF!")
 
     output_rgb = f"{args.output_prefix}_rgb_boundaries.tiff"
-    create_rgb_overlay_tiff(args.dapi_path, boundary_path, output_rgb)
+    with perf.phase('render_rgb'):
+        create_rgb_overlay_tiff(args.dapi_path, boundary_path, output_rgb)
     print(f"Rendered overlaid RGB boundary/DAPI TIFF!")
 
     os.remove(boundary_path)
+    perf.write(f"{args.output_prefix}_boundaries.tiff")
 
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Content-addressed result cache for deterministic image steps
+Outputs of a script run are stored under a key built from cheap input fingerprints
+(TIFF page layout, OME-XML, file size and a sample of tile bytes), the normalised
+parameters and the source of the script and of every bin/ module it imports, so reruns on the same slides can skip the work
+even in a new work or output directory. Entries are published with an atomic rename
+and evicted least-recently-used when the cache grows past its size limit, so
+concurrent tasks can share one cache directory.
+"""
+
+import argparse
+import ast
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+import tifffile
+import perf
+
+CACHE_DIR_ENV = 'MIHCRO_CACHE_DIR'
+MAX_SIZE_ENV = 'MIHCRO_CACHE_MAX_SIZE'
+DEFAULT_MAX_SIZE = 50 * 1024**3
+# tile/chunk bytes hashed per input, so that files with identical layout but different pixels differ
+SAMPLE_SEGMENTS = 16
+SAMPLE_BYTES = 64 * 1024
+MANIFEST = 'manifest.json'
+
+PathLike = Union[str, Path]
+
+
+def parse_size(size: Union[str, int, None]) -> int:
+    """'50GB', '500 MB', '1.5T' or a byte count."""
+    if size is None or size == '':
+        return DEFAULT_MAX_SIZE
+    if isinstance(size, int):
+        return size
+    text = str(size).strip().upper().replace(' ', '').rstrip('B').rstrip('I')
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text))
+
+
+def _sample(fh, segments: List, digest):
+    if not segments:
+        return
+    step = max(1, len(segments) // SAMPLE_SEGMENTS)
+    for offset, bytecount in segments[::step][:SAMPLE_SEGMENTS] + [segments[-1]]:
+        fh.seek(offset)
+        digest.update(fh.read(min(bytecount, SAMPLE_BYTES)))
+
+
+def fingerprint(path: PathLike) -> str:
+    """Cheap content fingerprint of a TIFF, OME-Zarr store or small text file."""
+    path = Path(path)
+    digest = hashlib.sha256()
+
+    if path.is_dir():
+        # OME-Zarr: metadata by content, chunks by name and size plus a sample of their bytes
+        files = sorted(f for f in path.rglob('*') if f.is_file())
+        chunks = []
+        for f in files:
+            rel = f.relative_to(path).as_posix()
+            digest.update(f"{rel}\0{f.stat().st_size}\n".encode())
+            if f.name.startswith('.') or f.suffix in ('.json', '.xml'):
+                digest.update(f.read_bytes())
+            else:
+                chunks.append(f)
+        step = max(1, len(chunks) // SAMPLE_SEGMENTS)
+        for f in chunks[::step][:SAMPLE_SEGMENTS]:
+            with open(f, 'rb') as fh:
+                digest.update(fh.read(SAMPLE_BYTES))
+        return digest.hexdigest()
+
+    digest.update(f"size={path.stat().st_size}\n".encode())
+    try:
+        with tifffile.TiffFile(path) as tif:
+            segments = []
+            for series in tif.series:
+                for level in series.levels:
+                    for page in level.pages:
+                        if page is None:
+                            continue
+                        digest.update(repr((page.shape, str(page.dtype), page.compression,
+                                            page.dataoffsets, page.databytecounts)).encode())
+                        digest.update((getattr(page, 'description', '') or '').encode())
+                        if level is series.levels[0]:
+                            segments.extend(zip(page.dataoffsets, page.databytecounts))
+            _sample(tif.filehandle, [s for s in segments if s[1] > 0], digest)
+    except tifffile.TiffFileError:
+        # marker lists, metadata XML and other small inputs are hashed in full
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def local_modules(script: PathLike) -> List[Path]:
+    """
+    script and the modules next to it that it imports, directly or through each other,
+    including imports inside functions (which are not in sys.modules until they run).
+    """
+    script = Path(script).resolve()
+    found, pending = {script}, [script]
+    while pending:
+        tree = ast.parse(pending.pop().read_bytes())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module = script.parent / f"{name.split('.')[0]}.py"
+                if module.is_file() and module not in found:
+                    found.add(module)
+                    pending.append(module)
+    return sorted(found)
+
+
+def script_digest(script: PathLike) -> str:
+    """Digest of the source of script and of the bin/ modules it imports."""
+    digest = hashlib.sha256()
+    for module in local_modules(script):
+        digest.update(f"{module.name}\0".encode())
+        digest.update(hashlib.sha256(module.read_bytes()).digest())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Directory of cache entries <root>/<key[:2]>/<key>/, each holding the output files and a manifest."""
+
+    def __init__(self, root: PathLike, max_size: Union[str, int, None] = None):
+        self.root = Path(root)
+        self.max_size = parse_size(max_size)
+        (self.root / 'tmp').mkdir(parents=True, exist_ok=True)
+
+    def key(self, script: PathLike, inputs: Sequence[PathLike], params: Dict) -> str:
+        """Key for running script on inputs with params; params must be JSON-serialisable."""
+        payload = {
+            'script': Path(script).name,
+            'script_digest': script_digest(script),
+            'inputs': [fingerprint(p) for p in inputs],
+            'params': params,
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    def entry(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def restore(self, key: str, outputs: Dict[str, PathLike]) -> bool:
+        """Copy a cached entry to the output paths; False on a miss or an entry evicted mid-copy."""
+        entry = self.entry(key)
+        try:
+            manifest = json.loads((entry / MANIFEST).read_text())
+            if set(manifest['outputs']) != set(outputs):
+                return False
+            for name, dest in outputs.items():
+                _place(entry / manifest['outputs'][name], Path(dest))
+            # last use is the manifest mtime
+            os.utime(entry / MANIFEST)
+        except (OSError, ValueError, KeyError):
+            return False
+        return True
+
+    def store(self, key: str, outputs: Dict[str, PathLike], info: Optional[Dict] = None):
+        """Publish outputs under key with an atomic rename, then evict down to the size limit."""
+        entry = self.entry(key)
+        if entry.exists():
+            return
+        size = sum(_size(Path(p)) for p in outputs.values())
+        if size > self.max_size:
+            print(f"Result cache: outputs ({size} bytes) larger than cache limit, not stored")
+            return
+
+        staging = self.root / 'tmp' / f"{key}.{uuid.uuid4().hex}"
+        staging.mkdir(parents=True)
+        try:
+            names = {}
+            for name, src in outputs.items():
+                names[name] = f"{name}{''.join(Path(src).suffixes)}"
+                _place(Path(src), staging / names[name])
+            (staging / MANIFEST).write_text(json.dumps({
+                'outputs': names,
+                'size': size,
+                'created': time.time(),
+                **(info or {}),
+            }, indent=2))
+            entry.parent.mkdir(exist_ok=True)
+            os.rename(staging, entry)
+        except OSError:
+            # another task published the same key first
+            shutil.rmtree(staging, ignore_errors=True)
+            if not entry.exists():
+                raise
+            return
+        self.evict()
+
+    def entries(self) -> List[Dict]:
+        found = []
+        for manifest in self.root.glob(f'??/*/{MANIFEST}'):
+            try:
+                stat = manifest.stat()
+                size = json.loads(manifest.read_text())['size']
+            except (OSError, ValueError, KeyError):
+                continue
+            found.append({'path': manifest.parent, 'size': size, 'used': stat.st_mtime})
+        return found
+
+    @contextmanager
+    def _lock(self):
+        with open(self.root / '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def evict(self, max_size: Optional[int] = None) -> int:
+        """Remove least recently used entries until the cache fits max_size; returns bytes freed."""
+        max_size = self.max_size if max_size is None else max_size
+        freed = 0
+        with self._lock():
+            entries = sorted(self.entries(), key=lambda e: e['used'])
+            total = sum(e['size'] for e in entries)
+            for e in entries:
+                if total <= max_size:
+                    break
+                # move out of the way first so readers never see a half-deleted entry
+                trash = self.root / 'tmp' / f"evict.{uuid.uuid4().hex}"
+                try:
+                    os.rename(e['path'], trash)
+                except OSError:
+                    continue
+                shutil.rmtree(trash, ignore_errors=True)
+                total -= e['size']
+                freed += e['size']
+        return freed
+
+
+def _size(path: Path) -> int:
+    if path.is_dir():
+        return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+    return path.stat().st_size
+
+
+def _place(src: Path, dest: Path):
+    """Hard link src to dest where possible (same filesystem), copy otherwise."""
+    if dest.exists() or dest.is_symlink():
+        if dest.is_dir():
+            shutil.rmtree(dest)
+        else:
+            dest.unlink()
+    if src.is_dir():
+        shutil.copytree(src, dest, copy_function=_link_or_copy)
+    else:
+        _link_or_copy(src, dest)
+
+
+def _link_or_copy(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+def open_cache(cache_dir: Optional[PathLike] = None, max_size: Union[str, int, None] = None) -> Optional[ResultCache]:
+    """Cache from an explicit directory or MIHCRO_CACHE_DIR; None when caching is off."""
+    cache_dir = cache_dir or os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        return None
+    return ResultCache(cache_dir, max_size or os.environ.get(MAX_SIZE_ENV))
+
+
+def add_arguments(parser):
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help=f"Reuse results from this cache directory when inputs and parameters match (default: ${CACHE_DIR_ENV})")
+    parser.add_argument('--cache-max-size', type=str, default=None,
+                        help=f"Evict least recently used cache entries beyond this size, e.g. 50GB (default: ${MAX_SIZE_ENV} or 50GB)")
+
+
+def run_cached(
+    cache: Optional[ResultCache],
+    inputs: Sequence[PathLike],
+    params: Dict,
+    outputs: Dict[str, PathLike],
+    func: Callable[[], object],
+    script: Optional[PathLike] = None,
+) -> bool:
+    """
+    Restore outputs from cache, or run func and store what it wrote.
+    Returns True on a cache hit. Without a cache this simply calls func.
+    """
+    if cache is None:
+        func()
+        return False
+
+    script = script or sys.argv[0]
+    with perf.phase('cache_lookup'):
+        key = cache.key(script, inputs, params)
+        hit = cache.restore(key, outputs)
+    if hit:
+        print(f"Result cache hit {key[:12]}: restored {', '.join(str(p) for p in outputs.values())}")
+        return True
+
+    for dest in outputs.values():
+        # an output restored by an earlier hit is a hard link into the cache, which writing
+        # it in place would corrupt
+        dest = Path(dest)
+        if dest.is_dir():
+            if any(f.stat().st_nlink > 1 for f in dest.rglob('*') if f.is_file()):
+                shutil.rmtree(dest)
+        elif dest.is_file() and dest.stat().st_nlink > 1:
+            dest.unlink()
+    func()
+    with perf.phase('cache_store'):
+        cache.store(key, outputs, {'script': Path(script).name, 'params': params})
+    print(f"Result cache miss {key[:12]}: stored outputs in {cache.entry(key)}")
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or prune a mihcro result cache")
+    parser.add_argument('cache_dir', type=Path)
+    parser.add_argument('--prune', type=str, default=None, help="Evict least recently used entries down to this size, e.g. 10GB")
+    args = parser.parse_args()
+
+    cache = ResultCache(args.cache_dir)
+    if args.prune is not None:
+        freed = cache.evict(parse_size(args.prune))
+        print(f"Freed {freed / 1024**3:.2f} GB")
+    entries = cache.entries()
+    print(f"{len(entries)} entries, {sum(e['size'] for e in entries) / 1024**3:.2f} GB in {args.cache_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+# Version: 0.0.1
+# Streams single-channel images into a tiled (channels, Y, X) TIFF for segmentation,
+# one tile row at a time, optionally normalising dtype and intensity range on the way.
+
+import argparse
+from typing import Iterator, List, Optional, Tuple
+import numpy as np
+import tifffile
+import perf
+
+# bytes of compressed strips/tiles read ahead when decoding a non-mappable input
+SEGMENT_BUFFER = 16 * 1024 * 1024
+
+
+class BandReader:
+    """Serve consecutive row bands of a single-channel TIFF without loading the whole image."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tif = tifffile.TiffFile(path)
+        self.page = self.tif.pages.first
+
+        shape = tuple(s for s in self.page.shape if s != 1) or (1, 1)
+        if len(shape) != 2:
+            raise ValueError(f"Expected a single-channel 2D image, got shape {self.page.shape} in {path}")
+        self.shape = shape
+        self.dtype = self.page.dtype
+
+        # uncompressed contiguous images are served straight from a memory map
+        try:
+            self.memmap = tifffile.memmap(path, mode='r').reshape(self.shape)
+        except ValueError:
+            self.memmap = None
+
+    def close(self):
+        self.memmap = None
+        self.tif.close()
+
+    def _segment_bands(self) -> Iterator[np.ndarray]:
+        # decode strips/tiles in file order, yielding one full-width band per strip/tile row
+        height, width = self.shape
+        band = None
+        band_y = None
+        for segment, (_, _, y, x, _), _ in self.page.segments(maxworkers=1, buffersize=SEGMENT_BUFFER):
+            if band_y != y:
+                if band is not None:
+                    yield band
+                band_y = y
+                band = np.zeros((min(segment.shape[1], height - y), width), dtype=self.dtype)
+            rows, cols = band.shape[0], min(segment.shape[2], width - x)
+            band[:, x:x + cols] = segment[0, :rows, :cols, 0]
+        if band is not None:
+            yield band
+
+    def bands(self, height: int) -> Iterator[np.ndarray]:
+        """Yield row bands of exactly `height` rows (the last one may be shorter)."""
+        if self.memmap is not None:
+            for y in range(0, self.shape[0], height):
+                yield np.asarray(self.memmap[y:y + height])
+            return
+
+        pending: List[np.ndarray] = []
+        buffered = 0
+        for rows in self._segment_bands():
+            pending.append(rows)
+            buffered += len(rows)
+            while buffered >= height:
+                block = np.concatenate(pending) if len(pending) > 1 else pending[0]
+                yield block[:height]
+                pending = [block[height:]]
+                buffered = len(pending[0])
+        if buffered:
+            yield np.concatenate(pending)
+
+    def intensity_range(self, height: int = 1024) -> Tuple[float, float]:
+        """Streamed min/max over the image, ignoring non-finite values."""
+        lo, hi = np.inf, -np.inf
+        for band in self.bands(height):
+            if np.issubdtype(band.dtype, np.floating):
+                band = band[np.isfinite(band)]
+            if band.size:
+                lo = min(lo, float(band.min()))
+                hi = max(hi, float(band.max()))
+        return lo, hi
+
+
+def normalise(
+    band: np.ndarray,
+    dtype: np.dtype,
+    intensity_range: Optional[Tuple[float, float]] = None,
+) -> np.ndarray:
+    """Convert a band to dtype, optionally stretching intensity_range to the full output range."""
+    if intensity_range is None:
+        if band.dtype == dtype:
+            return band
+        if np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            band = np.clip(np.nan_to_num(band), info.min, info.max)
+        return band.astype(dtype)
+
+    lo, hi = intensity_range
+    scale = 1.0 / (hi - lo) if hi > lo else 0.0
+    out = (band.astype(np.float32) - lo) * scale
+    np.clip(out, 0.0, 1.0, out=out)
+    np.nan_to_num(out, copy=False)
+    if np.issubdtype(dtype, np.integer):
+        out *= np.iinfo(dtype).max
+        np.round(out, out=out)
+    return out.astype(dtype)
+
+
+def stack_channels(
+    inputs: List[str],
+    output: str,
+    dtype: Optional[str] = None,
+    rescale: bool = False,
+    tile: int = 256,
+    compression: Optional[str] = None,
+):
+    """Write inputs as the planes of one tiled TIFF, in the given channel order."""
+    readers = [BandReader(path) for path in inputs]
+    try:
+        shape = readers[0].shape
+        for reader in readers[1:]:
+            if reader.shape != shape:
+                raise ValueError("Images must have same dimensions")
+
+        out_dtype = np.dtype(dtype) if dtype else np.result_type(*(reader.dtype for reader in readers))
+        with perf.phase('intensity_range'):
+            ranges = [reader.intensity_range() if rescale else None for reader in readers]
+        for path, reader, intensity_range in zip(inputs, readers, ranges):
+            print(f"{path}: shape={reader.shape}, dtype={reader.dtype}, "
+                  f"memory-mapped={reader.memmap is not None}, range={intensity_range}")
+
+        def tiles():
+            # TiffWriter consumes tiles plane by plane, row-major within a plane
+            for reader, intensity_range in zip(readers, ranges):
+                for band in reader.bands(tile):
+                    perf.add('pixels_decoded', band.size)
+                    band = normalise(band, out_dtype, intensity_range)
+                    for x in range(0, shape[1], tile):
+                        yield band[:, x:x + tile]
+
+        out_shape = (len(readers), *shape) if len(readers) > 1 else shape
+        tifffile.imwrite(
+            output,
+            tiles(),
+            shape=out_shape,
+            dtype=out_dtype,
+            tile=(tile, tile),
+            photometric='minisblack',
+            compression=compression,
+            bigtiff=len(readers) * shape[0] * shape[1] * out_dtype.itemsize > 3.5 * (1024**3),
+            metadata={'axes': 'CYX' if len(readers) > 1 else 'YX'},
+        )
+        print(f"Saved {out_shape} {out_dtype} stack to {output}")
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stack nuclear/membrane images into a tiled segmentation input, one tile row at a time.")
+    parser.add_argument("-i", "--input", type=str, action="append", required=True,
+                        help="Single-channel input TIFF; repeat to add channels in output order.")
+    parser.add_argument("-o", "--output", type=str, required=True, help="Output tiled .tif image.")
+    parser.add_argument("--dtype", type=str, choices=["uint8", "uint16", "float32"], default=None,
+                        help="Output dtype (default: common dtype of the inputs).")
+    parser.add_argument("--rescale", action="store_true",
+                        help="Stretch each channel's min/max to the output range ([0, 1] for float32).")
+    parser.add_argument("--tile", type=int, default=256, help="Output tile size (multiple of 16).")
+    parser.add_argument("--compression", type=str, default=None, help="Output compression, e.g. zlib (default: none).")
+
+    perf.add_argument(parser)
+
+    args = parser.parse_args()
+    perf.enable(args.perf)
+
+    with perf.phase('stack'):
+        stack_channels(args.input, args.output, args.dtype, args.rescale, args.tile, args.compression)
+    perf.write(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# Version: 0.0.1
+# Merges the *.perf.json files written by the bin/ scripts (see perf.py) into one
+# per-phase table across samples, plus a per script/phase summary.
+
+import argparse
+import csv
+import json
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List
+
+PHASE_COLUMNS = [
+    'run', 'script', 'phase', 'seconds', 'peak_rss_mib', 'rss_growth_mib',
+    'bytes_read', 'bytes_written', 'pixels_decoded', 'counters',
+]
+SUMMARY_COLUMNS = [
+    'script', 'phase', 'runs', 'total_seconds', 'mean_seconds', 'max_seconds',
+    'max_peak_rss_mib', 'total_bytes_read', 'total_bytes_written', 'total_pixels_decoded',
+]
+
+
+def load_rows(paths: List[str]) -> List[Dict]:
+    """One row per phase, plus a 'total' row per perf file."""
+    rows = []
+    for path in sorted(paths, key=lambda p: Path(p).name):
+        with open(path) as f:
+            perf = json.load(f)
+        run = Path(path).name[:-len('.perf.json')]
+        for phase in perf['phases'] + [dict(perf, name='total', seconds=perf['wall_seconds'])]:
+            counters = dict(phase.get('counters', {}))
+            rows.append({
+                'run': run,
+                'script': perf['script'],
+                'phase': phase['name'],
+                'seconds': phase['seconds'],
+                'peak_rss_mib': phase.get('peak_rss_mib'),
+                'rss_growth_mib': phase.get('rss_growth_mib'),
+                'bytes_read': phase.get('bytes_read'),
+                'bytes_written': phase.get('bytes_written'),
+                'pixels_decoded': counters.pop('pixels_decoded', None),
+                'counters': ';'.join(f"{k}={v}" for k, v in sorted(counters.items())),
+            })
+    return rows
+
+
+def summarise(rows: List[Dict]) -> List[Dict]:
+    groups = defaultdict(list)
+    for row in rows:
+        groups[(row['script'], row['phase'])].append(row)
+
+    def total(group, key):
+        values = [row[key] for row in group if row[key] is not None]
+        return sum(values) if values else None
+
+    summary = []
+    for (script, phase), group in sorted(groups.items()):
+        seconds = [row['seconds'] for row in group]
+        rss = [row['peak_rss_mib'] for row in group if row['peak_rss_mib'] is not None]
+        summary.append({
+            'script': script,
+            'phase': phase,
+            'runs': len(group),
+            'total_seconds': round(sum(seconds), 4),
+            'mean_seconds': round(sum(seconds) / len(seconds), 4),
+            'max_seconds': max(seconds),
+            'max_peak_rss_mib': max(rss) if rss else None,
+            'total_bytes_read': total(group, 'bytes_read'),
+            'total_bytes_written': total(group, 'bytes_written'),
+            'total_pixels_decoded': total(group, 'pixels_decoded'),
+        })
+    return summary
+
+
+def write_tsv(path: str, rows: List[Dict], columns: List[str]):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, delimiter='\t', lineterminator='\n')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({k: '' if row[k] is None else row[k] for k in columns})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge *.perf.json files into per-phase tables.")
+    parser.add_argument("perf_files", nargs='+', help="*.perf.json files written with --perf or MIHCRO_PERF=1")
+    parser.add_argument("-p", "--prefix", type=str, default="perf", help="Output prefix for <prefix>_phases.tsv and <prefix>_summary.tsv")
+    args = parser.parse_args()
+
+    rows = load_rows(args.perf_files)
+    write_tsv(f"{args.prefix}_phases.tsv", rows, PHASE_COLUMNS)
+    write_tsv(f"{args.prefix}_summary.tsv", summarise(rows), SUMMARY_COLUMNS)
+    print(f"Merged {len(args.perf_files)} perf files into {args.prefix}_phases.tsv and {args.prefix}_summary.tsv")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+# Version: 0.0.1
+# Cuts whole-slide segmentation inputs into overlapping tiles and stitches the per-tile
+# label masks back into one globally consistent instance mask.
+
+import argparse
+import json
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import tifffile
+from stack_segmentation_input import BandReader
+import perf
+
+TILE_PATTERN = re.compile(r'tile(\d+)')
+
+
+def tile_grid(height: int, width: int, tile_size: int, overlap: int) -> List[Dict[str, int]]:
+    """Tile origins/extents covering the image, neighbouring tiles sharing `overlap` pixels."""
+    if not 0 <= overlap < tile_size / 2:
+        raise ValueError(f"Overlap ({overlap}) must be less than half the tile size ({tile_size})")
+
+    stride = tile_size - overlap
+
+    def starts(size):
+        # the last tile is allowed to be smaller, but never only overlap
+        return [s for s in range(0, size, stride) if s == 0 or s + overlap < size]
+
+    tiles = []
+    for row, y in enumerate(starts(height)):
+        for col, x in enumerate(starts(width)):
+            tiles.append({
+                'index': len(tiles),
+                'row': row,
+                'col': col,
+                'y': y,
+                'x': x,
+                'height': min(tile_size, height - y),
+                'width': min(tile_size, width - x),
+            })
+    return tiles
+
+
+def tile_name(prefix: str, index: int, suffix: str = '') -> str:
+    return f"{prefix}.tile{index:04d}{suffix}.tif"
+
+
+def split(inputs: List[str], names: List[str], prefix: str, tile_size: int, overlap: int, stack: bool) -> Path:
+    """Write one tile file per input (or one stacked file with --stack) for each tile, plus a manifest."""
+    readers = [BandReader(path) for path in inputs]
+    try:
+        shape = readers[0].shape
+        for reader in readers[1:]:
+            if reader.shape != shape:
+                raise ValueError("Images must have same dimensions")
+        dtype = np.result_type(*(reader.dtype for reader in readers))
+
+        tiles = tile_grid(shape[0], shape[1], tile_size, overlap)
+        stride = tile_size - overlap
+        rows: Dict[int, List[Dict[str, int]]] = {}
+        for tile in tiles:
+            rows.setdefault(tile['row'], []).append(tile)
+
+        # a tile row spans its own band and the leading `overlap` rows of the next one
+        band_iters = [reader.bands(stride) for reader in readers]
+        current = [next(it, None) for it in band_iters]
+        for row in sorted(rows):
+            following = [next(it, None) for it in band_iters]
+            windows = []
+            for band, next_band in zip(current, following):
+                window = band if next_band is None else np.concatenate([band, next_band[:overlap]])
+                windows.append(window)
+
+            for tile in rows[row]:
+                x0, x1 = tile['x'], tile['x'] + tile['width']
+                planes = [window[:tile['height'], x0:x1] for window in windows]
+                if stack:
+                    stacked = np.stack([p.astype(dtype, copy=False) for p in planes]) if len(planes) > 1 else planes[0]
+                    tifffile.imwrite(tile_name(prefix, tile['index']), stacked, photometric='minisblack')
+                else:
+                    for name, plane in zip(names, planes):
+                        tifffile.imwrite(tile_name(prefix, tile['index'], f'.{name}'), plane, photometric='minisblack')
+            current = following
+    finally:
+        for reader in readers:
+            reader.close()
+
+    manifest = Path(f"{prefix}.tiles.json")
+    with open(manifest, 'w') as f:
+        json.dump({
+            'image_shape': list(shape),
+            'tile_size': tile_size,
+            'overlap': overlap,
+            'inputs': [str(path) for path in inputs],
+            'tiles': tiles,
+        }, f, indent=2)
+    print(f"Wrote {len(tiles)} tiles of {tile_size}px with {overlap}px overlap, manifest {manifest}")
+    return manifest
+
+
+class LabelUnion:
+    """Union-find over global label ids; only merged labels are stored."""
+
+    def __init__(self):
+        self.parent: Dict[int, int] = {}
+
+    def find(self, label: int) -> int:
+        root = label
+        while self.parent.get(root, root) != root:
+            root = self.parent[root]
+        while label != root:
+            self.parent[label], label = root, self.parent.get(label, label)
+        return root
+
+    def union(self, a: int, b: int):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            self.parent[max(ra, rb)] = min(ra, rb)
+
+    def roots(self, labels: np.ndarray) -> np.ndarray:
+        if not self.parent:
+            return labels
+        out = labels.copy()
+        merged = np.isin(labels, np.fromiter(self.parent, dtype=labels.dtype))
+        out[merged] = [self.find(int(label)) for label in labels[merged]]
+        return out
+
+
+def match_overlap(a: np.ndarray, b: np.ndarray, iou_threshold: float) -> List[Tuple[int, int]]:
+    """Pairs of global labels whose IoU within the shared region is at least iou_threshold."""
+    both = (a > 0) & (b > 0)
+    if not both.any():
+        return []
+    a_ids, a_counts = np.unique(a[a > 0], return_counts=True)
+    b_ids, b_counts = np.unique(b[b > 0], return_counts=True)
+    pairs, inter = np.unique(
+        (a[both].astype(np.uint64) << np.uint64(32)) | b[both].astype(np.uint64),
+        return_counts=True,
+    )
+    pa = (pairs >> np.uint64(32)).astype(np.int64)
+    pb = (pairs & np.uint64(0xFFFFFFFF)).astype(np.int64)
+    union = a_counts[np.searchsorted(a_ids, pa)] + b_counts[np.searchsorted(b_ids, pb)] - inter
+    iou = inter / union
+
+    # keep the best partner for each label in a
+    order = np.lexsort((-iou, pa))
+    best = {}
+    for i in order:
+        if iou[i] >= iou_threshold and int(pa[i]) not in best:
+            best[int(pa[i])] = int(pb[i])
+    return list(best.items())
+
+
+def _read_mask(path: Path) -> np.ndarray:
+    mask = tifffile.imread(path)
+    mask = np.squeeze(mask)
+    if mask.ndim != 2:
+        raise ValueError(f"Tile mask {path} is not 2D: {mask.shape}")
+    return mask
+
+
+def merge(manifest_path: str, masks: List[str], output: str, iou_threshold: float = 0.5) -> int:
+    """
+    Stitch tile masks into one label image.
+    Pass 1 gives every tile label a global id and unites labels matched by IoU in the overlaps,
+    keeping only overlap strips in memory. Pass 2 writes each tile's core (the tile minus half
+    the overlap on interior sides) into a memory-mapped output, relabelled consecutively.
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    height, width = manifest['image_shape']
+    overlap = manifest['overlap']
+    tiles = manifest['tiles']
+
+    mask_paths = {}
+    for path in masks:
+        found = TILE_PATTERN.search(Path(path).name)
+        if not found:
+            raise ValueError(f"Cannot find tile index in mask name {path}")
+        mask_paths[int(found.group(1))] = Path(path)
+    missing = [tile['index'] for tile in tiles if tile['index'] not in mask_paths]
+    if missing:
+        raise ValueError(f"Missing masks for tiles {missing}")
+
+    # pass 1: global ids and seam matching
+    union = LabelUnion()
+    tile_labels: Dict[int, np.ndarray] = {}
+    offsets: Dict[int, int] = {}
+    next_offset = 0
+    bottom_strips: Dict[int, Tuple[int, int, np.ndarray]] = {}   # col -> (y, x, strip) of the previous row
+    previous_bottom: Dict[int, Tuple[int, int, np.ndarray]] = {}
+    right_strip: Optional[Tuple[int, int, np.ndarray]] = None
+    current_row = None
+
+    for tile in tiles:
+        if tile['row'] != current_row:
+            previous_bottom, bottom_strips = bottom_strips, {}
+            right_strip = None
+            current_row = tile['row']
+
+        mask = _read_mask(mask_paths[tile['index']])
+        labels = np.unique(mask)
+        labels = labels[labels > 0]
+        tile_labels[tile['index']] = labels
+        offsets[tile['index']] = next_offset
+
+        global_mask = np.zeros(mask.shape, dtype=np.uint32)
+        nonzero = mask > 0
+        global_mask[nonzero] = next_offset + 1 + np.searchsorted(labels, mask[nonzero])
+        next_offset += len(labels)
+
+        neighbours = [right_strip] + [previous_bottom.get(tile['col'] + d) for d in (-1, 0, 1)]
+        for neighbour in neighbours:
+            if neighbour is None:
+                continue
+            ny, nx, strip = neighbour
+            y0, y1 = max(ny, tile['y']), min(ny + strip.shape[0], tile['y'] + tile['height'])
+            x0, x1 = max(nx, tile['x']), min(nx + strip.shape[1], tile['x'] + tile['width'])
+            if y0 >= y1 or x0 >= x1:
+                continue
+            a = strip[y0 - ny:y1 - ny, x0 - nx:x1 - nx]
+            b = global_mask[y0 - tile['y']:y1 - tile['y'], x0 - tile['x']:x1 - tile['x']]
+            for la, lb in match_overlap(a, b, iou_threshold):
+                union.union(la, lb)
+
+        right_strip = (tile['y'], tile['x'] + tile['width'] - overlap, global_mask[:, -overlap:].copy()) if overlap else None
+        bottom_strips[tile['col']] = (tile['y'] + tile['height'] - overlap, tile['x'], global_mask[-overlap:].copy()) if overlap else None
+
+    # pass 2: write tile cores through the union, relabelled consecutively
+    out = tifffile.memmap(output, shape=(height, width), dtype=np.uint32, photometric='minisblack')
+    final: Dict[int, int] = {}
+    last_row = max(tile['row'] for tile in tiles)
+    last_col = max(tile['col'] for tile in tiles)
+    half = overlap // 2
+
+    for tile in tiles:
+        top = half if tile['row'] > 0 else 0
+        left = half if tile['col'] > 0 else 0
+        bottom = tile['height'] - (overlap - half) if tile['row'] < last_row else tile['height']
+        right = tile['width'] - (overlap - half) if tile['col'] < last_col else tile['width']
+
+        mask = _read_mask(mask_paths[tile['index']])[top:bottom, left:right]
+        labels = tile_labels[tile['index']]
+        roots = union.roots(offsets[tile['index']] + 1 + np.arange(len(labels), dtype=np.int64))
+
+        lookup = np.zeros(len(labels) + 1, dtype=np.uint32)
+        for i, root in enumerate(roots):
+            root = int(root)
+            if root not in final:
+                final[root] = len(final) + 1
+            lookup[i + 1] = final[root]
+
+        core = np.zeros(mask.shape, dtype=np.uint32)
+        nonzero = mask > 0
+        core[nonzero] = lookup[1 + np.searchsorted(labels, mask[nonzero])]
+        y, x = tile['y'] + top, tile['x'] + left
+        out[y:y + core.shape[0], x:x + core.shape[1]] = core
+
+    out.flush()
+    del out
+    print(f"Merged {len(tiles)} tiles into {output}: {next_offset} tile labels, "
+          f"{len(union.parent)} merged across seams, {len(final)} cells")
+    return len(final)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tile whole-slide segmentation inputs and stitch tile masks")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    split_parser = subparsers.add_parser('split', help="Cut inputs into overlapping tiles")
+    split_parser.add_argument("-i", "--input", type=str, action="append", required=True,
+                              help="Single-channel input TIFF; repeat for nuclear/membrane")
+    split_parser.add_argument("-n", "--name", type=str, action="append",
+                              help="Name used in tile file names for each input (default: input1, input2, ...)")
+    split_parser.add_argument("-p", "--prefix", type=str, required=True, help="Output file prefix")
+    split_parser.add_argument("--tile-size", type=int, default=4096, help="Tile width/height in pixels")
+    split_parser.add_argument("--overlap", type=int, default=128, help="Overlap between neighbouring tiles in pixels")
+    split_parser.add_argument("--stack", action="store_true", help="Write all inputs of a tile as one (C, Y, X) file")
+
+    merge_parser = subparsers.add_parser('merge', help="Stitch tile label masks into one mask")
+    merge_parser.add_argument("-m", "--manifest", type=str, required=True, help="Tile manifest written by split")
+    merge_parser.add_argument("-o", "--output", type=str, required=True, help="Output label mask .tif")
+    merge_parser.add_argument("--iou", type=float, default=0.5, help="Minimum IoU in the overlap to join two labels")
+    merge_parser.add_argument("masks", nargs='+', help="Tile masks; the tile index is parsed from 'tileNNNN' in the name")
+
+    for subparser in (split_parser, merge_parser):
+        perf.add_argument(subparser)
+
+    args = parser.parse_args()
+    perf.enable(args.perf, script=f"tile_segmentation.py {args.command}")
+
+    if args.command == 'split':
+        names = args.name or [f"input{i + 1}" for i in range(len(args.input))]
+        if len(names) != len(args.input):
+            parser.error("--name must be given once per --input")
+        with perf.phase('split'):
+            manifest = split(args.input, names, args.prefix, args.tile_size, args.overlap, args.stack)
+        perf.write(manifest)
+    else:
+        with perf.phase('merge'):
+            perf.add('cells', merge(args.manifest, args.masks, args.output, args.iou))
+        perf.write(args.output)
+
+
+if __name__ == "__main__":
+    main()
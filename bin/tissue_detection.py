@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+# Version: 0.0.1
+# Finds the tissue on a coarse pyramid level, so that later steps can crop whole-slide
+# scans to it instead of processing the empty glass around it. Each channel is scaled to
+# its own 99th percentile and max-projected, the projection is thresholded with Otsu on a
+# log scale, and the bounding box of the remaining components (small specks and dust are
+# dropped) is the tissue region.
+
+import argparse
+from typing import Dict, Optional, Tuple
+import numpy as np
+import tifffile
+import perf
+
+# components smaller than this fraction of the coarse image are ignored
+DEFAULT_MIN_AREA = 0.001
+# margin around the tissue, in coarse pixels
+DEFAULT_MARGIN = 2
+
+
+def tissue_projection(image: np.ndarray, axes: str) -> np.ndarray:
+    """Max projection over all non-spatial axes of the per-plane normalised image."""
+    y_idx, x_idx = axes.index('Y'), axes.index('X')
+    planes = np.moveaxis(image, (y_idx, x_idx), (-2, -1))
+    planes = planes.reshape((-1,) + planes.shape[-2:]).astype(np.float32)
+
+    projection = np.zeros(planes.shape[1:], dtype=np.float32)
+    for plane in planes:
+        high = np.percentile(plane, 99)
+        low = plane.min()
+        if high > low:
+            np.maximum(projection, np.clip((plane - low) / (high - low), 0, 1), out=projection)
+    return projection
+
+
+def tissue_mask(image: np.ndarray, axes: str, min_area: float = DEFAULT_MIN_AREA) -> np.ndarray:
+    """Boolean tissue mask of a coarse image."""
+    from scipy import ndimage
+    from skimage.filters import threshold_otsu
+
+    projection = np.log1p(tissue_projection(image, axes) * 255)
+    if projection.max() == projection.min():
+        return np.zeros(projection.shape, dtype=bool)
+
+    mask = projection > threshold_otsu(projection)
+    mask = ndimage.binary_opening(mask)
+    mask = ndimage.binary_closing(mask, iterations=2)
+    mask = ndimage.binary_fill_holes(mask)
+
+    labels, n = ndimage.label(mask)
+    if n == 0:
+        return mask
+    areas = np.bincount(labels.ravel())
+    keep = areas >= min_area * mask.size
+    keep[0] = False
+    return keep[labels]
+
+
+def tissue_bbox(
+    mask: np.ndarray,
+    margin: int = DEFAULT_MARGIN
+) -> Optional[Tuple[int, int, int, int]]:
+    """(y0, x0, y1, x1) around all tissue in mask, padded by margin, upper bounds exclusive; None without tissue."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if not len(rows):
+        return None
+    height, width = mask.shape
+    return (
+        max(0, int(rows[0]) - margin),
+        max(0, int(cols[0]) - margin),
+        min(height, int(rows[-1]) + 1 + margin),
+        min(width, int(cols[-1]) + 1 + margin),
+    )
+
+
+def scale_bbox(
+    bbox: Tuple[int, int, int, int],
+    coarse_shape: Tuple[int, int],
+    level_shape: Tuple[int, int],
+    align: int = 1
+) -> Tuple[int, int, int, int]:
+    """
+    Map a coarse bbox onto a finer level of height x width level_shape, rounding outwards,
+    with the origin on a multiple of align (so that block downsampling keeps its grid).
+    """
+    y0, x0, y1, x1 = bbox
+    sy = level_shape[0] / coarse_shape[0]
+    sx = level_shape[1] / coarse_shape[1]
+    y0 = int(np.floor(y0 * sy)) // align * align
+    x0 = int(np.floor(x0 * sx)) // align * align
+    y1 = min(level_shape[0], int(np.ceil(y1 * sy)))
+    x1 = min(level_shape[1], int(np.ceil(x1 * sx)))
+    return y0, x0, y1, x1
+
+
+def detect_tissue(
+    image: np.ndarray,
+    axes: str,
+    min_area: float = DEFAULT_MIN_AREA,
+    margin: int = DEFAULT_MARGIN
+) -> Dict:
+    """Tissue mask, bbox (None without tissue) and tissue fraction of a coarse image."""
+    mask = tissue_mask(image, axes, min_area)
+    bbox = tissue_bbox(mask, margin)
+    return {
+        'mask': mask,
+        'bbox': bbox,
+        'tissue_fraction': float(mask.mean()),
+        'bbox_fraction': 0.0 if bbox is None else (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) / mask.size,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detect the tissue region of an OME-TIFF on its smallest pyramid level.")
+    parser.add_argument("input", type=str, help="Input OME-TIFF")
+    parser.add_argument("--mask", type=str, help="Write the coarse tissue mask to this TIFF")
+    parser.add_argument("--min-area", type=float, default=DEFAULT_MIN_AREA,
+                        help=f"Smallest tissue component, as a fraction of the image (default: {DEFAULT_MIN_AREA})")
+    parser.add_argument("--margin", type=int, default=DEFAULT_MARGIN,
+                        help=f"Margin around the tissue in coarse pixels (default: {DEFAULT_MARGIN})")
+    perf.add_argument(parser)
+    args = parser.parse_args()
+    perf.enable(args.perf)
+
+    from ome_tiff_rescaler import OMETIFFRescaler
+
+    rescaler = OMETIFFRescaler(args.input, args.input)
+    with perf.phase('plan'):
+        plan = rescaler.plan_pyramid()
+    with plan:
+        coarse = plan.coarsest_level()
+        with perf.phase('read_coarse'):
+            image = plan.read_level(coarse.index)
+            perf.add('pixels_decoded', image.size)
+    with perf.phase('detect'):
+        tissue = detect_tissue(image, coarse.axes, args.min_area, args.margin)
+
+    base = plan.levels[0]
+    base_yx = (base.shape[base.axes.index('Y')], base.shape[base.axes.index('X')])
+    print(f"Coarse level {coarse.index}: shape={coarse.shape}, axes={coarse.axes}")
+    print(f"Tissue fraction: {tissue['tissue_fraction']:.3f}")
+    if tissue['bbox'] is None:
+        print("No tissue found")
+    else:
+        print(f"Tissue bbox (coarse y0, x0, y1, x1): {tissue['bbox']}")
+        print(f"Tissue bbox (level 0): {scale_bbox(tissue['bbox'], tissue['mask'].shape, base_yx)}")
+        print(f"Bbox covers {tissue['bbox_fraction']:.3f} of the image")
+    if args.mask:
+        tifffile.imwrite(args.mask, tissue['mask'].astype(np.uint8) * 255)
+        print(f"Saved tissue mask to {args.mask}")
+        perf.write(args.mask)
+
+
+if __name__ == "__main__":
+    main()
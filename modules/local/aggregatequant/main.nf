@@ -0,0 +1,48 @@
+process AGGREGATE_QUANT {
+    tag "$meta.id"
+    label 'process_single'
+
+    container "ghcr.io/patrickcrock/mihcro_python:1.1"
+
+    input:
+    tuple val(meta), path(cellbyfeature)
+    tuple val(meta2), path(markerfile)
+
+    output:
+    tuple val(meta), path("*_qc")   , emit: qc
+    path "versions.yml"            , emit: versions
+    path "*.perf.json"             , emit: perf, optional: true
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def args = task.ext.args ?: ''
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    aggregate_quant.py \\
+        -i ${cellbyfeature} \\
+        -m ${markerfile} \\
+        -o ${prefix}_qc \\
+        $args
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        aggregate_quant.py: \$(grep 'Version: ' aggregate_quant.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
+
+    stub:
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    mkdir ${prefix}_qc
+    touch ${prefix}_qc/summary.csv
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        aggregate_quant.py: \$(grep 'Version: ' aggregate_quant.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
+}
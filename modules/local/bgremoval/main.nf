@@ -14,6 +14,7 @@ process DAPI_BACKGROUND_REMOVAL {
     tuple val(meta), path("*_dapi_processed.tif"), emit: processed_image
     tuple val(meta), path("*_dapi_diagnostic.png"), emit: diagnostic
     path "versions.yml"           , emit: versions
+    path "*.perf.json"            , emit: perf, optional: true
 
     when:
     params.dapi_bg_method != "none"
@@ -55,3 +56,59 @@ process DAPI_BACKGROUND_REMOVAL {
     END_VERSIONS
     """
 }
+
+process DAPI_AF_BACKGROUND_REMOVAL {
+    tag "$meta.id"
+    label 'process_low'
+
+    container "ghcr.io/patrickcrock/mihcro_python:1.1"
+    containerOptions "--env MPLCONFIGDIR=/tmp/matplotlib-${task.index}"
+
+    publishDir "${params.outdir}/dapi_processed", mode: 'copy'
+
+    input:
+    tuple val(meta), path(xml), path(ome_tif)
+
+    output:
+    tuple val(meta), path("*_dapi_processed.tif"), emit: processed_image
+    tuple val(meta), path("*_dapi_diagnostic.png"), emit: diagnostic
+    path "versions.yml"           , emit: versions
+    path "*.perf.json"            , emit: perf, optional: true
+
+    when:
+    params.dapi_bg_method == "af"
+
+    script:
+    def args = task.ext.args ?: ''
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    // DAPI and AF are read from the image and subtracted tile by tile, without extracting them first
+    """
+    otsu_thresholding.py \\
+        --image ${ome_tif} \\
+        --xml ${xml} \\
+        -o ${prefix}_dapi_processed.tif \\
+        -m af \\
+        -l ${params.dapi_otsu_leniency} \\
+        -p ${prefix}_dapi_diagnostic.png \\
+        ${args}
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        otsu_thresholding.py: \$(grep 'Version: ' otsu_thresholding.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
+
+    stub:
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    touch ${prefix}_dapi_processed.tif
+    touch ${prefix}_dapi_diagnostic.png
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        otsu_thresholding.py: \$(grep 'Version: ' otsu_thresholding.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
+}
@@ -0,0 +1,53 @@
+process CELL_OUTLINES {
+    tag "$meta.id"
+    label 'process_low'
+
+    container "ghcr.io/patrickcrock/mihcro_python:1.1"
+
+    input:
+    tuple val(meta), path(mask), path(bbox), path(image), path(downscale_json)
+
+    output:
+    tuple val(meta), path("*_outlines.geojson*"), emit: outlines
+    path "versions.yml"                         , emit: versions
+    path "*.perf.json"                          , emit: perf, optional: true
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def args = task.ext.args ?: ''
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    def suffix = params.cell_outlines == 'geojsonseq' ? 'geojsonl.gz' : 'geojson'
+    def bbox_arg = bbox ? "--bbox ${bbox}" : ''
+    def offset_arg = downscale_json ? "--offset-json ${downscale_json}" : ''
+    """
+    cell_outlines.py \\
+        -i ${mask} \\
+        -o ${prefix}_outlines.${suffix} \\
+        --image ${image} \\
+        --workers ${task.cpus} \\
+        ${bbox_arg} \\
+        ${offset_arg} \\
+        $args
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        cell_outlines.py: \$(grep 'Version: ' cell_outlines.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
+
+    stub:
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    def suffix = params.cell_outlines == 'geojsonseq' ? 'geojsonl.gz' : 'geojson'
+    """
+    touch ${prefix}_outlines.${suffix}
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        cell_outlines.py: \$(grep 'Version: ' cell_outlines.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
+}
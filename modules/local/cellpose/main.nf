@@ -76,21 +76,35 @@ process PREPROCESS_CELLPOSE {
 
     output:
     tuple val(meta), path("*_combined.tif"), emit: combined
+    path "versions.yml"                    , emit: versions
+    path "*.perf.json"                     , emit: perf, optional: true
 
     script:
+    def args = task.ext.args ?: ''
     def prefix = task.ext.prefix ?: "${meta.id}"
     """
-    #!/usr/bin/env python3
-    import numpy as np
-    import tifffile
+    stack_segmentation_input.py \\
+        -i ${membrane} \\
+        -i ${nuclear} \\
+        -o ${prefix}_combined.tif \\
+        ${args}
 
-    nuclear_img = tifffile.imread("$nuclear")
-    membrane_img = tifffile.imread("$membrane")
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        stack_segmentation_input.py: \$(grep 'Version: ' stack_segmentation_input.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
 
-    if nuclear_img.shape != membrane_img.shape:
-        raise ValueError("Images must have same dimensions")
+    stub:
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    touch ${prefix}_combined.tif
 
-    stacked = np.stack([membrane_img, nuclear_img], axis=0)
-    tifffile.imwrite("${prefix}_combined.tif", stacked)
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        stack_segmentation_input.py: \$(grep 'Version: ' stack_segmentation_input.py | cut -d ' ' -f 3)
+    END_VERSIONS
     """
  }
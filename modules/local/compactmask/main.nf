@@ -0,0 +1,47 @@
+process COMPACT_MASK {
+    tag "$meta.id"
+    label 'process_low'
+
+    container "ghcr.io/patrickcrock/mihcro_python:1.1"
+
+    input:
+    tuple val(meta), path(mask)
+
+    output:
+    tuple val(meta), path("*_labels.tif")      , emit: mask
+    tuple val(meta), path("*_labels.bbox.csv") , emit: bbox
+    path "versions.yml"                        , emit: versions
+    path "*.perf.json"                         , emit: perf, optional: true
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def args = task.ext.args ?: ''
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    compact_mask.py \\
+        -i ${mask} \\
+        -o ${prefix}_labels.tif \\
+        $args
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        compact_mask.py: \$(grep 'Version: ' compact_mask.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
+
+    stub:
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    touch ${prefix}_labels.tif
+    touch ${prefix}_labels.bbox.csv
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        compact_mask.py: \$(grep 'Version: ' compact_mask.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
+}
@@ -10,14 +10,17 @@ process DOWNSCALE_OME_TIFF {
 
     output:
     tuple val(meta), path("*.downscaled.ome.tiff"), emit: downscaled
-    tuple val(meta), path("*.json"), emit: metadata
+    tuple val(meta), path("*.downscaled.ome.json"), emit: metadata
     path "versions.yml", emit: versions
+    path "*.perf.json", emit: perf, optional: true
 
     script:
+    def args = task.ext.args ?: ''
     def prefix = task.ext.prefix ?: "${meta.id}"
     """
     ome_tiff_rescaler.py \\
         ${ome_tiff} \\
+        $args \\
         --prefix ${prefix}
 
     cat <<-END_VERSIONS > versions.yml
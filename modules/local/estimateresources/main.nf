@@ -0,0 +1,46 @@
+process ESTIMATE_RESOURCES {
+    tag "$meta.id"
+    label 'process_single'
+
+    container "ghcr.io/patrickcrock/mihcro_python:1.1"
+
+    input:
+    tuple val(meta), path(image)
+    path(model)
+
+    output:
+    tuple val(meta), path("*.resources.json"), emit: resources
+    path "versions.yml"                      , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def args = task.ext.args ?: ''
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    estimate_resources.py estimate \\
+        ${image} \\
+        --model ${model} \\
+        --prefix ${prefix} \\
+        $args
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        estimate_resources.py: \$(grep 'Version: ' estimate_resources.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
+
+    stub:
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    echo '{}' > ${prefix}.resources.json
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        estimate_resources.py: \$(grep 'Version: ' estimate_resources.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
+}
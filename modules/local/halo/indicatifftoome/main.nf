@@ -9,7 +9,10 @@ process INDICA_TIFF_TO_OME {
 
     output:
     tuple val(meta), path("*.ome.tif") , emit: image
+    tuple val(meta), path("*.downscaled.ome.tiff"), emit: downscaled, optional: true
+    tuple val(meta), path("*.downscaled.ome.json"), emit: metadata, optional: true
     path "versions.yml"           , emit: versions
+    path "*.perf.json"            , emit: perf, optional: true
 
     when:
     task.ext.when == null || task.ext.when
@@ -43,9 +46,13 @@ END_VERSIONS
     """
 
     stub:
+    def args = task.ext.args ?: ''
     def prefix = task.ext.prefix ?: "${meta.id}"
+    def downscale_prefix = (args =~ /--downscale-prefix\s+(\S+)/)
+    def downscale_touch = downscale_prefix ? "touch ${downscale_prefix[0][1]}.downscaled.ome.tiff ${downscale_prefix[0][1]}.downscaled.ome.json" : ''
     """
     touch ${prefix}.ome.tif
+    ${downscale_touch}
 
     cat <<-END_VERSIONS > versions.yml
 "${task.process}":
@@ -0,0 +1,45 @@
+process PREPROCESS_MESMER {
+    tag "$meta.id"
+    label 'process_low'
+
+    container "ghcr.io/patrickcrock/mihcro_python:1.1"
+
+    input:
+    tuple val(meta), path(image)
+
+    output:
+    tuple val(meta), path("*_mesmer_input.tif"), emit: image
+    path "versions.yml"                        , emit: versions
+    path "*.perf.json"                         , emit: perf, optional: true
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def args = task.ext.args ?: ''
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    stack_segmentation_input.py \\
+        -i ${image} \\
+        -o ${prefix}_mesmer_input.tif \\
+        ${args}
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        stack_segmentation_input.py: \$(grep 'Version: ' stack_segmentation_input.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
+
+    stub:
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    touch ${prefix}_mesmer_input.tif
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        stack_segmentation_input.py: \$(grep 'Version: ' stack_segmentation_input.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
+}
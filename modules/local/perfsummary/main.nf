@@ -0,0 +1,43 @@
+process SUMMARISE_PERF {
+    label 'process_single'
+
+    container "ghcr.io/patrickcrock/mihcro_python:1.1"
+
+    input:
+    path(perf_files, stageAs: 'perf??/*')
+
+    output:
+    path "*_phases.tsv"  , emit: phases
+    path "*_summary.tsv" , emit: summary
+    path "versions.yml"  , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def prefix = task.ext.prefix ?: "mihcro_perf"
+    """
+    summarise_perf.py \\
+        --prefix ${prefix} \\
+        ${perf_files}
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        summarise_perf.py: \$(grep 'Version: ' summarise_perf.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
+
+    stub:
+    def prefix = task.ext.prefix ?: "mihcro_perf"
+    """
+    touch ${prefix}_phases.tsv
+    touch ${prefix}_summary.tsv
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        summarise_perf.py: \$(grep 'Version: ' summarise_perf.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
+}
@@ -6,7 +6,7 @@ process RENDER_REPORT {
     container "ghcr.io/patrickcrock/rmdqc_microscopy:1.0"
 
     input:
-    tuple val(meta), path(cellbyfeature)
+    tuple val(meta), path(qcstats)
     tuple val(meta3), path(markerfile)
     path rmd_file
 
@@ -21,7 +21,7 @@ process RENDER_REPORT {
     R -e "rmarkdown::render('${rmd_file}', \
         output_format='html_document', \
         output_file='${prefix}_report.html', \
-        params=list(cellbyfeature='${cellbyfeature.name}', markerfile='${markerfile.name}', samplename='${prefix}'), \
+        params=list(qcstats='${qcstats.name}', markerfile='${markerfile.name}', samplename='${prefix}'), \
         envir=new.env())"
 
     cat <<-END_VERSIONS > versions.yml
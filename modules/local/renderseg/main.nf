@@ -13,6 +13,7 @@ process RENDER_SEGMENTATION {
     tuple val(meta), path("*_bw_boundaries.tiff"), emit: boundaries_bw
     tuple val(meta), path("*_rgb_boundaries.tiff"), emit: boundaries_rgb
     path "versions.yml", emit: versions
+    path "*.perf.json", emit: perf, optional: true
 
     script:
     def prefix = task.ext.prefix ?: "${meta.id}"
@@ -13,6 +13,7 @@ process SEPARATEIMAGECHANNELS {
     output:
     tuple val(meta), path("*.tif"), emit: image
     path "versions.yml"           , emit: versions
+    path "*.perf.json"            , emit: perf, optional: true
 
     when:
     task.ext.when == null || task.ext.when
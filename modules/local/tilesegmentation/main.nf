@@ -0,0 +1,101 @@
+process SPLIT_SEGMENTATION_TILES {
+    tag "$meta.id"
+    label 'process_low'
+
+    container "ghcr.io/patrickcrock/mihcro_python:1.1"
+
+    input:
+    tuple val(meta), path(nuclear), path(membrane)
+    val(stack)
+
+    output:
+    tuple val(meta), path("*.tile*.tif")  , emit: tiles
+    tuple val(meta), path("*.tiles.json") , emit: manifest
+    path "versions.yml"                   , emit: versions
+    path "*.perf.json"                    , emit: perf, optional: true
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def args = task.ext.args ?: ''
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    def nuclear_arg = "-i ${nuclear} -n nuclear"
+    def membrane_arg = membrane ? "-i ${membrane} -n membrane" : ''
+    // Cellpose expects stacked tiles in (membrane, nuclear) order
+    def input_args = stack ? "${membrane_arg} ${nuclear_arg} --stack" : "${nuclear_arg} ${membrane_arg}"
+    """
+    tile_segmentation.py split \\
+        ${input_args} \\
+        -p ${prefix} \\
+        --tile-size ${params.segmentation_tile_size} \\
+        --overlap ${params.segmentation_tile_overlap} \\
+        $args
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        tile_segmentation.py: \$(grep 'Version: ' tile_segmentation.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
+
+    stub:
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    touch ${prefix}.tile0000.tif
+    touch ${prefix}.tiles.json
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        tile_segmentation.py: \$(grep 'Version: ' tile_segmentation.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
+}
+
+process MERGE_SEGMENTATION_TILES {
+    tag "$meta.id"
+    label 'process_low'
+
+    container "ghcr.io/patrickcrock/mihcro_python:1.1"
+
+    input:
+    tuple val(meta), path(masks, stageAs: 'masks/*'), path(manifest)
+
+    output:
+    tuple val(meta), path("*_mask.tif"), emit: mask
+    path "versions.yml"                , emit: versions
+    path "*.perf.json"                 , emit: perf, optional: true
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def args = task.ext.args ?: ''
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    tile_segmentation.py merge \\
+        -m ${manifest} \\
+        -o ${prefix}_mask.tif \\
+        $args \\
+        masks/*
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        tile_segmentation.py: \$(grep 'Version: ' tile_segmentation.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
+
+    stub:
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    touch ${prefix}_mask.tif
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        tile_segmentation.py: \$(grep 'Version: ' tile_segmentation.py | cut -d ' ' -f 3)
+    END_VERSIONS
+    """
+}
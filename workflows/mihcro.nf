@@ -12,22 +12,31 @@ include { BFTOOLS_TIFFMETAXML } from '../modules/local/bftools/tiffmetaxml/main'
 include { INDICA_TIFF_TO_OME } from '../modules/local/halo/indicatifftoome/main.nf'
 include { HANDLE_STITCHED } from '../modules/local/handlestitched/main'
 include { EXTRACTIMAGECHANNEL as EXTRACT_DAPI } from '../modules/local/extractimagechannel/main'
-include { EXTRACTIMAGECHANNEL as EXTRACT_AF } from '../modules/local/extractimagechannel/main'
 include { EXTRACTIMAGECHANNEL as EXTRACT_MEMBRANE } from '../modules/local/extractimagechannel/main'
 
 
 include { DOWNSCALE_OME_TIFF } from '../modules/local/downscaletiff'
+include { ESTIMATE_RESOURCES } from '../modules/local/estimateresources/main'
 
 include { DEEPCELL_MESMER } from '../modules/nf-core/deepcell/mesmer/main'
 include { PREPROCESS_CELLPOSE } from '../modules/local/cellpose/main'
 include { CELLPOSE } from '../modules/local/cellpose/main' // custom module to set cache directories
+include { PREPROCESS_MESMER as PREPROCESS_MESMER_NUCLEAR } from '../modules/local/mesmerprep/main'
+include { PREPROCESS_MESMER as PREPROCESS_MESMER_MEMBRANE } from '../modules/local/mesmerprep/main'
+
+include { SPLIT_SEGMENTATION_TILES } from '../modules/local/tilesegmentation/main'
+include { MERGE_SEGMENTATION_TILES } from '../modules/local/tilesegmentation/main'
+include { COMPACT_MASK } from '../modules/local/compactmask/main'
+include { CELL_OUTLINES } from '../modules/local/celloutlines/main'
 
 include { SEPARATEIMAGECHANNELS } from '../modules/local/separateimagechannels/main'
 include { MCQUANT } from '../modules/nf-core/mcquant/main'
 
+include { AGGREGATE_QUANT } from '../modules/local/aggregatequant/main'
 include { RENDER_REPORT } from '../modules/local/qcreportR/main'
 include { RENDER_SEGMENTATION } from '../modules/local/renderseg/main'
-include { DAPI_BACKGROUND_REMOVAL } from '../modules/local/bgremoval/main.nf'
+include { DAPI_BACKGROUND_REMOVAL; DAPI_AF_BACKGROUND_REMOVAL } from '../modules/local/bgremoval/main.nf'
+include { SUMMARISE_PERF } from '../modules/local/perfsummary/main'
 
 /*
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -82,16 +91,46 @@ workflow MIHCRO {
         .mix(HANDLE_STITCHED.out.versions)
         .mix(INDICA_TIFF_TO_OME.out.versions)
 
+    // Per-stage metrics from the bin/ scripts, only written when params.perf_metrics is set
+    ch_perf = Channel.empty()
+        .mix(INDICA_TIFF_TO_OME.out.perf)
+
+
+    // Per-sample memory/time of the later Python steps, predicted from the image headers
+    // and carried in meta.resources (applied by conf/resources.config)
+    def withResources = { ch -> ch }
+    if (params.resource_estimates) {
+        ESTIMATE_RESOURCES(ch_images, file(params.resource_model, checkIfExists: true))
+        ch_versions = ch_versions.mix(ESTIMATE_RESOURCES.out.versions)
+
+        ch_resources = ESTIMATE_RESOURCES.out.resources
+            .map { meta, json -> [meta, new groovy.json.JsonSlurper().parse(json)] }
+        withResources = { ch ->
+            ch.join(ch_resources).map { meta, image, resources -> [meta + [resources: resources], image] }
+        }
+    }
 
     // Conditional downscaling based on parameter
+    // HALO fused inputs are already downscaled by INDICA_TIFF_TO_OME during conversion
     if (params.downscale_mode == '1um') {
         DOWNSCALE_OME_TIFF(
-            ch_images
+            withResources(
+                Channel.empty()
+                    .mix(QUPATH_STITCH.out.image)
+                    .mix(HANDLE_STITCHED.out.image)
+            )
         )
         ch_processed_images = DOWNSCALE_OME_TIFF.out.downscaled
+            .mix(withResources(INDICA_TIFF_TO_OME.out.downscaled))
+        // [id, metadata JSON], for the tissue crop offsets
+        ch_downscale_json = DOWNSCALE_OME_TIFF.out.metadata
+            .mix(INDICA_TIFF_TO_OME.out.metadata)
+            .map { meta, json -> [meta.id, json] }
         ch_versions = ch_versions.mix(DOWNSCALE_OME_TIFF.out.versions)
+        ch_perf = ch_perf.mix(DOWNSCALE_OME_TIFF.out.perf)
     } else {
-        ch_processed_images = ch_images
+        ch_processed_images = withResources(ch_images)
+        ch_downscale_json = ch_images.map { meta, image -> [meta.id, []] }
     }
 
     // Extract XML, DAPI channel from processed images
@@ -99,38 +138,39 @@ workflow MIHCRO {
 
     ch_versions = ch_versions.mix(BFTOOLS_TIFFMETAXML.out.versions)
 
-    EXTRACT_DAPI (
-        BFTOOLS_TIFFMETAXML.out.xml_tif
-    )
-    ch_versions = ch_versions.mix(EXTRACT_DAPI.out.versions)
-
     // Background removal and otsu thresholding, if requested
-    if (params.dapi_bg_method != "none") {
-        if (params.dapi_bg_method == "af") {
-            // Extract both DAPI and AF channels
-            ch_dapi = EXTRACT_DAPI.out.image
-            ch_af = EXTRACT_AF(BFTOOLS_TIFFMETAXML.out.xml_tif).image
-
-            // Join DAPI and AF by meta.id, then pass to background removal
-            ch_bg_input = ch_dapi.join(ch_af, by: 0)
-            DAPI_BACKGROUND_REMOVAL(ch_bg_input)
-        } else {
+    if (params.dapi_bg_method == "af") {
+        // DAPI and AF are read straight from the image and subtracted in one pass
+        DAPI_AF_BACKGROUND_REMOVAL(BFTOOLS_TIFFMETAXML.out.xml_tif)
+        ch_nuclear_image = DAPI_AF_BACKGROUND_REMOVAL.out.processed_image
+        ch_versions = ch_versions.mix(DAPI_AF_BACKGROUND_REMOVAL.out.versions)
+        ch_perf = ch_perf.mix(DAPI_AF_BACKGROUND_REMOVAL.out.perf)
+    } else {
+        EXTRACT_DAPI (
+            BFTOOLS_TIFFMETAXML.out.xml_tif
+        )
+        ch_versions = ch_versions.mix(EXTRACT_DAPI.out.versions)
+        ch_perf = ch_perf.mix(EXTRACT_DAPI.out.perf)
+
+        if (params.dapi_bg_method != "none") {
             // No AF channel needed - add empty placeholder
             ch_bg_input = EXTRACT_DAPI.out.image.map { meta, dapi ->
                 [meta, dapi, []]
             }
             DAPI_BACKGROUND_REMOVAL(ch_bg_input)
+            ch_nuclear_image = DAPI_BACKGROUND_REMOVAL.out.processed_image
+            ch_versions = ch_versions.mix(DAPI_BACKGROUND_REMOVAL.out.versions)
+            ch_perf = ch_perf.mix(DAPI_BACKGROUND_REMOVAL.out.perf)
+        } else {
+            ch_nuclear_image = EXTRACT_DAPI.out.image
         }
-        ch_nuclear_image = DAPI_BACKGROUND_REMOVAL.out.processed_image
-        ch_versions = ch_versions.mix(DAPI_BACKGROUND_REMOVAL.out.versions)
-    } else {
-        ch_nuclear_image = EXTRACT_DAPI.out.image
     }
 
     // Extract membrane channel if requested
     if (params.membrane_channel != null) {
         EXTRACT_MEMBRANE(BFTOOLS_TIFFMETAXML.out.xml_tif)
         ch_membrane = EXTRACT_MEMBRANE.out.image
+        ch_perf = ch_perf.mix(EXTRACT_MEMBRANE.out.perf)
     } else {
         // Create a dummy membrane channel matched to nuclear images
         ch_membrane = ch_nuclear_image.map { meta, img -> [meta, []] }
@@ -138,14 +178,81 @@ workflow MIHCRO {
 
     // Segmentation
 
+    // With --segmentation_tile_size: one [meta + [tile: index], tile] per tile file, with the
+    // sample's tile count in meta.n_tiles so that each sample's masks are merged as soon as
+    // its own tiles are segmented, not once every sample's tiles are
+    def perTile = { ch -> ch
+        .map { meta, tiles ->
+            def files = tiles instanceof List ? tiles : [tiles]
+            [meta + [n_tiles: files.collect { (it.name =~ /tile(\d+)/)[0][1] }.unique().size()], files]
+        }
+        .transpose()
+        .map { meta, tile -> [meta + [tile: (tile.name =~ /tile(\d+)/)[0][1]], tile] }
+    }
+    def groupTiles = { ch -> ch
+        .map { meta, mask -> [groupKey(meta.findAll { !(it.key in ['tile', 'n_tiles']) }, meta.n_tiles), mask] }
+        .groupTuple()
+        .map { key, masks -> [key.getGroupTarget(), masks] }
+    }
+
     if (params.segmentation == 'mesmer') {
 
-        DEEPCELL_MESMER (
-            ch_nuclear_image,
-            ch_membrane
-        )
+        // Normalise dtype/intensity of the Mesmer inputs, if requested
+        ch_mesmer_nuclear = ch_nuclear_image
+        ch_mesmer_membrane = ch_membrane
+        if (params.segmentation_input_dtype || params.segmentation_input_rescale) {
+            PREPROCESS_MESMER_NUCLEAR(ch_nuclear_image)
+            ch_mesmer_nuclear = PREPROCESS_MESMER_NUCLEAR.out.image
+            ch_versions = ch_versions.mix(PREPROCESS_MESMER_NUCLEAR.out.versions)
+            ch_perf = ch_perf.mix(PREPROCESS_MESMER_NUCLEAR.out.perf)
+
+            if (params.membrane_channel != null) {
+                PREPROCESS_MESMER_MEMBRANE(ch_membrane)
+                ch_mesmer_membrane = PREPROCESS_MESMER_MEMBRANE.out.image
+                ch_versions = ch_versions.mix(PREPROCESS_MESMER_MEMBRANE.out.versions)
+                ch_perf = ch_perf.mix(PREPROCESS_MESMER_MEMBRANE.out.perf)
+            }
+        }
 
-        ch_segmentation = DEEPCELL_MESMER.out.mask
+        if (params.segmentation_tile_size) {
+            // Segment overlapping tiles as separate tasks, one nuclear/membrane pair per tile
+            SPLIT_SEGMENTATION_TILES(ch_mesmer_nuclear.join(ch_mesmer_membrane), false)
+            ch_versions = ch_versions.mix(SPLIT_SEGMENTATION_TILES.out.versions)
+            ch_perf = ch_perf.mix(SPLIT_SEGMENTATION_TILES.out.perf)
+
+            ch_tiles = perTile(SPLIT_SEGMENTATION_TILES.out.tiles)
+            ch_tile_nuclear = ch_tiles.filter { meta, tile -> tile.name.endsWith('.nuclear.tif') }
+            ch_tile_membrane = params.membrane_channel != null
+                ? ch_tiles.filter { meta, tile -> tile.name.endsWith('.membrane.tif') }
+                : ch_tile_nuclear.map { meta, tile -> [meta, []] }
+            ch_mesmer_tiles = ch_tile_nuclear
+                .join(ch_tile_membrane)
+                .multiMap { meta, nuclear, membrane ->
+                    nuclear: [meta, nuclear]
+                    membrane: [meta, membrane]
+                }
+
+            DEEPCELL_MESMER (
+                ch_mesmer_tiles.nuclear,
+                ch_mesmer_tiles.membrane
+            )
+
+            MERGE_SEGMENTATION_TILES(
+                groupTiles(DEEPCELL_MESMER.out.mask)
+                    .join(SPLIT_SEGMENTATION_TILES.out.manifest)
+            )
+            ch_mesmer_mask = MERGE_SEGMENTATION_TILES.out.mask
+            ch_versions = ch_versions.mix(MERGE_SEGMENTATION_TILES.out.versions)
+            ch_perf = ch_perf.mix(MERGE_SEGMENTATION_TILES.out.perf)
+        } else {
+            DEEPCELL_MESMER (
+                ch_mesmer_nuclear,
+                ch_mesmer_membrane
+            )
+            ch_mesmer_mask = DEEPCELL_MESMER.out.mask
+        }
+
+        ch_segmentation = ch_mesmer_mask
             .map { meta, it ->
                 return [meta.id, meta + [seg: 'mesmer'], it]
             }
@@ -153,9 +260,18 @@ workflow MIHCRO {
 
     } else if (params.segmentation == 'cellpose') {
 
-        if (params.membrane_channel != null) {
+        if (params.segmentation_tile_size) {
+            // Tiles are written already stacked, so PREPROCESS_CELLPOSE is not needed
+            SPLIT_SEGMENTATION_TILES(ch_nuclear_image.join(ch_membrane), true)
+            ch_versions = ch_versions.mix(SPLIT_SEGMENTATION_TILES.out.versions)
+            ch_perf = ch_perf.mix(SPLIT_SEGMENTATION_TILES.out.perf)
+
+            ch_cellpose_input = perTile(SPLIT_SEGMENTATION_TILES.out.tiles)
+        } else if (params.membrane_channel != null) {
             PREPROCESS_CELLPOSE(ch_nuclear_image, ch_membrane)
             ch_cellpose_input = PREPROCESS_CELLPOSE.out.combined
+            ch_versions = ch_versions.mix(PREPROCESS_CELLPOSE.out.versions)
+            ch_perf = ch_perf.mix(PREPROCESS_CELLPOSE.out.perf)
         } else {
             ch_cellpose_input = ch_nuclear_image
         }
@@ -165,13 +281,53 @@ workflow MIHCRO {
             []
         )
 
-        ch_segmentation = CELLPOSE.out.mask
+        if (params.segmentation_tile_size) {
+            MERGE_SEGMENTATION_TILES(
+                groupTiles(CELLPOSE.out.mask)
+                    .join(SPLIT_SEGMENTATION_TILES.out.manifest)
+            )
+            ch_cellpose_mask = MERGE_SEGMENTATION_TILES.out.mask
+            ch_versions = ch_versions.mix(MERGE_SEGMENTATION_TILES.out.versions)
+            ch_perf = ch_perf.mix(MERGE_SEGMENTATION_TILES.out.perf)
+        } else {
+            ch_cellpose_mask = CELLPOSE.out.mask
+        }
+
+        ch_segmentation = ch_cellpose_mask
             .map { meta, it ->
                 return [meta.id, meta + [seg: 'cellpose'], it]
             }
         ch_versions = ch_versions.mix(CELLPOSE.out.versions)
     }
 
+    // Relabel masks consecutively and store them in the smallest dtype, tiled and compressed
+    if (params.compact_masks) {
+        COMPACT_MASK(
+            ch_segmentation.map { id, meta, mask -> [meta, mask] }
+        )
+        ch_segmentation = COMPACT_MASK.out.mask
+            .map { meta, mask -> [meta.id, meta, mask] }
+        ch_segmentation_bbox = COMPACT_MASK.out.mask.join(COMPACT_MASK.out.bbox)
+        ch_versions = ch_versions.mix(COMPACT_MASK.out.versions)
+        ch_perf = ch_perf.mix(COMPACT_MASK.out.perf)
+    } else {
+        // cell_outlines.py scans the mask for bounding boxes itself
+        ch_segmentation_bbox = ch_segmentation.map { id, meta, mask -> [meta, mask, []] }
+    }
+
+    // Vector cell outlines in physical units, if requested
+    if (params.cell_outlines) {
+        CELL_OUTLINES(
+            ch_segmentation_bbox
+                .map { meta, mask, bbox -> [meta.id, meta, mask, bbox] }
+                .combine(ch_processed_images.map { meta, image -> [meta.id, image] }, by: 0)
+                .join(ch_downscale_json, by: 0)
+                .map { id, meta, mask, bbox, image, downscale_json -> [meta, mask, bbox, image, downscale_json] }
+        )
+        ch_versions = ch_versions.mix(CELL_OUTLINES.out.versions)
+        ch_perf = ch_perf.mix(CELL_OUTLINES.out.perf)
+    }
+
     // Quantification
     SEPARATEIMAGECHANNELS (
         ch_processed_images,
@@ -182,6 +338,7 @@ workflow MIHCRO {
             [meta.id, meta, it]
         }
     ch_versions = ch_versions.mix(SEPARATEIMAGECHANNELS.out.versions)
+    ch_perf = ch_perf.mix(SEPARATEIMAGECHANNELS.out.perf)
 
     ch_quant = ch_segmentation
         .combine( ch_separatedimg, by:0 )
@@ -203,15 +360,32 @@ workflow MIHCRO {
     )
 
     ch_versions = ch_versions.mix(RENDER_SEGMENTATION.out.versions)
+    ch_perf = ch_perf.mix(RENDER_SEGMENTATION.out.perf)
 
-    RENDER_REPORT (
+    // Stream the cell by feature table into the summary tables and cell sample the report plots
+    AGGREGATE_QUANT (
         MCQUANT.out.csv,
+        ch_markers
+    )
+    ch_versions = ch_versions.mix(AGGREGATE_QUANT.out.versions)
+    ch_perf = ch_perf.mix(AGGREGATE_QUANT.out.perf)
+
+    RENDER_REPORT (
+        AGGREGATE_QUANT.out.qc,
         ch_markers,
         file("${projectDir}/bin/QCreport.Rmd")
     )
 
     ch_versions = ch_versions.mix(RENDER_REPORT.out.versions)
 
+    //
+    // Merge per-stage metrics across samples into pipeline_info
+    //
+    if (params.perf_metrics) {
+        SUMMARISE_PERF(ch_perf.collect())
+        ch_versions = ch_versions.mix(SUMMARISE_PERF.out.versions)
+    }
+
     //
     // Collate and save software versions
     //